@@ -158,7 +158,7 @@ setup_args = dict(name='pyg2p',
                   package_data={'pyg2p': ['*.json', 'VERSION']},
                   packages=find_packages('src'),
                   keywords="NetCDF GRIB PCRaster Lisflood EFAS GLOFAS",
-                  scripts=['bin/pyg2p'],
+                  scripts=['bin/pyg2p', 'bin/pyg2p-daemon'],
                   zip_safe=False,
                   # setup.py publish to pypi.
                   cmdclass={
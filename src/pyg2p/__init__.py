@@ -1,6 +1,7 @@
 import gc
 import logging
 from collections import namedtuple
+from collections.abc import Mapping
 from datetime import datetime
 
 import eccodes
@@ -143,6 +144,46 @@ class GribGridDetails(Loggable):
         return str(self._geo_keys)
 
 
+class LazyValues(Mapping):
+    """
+    Read-only mapping Step -> values, where each array is decoded from GRIB only when the item is accessed
+    for the first time, and then kept.
+    Transformations added with map() are applied right after decoding (e.g. unit conversion).
+    """
+
+    def __init__(self, loaders, functs=(), values=None):
+        # loaders: ordered dict of Step -> callable returning the decoded array
+        self._loaders = loaders
+        self._functs = tuple(functs)
+        # decoded (and transformed) values
+        self._values = values or {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            values = self._loaders[key]()
+            for funct in self._functs:
+                values = funct(values)
+            self._values[key] = values
+        return self._values[key]
+
+    def __contains__(self, key):
+        # avoid the decoding that Mapping.__contains__ would trigger
+        return key in self._loaders
+
+    def __iter__(self):
+        return iter(self._loaders)
+
+    def __len__(self):
+        return len(self._loaders)
+
+    def map(self, funct):
+        return LazyValues(self._loaders, self._functs + (funct,))
+
+    def reorder(self, keys):
+        return LazyValues({key: self._loaders[key] for key in keys}, self._functs,
+                          {key: self._values[key] for key in keys if key in self._values})
+
+
 class Messages(Loggable):
 
     def __init__(self, values, mv, unit, type_of_level, type_of_step, step_units, grid_details, val_2nd=None, data_date=None, data_time='0'):
@@ -201,9 +242,16 @@ class Messages(Loggable):
         converter.set_missing_value(self.missing_value)
         # convert all values
         self._log(converter, 'INFO')
-        self.values_first_or_single_res = {key: converter.convert(values) for key, values in self.values_first_or_single_res.items()}
-        self.values_second_res = {key: converter.convert(values) for key, values in self.values_second_res.items()}
+        self.values_first_or_single_res = self._convert(self.values_first_or_single_res, converter)
+        self.values_second_res = self._convert(self.values_second_res, converter)
         gc.collect()
 
+    @staticmethod
+    def _convert(values, converter):
+        if isinstance(values, LazyValues):
+            # conversion will happen at decoding time
+            return values.map(converter.convert)
+        return {key: converter.convert(values_) for key, values_ in values.items()}
+
     def __len__(self):
         return len(self.values_first_or_single_res) + len(self.values_second_res)
@@ -56,7 +56,7 @@ def execute(exc_ctx):
 
 
 def config_command(exc_ctx):
-    """Executes one of the commands -W, -K, -g"""
+    """Executes one of the commands -W, -K, -g, -C"""
     conf = exc_ctx.configuration
     if exc_ctx.to_download_conf:  # -W
         # download configuration
@@ -73,3 +73,9 @@ def config_command(exc_ctx):
     elif exc_ctx.to_check_conf:  # -K
         # check unused intertables (intertables that are not in configuration and can be deleted
         conf.to_check_conf()
+
+    elif exc_ctx.to_convert_intertables:  # -C
+        # convert existing intertables to a different layout (e.g. memory-mappable)
+        layout = exc_ctx.get('convert_intertables')
+        converted = conf.convert_intertables(layout)
+        logger.info(f'Converted {len(converted)} intertables to {layout} layout')
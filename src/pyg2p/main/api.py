@@ -45,7 +45,8 @@ class Command:
                 'scaleFactor': '-S', 'offset': '-O', 
                 'validMax': '-vM', 'validMin': '-vm', 'valueFormat': '-vf',
                 'log_level': '-l', 'log_dir': '-d', 'out_format': '-F', 'outputStepUnits': '-U',
-                'create_intertable': '-B', 'parallel': '-X', 'intertable_dir': '-N'}
+                'create_intertable': '-B', 'parallel': '-X', 'intertable_dir': '-N',
+                'decode_workers': '-j', 'max_memory': '-M', 'modes': '--modes'}
 
     def _a(self, opt, param=''):
         self._d[opt] = param
@@ -107,6 +108,7 @@ class ApiContext(Context):
         self._vars['geopotential.dir'] = self.api_conf.get('geopotentialDir')
         self._vars['interpolation.create'] = self.api_conf.get('createIntertable', False)
         self._vars['interpolation.parallel'] = self.api_conf.get('interpolationParallel', True)
+        self._vars['input.decodeWorkers'] = self.api_conf.get('decodeWorkers')
         self._vars['outMaps.fmap'] = self.api_conf.get('fmap')
         self._vars['outMaps.ext'] = self.api_conf.get('ext')
         self._vars['outMaps.namePrefix'] = self.api_conf.get('namePrefix')
@@ -174,6 +176,9 @@ class ApiContext(Context):
         self._vars['interpolation.use_broadcasting'] = interpolation_conf.get('use_broadcasting', False)
         self._vars['interpolation.num_of_splits'] = interpolation_conf.get('num_of_splits', None)        
         self._vars['interpolation.rotated_target'] = interpolation_conf.get('rotated_target', False)
+        max_memory = self.api_conf.get('maxMemory') or interpolation_conf.get('max_memory')
+        self._vars['interpolation.max_memory'] = strings.to_bytes(max_memory) if max_memory else None
+        self._vars['interpolation.modes'] = strings.to_list(self.api_conf['intertableModes']) if self.api_conf.get('intertableModes') else None
         if not self._vars['interpolation.dir'] and self.api_conf.get('intertableDir'):
             self._vars['interpolation.dirs']['user'] = self.api_conf['intertableDir']
 
@@ -290,20 +295,9 @@ class Pyg2pApi:
         values, self.messages, self.change_res_step = ctrl.execute(write_results=False)
         # need interpolation and correction
         self.interpolator = Interpolator(self.context, grib_info.mv)
-        is_second_res = False
-        lats, longs = self.messages.latlons
-        geodetic_info = self.messages.grid_details
-        grid_id = self.messages.grid_id
         out = {}
-        for i, (timestep, v) in enumerate(values.items()):
+        for timestep, grid_id, out_v in self.interpolator.interpolate_timesteps(values, self.messages, self.change_res_step):
             # note: timestep and change_res_step are instances of pyg2p.Step class
-            if self.messages.have_resolution_change() and timestep == self.change_res_step:
-                # Switching to second resolution
-                lats, longs = self.messages.latlons_2nd
-                geodetic_info = self.messages.grid_details.get_2nd_resolution()
-                grid_id = self.messages.grid2_id
-                is_second_res = True
-            out_v = self.interpolator.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res)
             if self.context.must_do_correction:
                 corrector = Corrector.get_instance(self.context, grid_id)
                 out_v = corrector.correct(out_v)
@@ -277,6 +277,26 @@ class IntertablesConfiguration(BaseConfiguration):
 
 
 class Configuration(pyg2p.Loggable):
+    instance = None
+    _instance_signature = None
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Configuration shared by all contexts of the same process (e.g. API calls or jobs of a daemon worker).
+        It's loaded again when files in the user configuration folder change (e.g. a new intertable was added).
+        """
+        if cls.instance is None or cls._user_files_signature() != cls._instance_signature:
+            cls.instance = Configuration()
+            # signature after loading: missing user configuration files are created at first load
+            cls._instance_signature = cls._user_files_signature()
+        return cls.instance
+
+    @staticmethod
+    def _user_files_signature():
+        config_dir = UserConfiguration.config_dir
+        return file_util.signature(*sorted(os.path.join(config_dir, f) for f in os.listdir(config_dir))) \
+            if file_util.exists(config_dir, is_folder=True) else None
 
     def __init__(self):
         super().__init__()
@@ -331,6 +351,33 @@ class Configuration(pyg2p.Loggable):
         self._log(f'=== Download finished: {remote_path}')
         client.quit()  # close FTP connection
 
+    def convert_intertables(self, layout):
+        # write a copy in the new layout of each intertable listed in configuration.
+        # Converted tables go next to the originals or in the user intertables folder if that is not writable
+        from .interpolation import Interpolator, intertable
+
+        converted = []
+        nnear = dict(Interpolator.scipy_modes_nnear, grib_nearest=1, grib_invdist=4)
+        for intertable_id, item in sorted(self.intertables.vars.items()):
+            if not isinstance(item, dict):
+                # description
+                continue
+            # details stored in header of compact intertables
+            meta = {'id': intertable_id, 'mode': item.get('method'), 'nnear': nnear.get(item.get('method')),
+                    'source_shape': item.get('source_shape'), 'target_shape': item.get('target_shape')}
+            for folder in (self.intertables.data_path, self.intertables.global_data_path):
+                tbl_fullpath = os.path.join(folder, item['filename']) if folder else None
+                if not tbl_fullpath or not intertable.exists(tbl_fullpath):
+                    continue
+                out_dir = folder if file_util.can_write(folder) else self.intertables.data_path
+                self._log(f'Converting {tbl_fullpath} to {layout} in {out_dir}', 'INFO')
+                try:
+                    converted.append(intertable.convert(tbl_fullpath, layout, out_dir=out_dir, meta=meta))
+                except OSError as e:
+                    self._log(f'Cannot convert {tbl_fullpath}: {e}', 'ERROR')
+                break
+        return converted
+
     def check_conf(self):
         # it logs all files in intertables and geopotentials paths that are not used in configuration
 
@@ -1,4 +1,5 @@
 import argparse
+import collections
 import ujson as json
 import os
 
@@ -7,11 +8,15 @@ from .. import __version__
 from ..util import files, strings
 from .manipulation.aggregator import ACCUMULATION
 from ..exceptions import (ApplicationException, INVALID_INTERPOL_METHOD,
-                          WRONG_ARGS, NOT_A_NUMBER, NOT_EXISTING_MAPS, MISSING_INPUT_GRIB, NOT_EXISTING_INPUT_GRIB)
+                          WRONG_ARGS, NOT_A_NUMBER, JSON_ERROR, NOT_EXISTING_MAPS, MISSING_INPUT_GRIB, NOT_EXISTING_INPUT_GRIB,
+                          MISSING_FORMULAS_IN_EXEC)
 
 
 class Context:
-    allowed_interp_methods = ('grib_nearest', 'grib_invdist', 'nearest', 'invdist', 'adw', 'cdd', 'bilinear', 'triangulation', 'bilinear_delaunay')
+    allowed_interp_methods = ('grib_nearest', 'grib_invdist', 'nearest', 'invdist', 'adw', 'cdd', 'bilinear', 'bilinear_rings',
+                              'triangulation', 'bilinear_delaunay')
+    # methods whose intertables can be created together (from the same KDTree search)
+    allowed_multi_mode_methods = ('nearest', 'invdist', 'adw', 'cdd', 'bilinear', 'bilinear_rings')
     default_values = {'interpolation.mode': 'grib_nearest', 'outMaps.unitTime': '24'}
 
     def __getitem__(self, param):
@@ -23,7 +28,7 @@ class Context:
     def __init__(self):
         # contains main configuration
         # (parameters, geopotentials, intertables, custom user paths, ftp to download test dataset, static data paths)
-        self.configuration = Configuration()
+        self.configuration = Configuration.get_instance()
         # init vars
         self.to_add_geopotential = False
         self.input_file_with_geopotential = None
@@ -36,6 +41,20 @@ class Context:
     def has_perturbation_number(self):
         return 'parameter.perturbationNumber' in self._vars and self._vars['parameter.perturbationNumber'] is not None
 
+    @property
+    def is_multi_member(self):
+        # list of perturbationNumber values (or 'all') to process in the same run
+        return bool(self._vars.get('parameter.members'))
+
+    def set_members(self, members):
+        # members is the output of strings.to_members: a single int, a list of ints or 'all'
+        if isinstance(members, int) or members is None:
+            self._vars['parameter.perturbationNumber'] = members
+            self._vars['parameter.members'] = None
+        else:
+            self._vars['parameter.perturbationNumber'] = None
+            self._vars['parameter.members'] = members
+
     def get(self, param, default=None):
         return self._vars.get(param, default)
 
@@ -46,6 +65,11 @@ class Context:
     def is_with_grib_interpolation(self):
         return self._vars['interpolation.mode'] in ('grib_invdist', 'grib_nearest')
 
+    @property
+    def targets(self):
+        # execution contexts of all target grids: this one and the ones of additional OutMaps blocks
+        return [self] + [TargetContext(self, params) for params in self._vars.get('outMaps.targets') or []]
+
     @property
     def must_do_aggregation(self):
         return self._vars['execution.doAggregation']
@@ -74,6 +98,10 @@ class Context:
     def to_check_conf(self):
         return self._vars.get('check_conf')
 
+    @property
+    def to_convert_intertables(self):
+        return self._vars.get('convert_intertables')
+
     def __str__(self):
         mess = f"\n\n============ pyg2p: Execution parameters: {self._vars.get('execution.name') or ''} {strings.now_string()} ============\n\n"
         params_str = [f'{par}={self._vars[par]}' for par in sorted(self._vars.keys()) if self._vars[par]]
@@ -86,7 +114,7 @@ class Context:
             if not files.exists(self._vars['geopotential']):
                 raise ApplicationException.get_exc(7001, self._vars['geopotential'])
 
-        else:
+        elif not (self.to_download_conf or self.to_check_conf or self.to_convert_intertables):
 
             if not self._vars.get('input.file'):
                 raise ApplicationException.get_exc(MISSING_INPUT_GRIB)
@@ -94,28 +122,44 @@ class Context:
             if not files.exists(self._vars['input.file']):
                 raise ApplicationException.get_exc(NOT_EXISTING_INPUT_GRIB, self._vars['input.file'])
 
-            if not files.exists(self._vars['interpolation.lonMap']) or not files.exists(self._vars['interpolation.latMap']):
+            for target in self.targets:
+                if not files.exists(target['interpolation.lonMap']) or not files.exists(target['interpolation.latMap']):
+                    raise ApplicationException.get_exc(
+                        NOT_EXISTING_MAPS,
+                        details=f"{target['interpolation.lonMap']} - {target['interpolation.latMap']}"
+                    )
+
+                if not files.exists(target['outMaps.clone']):
+                    raise ApplicationException.get_exc(1310)
+
+                if not target['interpolation.mode'] in self.allowed_interp_methods:
+                    raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD, details=target['interpolation.mode'])
+
+                if self._vars.get('interpolation.modes'):
+                    modes = [target['interpolation.mode']] + self._vars['interpolation.modes']
+                    not_allowed = [mode for mode in modes if mode not in self.allowed_multi_mode_methods]
+                    if not_allowed:
+                        raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD,
+                                                           details=f'{", ".join(not_allowed)} (tables of several methods are created only for {", ".join(self.allowed_multi_mode_methods)})')
+
+                # create out dir if not existing
+                try:
+                    if target['outMaps.outDir'] != './':
+                        if not target['outMaps.outDir'].endswith('/'):
+                            target['outMaps.outDir'] += '/'
+                        if not files.exists(target['outMaps.outDir'], is_folder=True):
+                            files.create_dir(target['outMaps.outDir'])
+                except Exception as exc:
+                    raise ApplicationException(exc, None, str(exc))
+
+            # targets must not write the same files
+            outputs = [(os.path.abspath(target['outMaps.outDir']), target.get('outMaps.namePrefix'), target.get('outMaps.format'))
+                       for target in self.targets]
+            if len(set(outputs)) < len(outputs):
                 raise ApplicationException.get_exc(
-                    NOT_EXISTING_MAPS,
-                    details=f"{self._vars['interpolation.lonMap']} - {self._vars['interpolation.latMap']}"
+                    JSON_ERROR, details='OutMaps blocks must differ in output folder, name prefix or format'
                 )
 
-            if not files.exists(self._vars['outMaps.clone']):
-                raise ApplicationException.get_exc(1310)
-
-            if not self._vars['interpolation.mode'] in self.allowed_interp_methods:
-                raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD, details=self._vars['interpolation.mode'])
-
-            # create out dir if not existing
-            try:
-                if self._vars['outMaps.outDir'] != './':
-                    if not self._vars['outMaps.outDir'].endswith('/'):
-                        self._vars['outMaps.outDir'] += '/'
-                    if not files.exists(self._vars['outMaps.outDir'], is_folder=True):
-                        files.create_dir(self._vars['outMaps.outDir'])
-            except Exception as exc:
-                raise ApplicationException(exc, None, str(exc))
-
             # check all numbers
 
             if self._vars['parameter.level'] and not self._vars['parameter.level'].isdigit():
@@ -133,8 +177,10 @@ class Context:
                     self._vars.get('correction.gemFormula') and self._vars.get('correction.demMap') and self._vars.get(
                     'correction.formula')):
                 raise ApplicationException.get_exc(4100)
-            if self._vars['execution.doCorrection'] and not files.exists(self._vars['correction.demMap']):
-                raise ApplicationException.get_exc(4200, self._vars['correction.demMap'])
+            if self._vars['execution.doCorrection']:
+                for target in self.targets:
+                    if not files.exists(target['correction.demMap']):
+                        raise ApplicationException.get_exc(4200, target['correction.demMap'])
 
     def geo_file(self, grid_id):
         path = self.input_file_with_geopotential
@@ -142,11 +188,13 @@ class Context:
             path = self.configuration.geopotentials.get_filepath(grid_id, additional=self._vars['geopotential.dirs'].get('user'))
         return path
 
-    def create_select_cmd_for_reader(self, start_, end_):
+    def reader_short_names(self):
         # 'var' suffix is for multiresolution 240 step message (global EUE files)
-        reader_args = {
-            'shortName': [self._vars['parameter.shortName'], self._vars['parameter.shortName'].upper(),
-                          self._vars['parameter.shortName'] + 'var']}
+        return [self._vars['parameter.shortName'], self._vars['parameter.shortName'].upper(),
+                self._vars['parameter.shortName'] + 'var']
+
+    def create_select_cmd_for_reader(self, start_, end_):
+        reader_args = {'shortName': self.reader_short_names()}
 
         if self._vars['parameter.level'] is not None:
             reader_args['level'] = self._vars['parameter.level']
@@ -175,6 +223,27 @@ class Context:
         return reader_arguments
 
 
+class TargetContext(Context):
+    """
+    Execution context of a target grid defined by an additional OutMaps block.
+    Its own parameters (target grid, interpolation, output name and format) overwrite the ones of the execution context
+    """
+
+    def __init__(self, ctx, params):
+        self._ctx = ctx
+        self.configuration = ctx.configuration
+        # parameters set on the execution context later (e.g. EPS member being processed) are seen by the target too
+        self._vars = collections.ChainMap(params, ctx._vars)
+
+    @property
+    def input_file_with_geopotential(self):
+        return self._ctx.input_file_with_geopotential
+
+    @property
+    def targets(self):
+        return [self]
+
+
 class ExecutionContext(Context):
 
     def __init__(self, argv):
@@ -225,6 +294,10 @@ class ExecutionContext(Context):
         self._vars['geopotential.dir'] = parsed_args['geopotentialDir']
         self._vars['interpolation.create'] = parsed_args['createIntertable']
         self._vars['interpolation.parallel'] = parsed_args['interpolationParallel']
+        self._vars['interpolation.max_memory'] = parsed_args['maxMemory']
+        self._vars['interpolation.modes'] = parsed_args['modes']
+        self._vars['input.decodeWorkers'] = parsed_args['decodeWorkers']
+        self._vars['input.indexNextToInput'] = parsed_args['indexNextToInput']
         self._vars['outMaps.fmap'] = parsed_args['fmap']
         self._vars['outMaps.format'] = parsed_args['format']
         self._vars['outMaps.ext'] = parsed_args['ext']
@@ -236,7 +309,7 @@ class ExecutionContext(Context):
         self._vars['outMaps.valueFormat'] = parsed_args['valueFormat']
         self._vars['outMaps.outputStepUnits'] = parsed_args['outputStepUnits']
         self._vars['outMaps.outDir'] = parsed_args['outDir']
-        self._vars['parameter.perturbationNumber'] = parsed_args['perturbationNumber']
+        self.set_members(parsed_args['perturbationNumber'])
         self._vars['input.file2'] = parsed_args['inputFile2']
         self._vars['input.two_resolution'] = bool(self._vars['input.file2'])
         self._vars['geopotential'] = parsed_args['addGeopotential']
@@ -244,13 +317,14 @@ class ExecutionContext(Context):
         self._vars['download_configuration'] = parsed_args['downloadConf']
         self._vars['under_api'] = parsed_args['underApi']
         self._vars['check_conf'] = parsed_args['checkConf']
+        self._vars['convert_intertables'] = parsed_args['convertIntertables']
         user_intertables = self._vars['interpolation.dir'] or self.configuration.default_interpol_dir
         user_geopotentials = self._vars['geopotential.dir'] or self.configuration.default_geopotential_dir
         self._vars['interpolation.dirs'] = {'global': self.configuration.intertables.global_data_path,
                                             'user': user_intertables}
         self._vars['geopotential.dirs'] = {'global': self.configuration.geopotentials.global_data_path,
                                            'user': user_geopotentials}
-        self.is_config_command = self.to_add_geopotential or self.to_download_conf or self.to_check_conf
+        self.is_config_command = self.to_add_geopotential or self.to_download_conf or self.to_check_conf or self.to_convert_intertables
 
     @staticmethod
     def add_args(parser):
@@ -266,7 +340,9 @@ class ExecutionContext(Context):
                             help='Grib timestep start. It overwrites the tstart in json execution file.', type=int)
         parser.add_argument('-e', '--end', help='Grib timestep end. It overwrites the tend in json execution file.',
                             type=int, metavar='tend')
-        parser.add_argument('-m', '--perturbationNumber', help='eps member number', type=int, metavar='eps_member')
+        parser.add_argument('-m', '--perturbationNumber', type=strings.to_members, metavar='eps_member',
+                            help='eps member number. It can also be a list (1,3,5), a range (1-50) or "all": '
+                                 'members are then processed in the same run and written in separate subfolders')
         parser.add_argument('-T', '--dataTime', help='To select messages by dataTime key value', type=int,
                             choices=[0, 1200], metavar='data_time')
         parser.add_argument('-D', '--dataDate', help='<YYYYMMDD> to select messages by dataDate key value',
@@ -299,9 +375,27 @@ class ExecutionContext(Context):
         parser.add_argument('-B', '--createIntertable', help='Flag to create intertable file',
                             action='store_true', default=False)
         parser.add_argument('-X', '--interpolationParallel',
-                            help='Use parallelization tools to make interpolation faster.'
+                            help='Use parallelization tools to make interpolation faster, '
+                                 'with the given number of workers (default: all CPUs). '
                                  'If -B option is not passed or intertable already exists'
                                  ' it does not have any effect.',
+                            nargs='?', const=True, type=int, default=False, metavar='workers')
+        parser.add_argument('-M', '--maxMemory',
+                            help='Memory budget for interpolation table creation (e.g. 16G). '
+                                 'Target points are interpolated in chunks fitting the budget and streamed '
+                                 'to the table file. It overwrites the @max_memory in json execution file.',
+                            type=strings.to_bytes, metavar='max_memory')
+        parser.add_argument('--modes',
+                            help='Comma separated scipy interpolation methods (nearest, invdist, adw, cdd, bilinear, bilinear_rings) '
+                                 'whose tables are created along with the one of the execution, from a single '
+                                 'search of neighbours (e.g. -B --modes nearest,invdist,adw).',
+                            type=strings.to_list, metavar='modes')
+
+        parser.add_argument('-j', '--decodeWorkers', help='Number of threads used to decode GRIB messages. '
+                                                          'It overwrites the decodeWorkers in json execution file.',
+                            type=int, metavar='decode_workers')
+        parser.add_argument('--indexNextToInput', help='Write the index of GRIB messages next to the input GRIB '
+                                                       '(default: in the user folder ~/.pyg2p/indexes).',
                             action='store_true', default=False)
 
         parser.add_argument('-g', '--addGeopotential', help='''Add the file to geopotentials.json configuration file, to use for correction.
@@ -310,6 +404,11 @@ class ExecutionContext(Context):
         parser.add_argument('-W', '--downloadConf',
                             help='Download intertables and geopotentials (FTP settings defined in ftp.json)',
                             metavar='dataset', choices=['geopotentials', 'intertables'])
+        parser.add_argument('-C', '--convertIntertables',
+                            help='Convert intertables listed in intertables.json to another layout '
+                                 '(mmap: uncompressed arrays, memory-mapped when loaded; '
+                                 'compact: narrow dtypes and chunked compression, decompressed in parallel)',
+                            metavar='layout', choices=['mmap', 'compact'])
         parser.add_argument('-A', '--underApi', help=argparse.SUPPRESS,
                             action='store_true', default=False)
         parser.add_argument('-K', '--checkConf', help=argparse.SUPPRESS,  # mostly used in development
@@ -335,6 +434,8 @@ class ExecutionContext(Context):
         exec_conf = u['Execution']
 
         self._vars['execution.name'] = exec_conf['@name']
+        if self._vars['input.decodeWorkers'] is None and exec_conf.get('@decodeWorkers'):
+            self._vars['input.decodeWorkers'] = int(exec_conf['@decodeWorkers'])
 
         self._vars['parameter.shortName'] = exec_conf['Parameter']['@shortName']
         parameter = self.configuration.parameters.get(self._vars['parameter.shortName'])
@@ -357,49 +458,56 @@ class ExecutionContext(Context):
             self._vars['correction.gemFormula'] = exec_conf['Parameter']['@gem']
             self._vars['correction.demMap'] = exec_conf['Parameter']['@demMap']
 
-        self._vars['outMaps.clone'] = exec_conf['OutMaps']['@cloneMap']
-        interpolation_conf = exec_conf['OutMaps']['Interpolation']
-        self._vars['interpolation.mode'] = interpolation_conf.get('@mode', self.default_values['interpolation.mode'])
-        self._vars['interpolation.cdd_map'] = interpolation_conf.get('@cdd_map', '')
-        self._vars['interpolation.cdd_mode'] = interpolation_conf.get('@cdd_mode', '')
-        self._vars['interpolation.cdd_options'] = interpolation_conf.get('@cdd_options', None)
-        self._vars['interpolation.use_broadcasting'] = interpolation_conf.get('@use_broadcasting', False)
-        self._vars['interpolation.num_of_splits'] = interpolation_conf.get('@num_of_splits', None)
-        self._vars['interpolation.rotated_target'] = interpolation_conf.get('@rotated_target', False)
+        out_maps = exec_conf['OutMaps']
+        if isinstance(out_maps, list):
+            # several target grids: the first OutMaps block defines the main target and all output attributes,
+            # the other blocks define additional targets written from the same values
+            out_maps, other_out_maps = out_maps[0], out_maps[1:]
+        else:
+            other_out_maps = []
+
+        self._vars.update(self._target_params(out_maps))
+        interpolation_conf = out_maps['Interpolation']
+        if self._vars['interpolation.max_memory'] is None and interpolation_conf.get('@max_memory'):
+            self._vars['interpolation.max_memory'] = strings.to_bytes(interpolation_conf['@max_memory'])
         if not self._vars['interpolation.dir'] and interpolation_conf.get('@intertableDir'):
             # get from JSON
             self._vars['interpolation.dirs']['user'] = interpolation_conf['@intertableDir']
         if not self._vars['geopotential.dir'] and interpolation_conf.get('@geopotentialDir'):
             # get from JSON
             self._vars['geopotential.dirs']['user'] = interpolation_conf['@geopotentialDir']
-        self._vars['interpolation.latMap'] = interpolation_conf['@latMap']
-        self._vars['interpolation.lonMap'] = interpolation_conf['@lonMap']
 
-        self._vars['outMaps.unitTime'] = exec_conf['OutMaps'].get('@unitTime')
+        self._vars['outMaps.unitTime'] = out_maps.get('@unitTime')
+
+        # additional targets take output name and format from command line too, if given
+        self._vars['outMaps.targets'] = [
+            self._additional_target_params(other, exec_conf['Parameter']['@shortName']) for other in other_out_maps
+        ]
+        self._vars['outMaps.targetWorkers'] = int(exec_conf.get('@targetWorkers') or 1)
 
         # optional parameters (can also be defined by command line)
         if not self._vars['outMaps.namePrefix']:
-            self._vars['outMaps.namePrefix'] = exec_conf['OutMaps'].get('@namePrefix') or exec_conf['Parameter'][
+            self._vars['outMaps.namePrefix'] = out_maps.get('@namePrefix') or exec_conf['Parameter'][
                 '@shortName']
         if self._vars['outMaps.scaleFactor'] is None:
-            self._vars['outMaps.scaleFactor'] = exec_conf['OutMaps'].get('@scaleFactor') or 1.0
+            self._vars['outMaps.scaleFactor'] = out_maps.get('@scaleFactor') or 1.0
         if self._vars['outMaps.offset'] is None:
-            self._vars['outMaps.offset'] = exec_conf['OutMaps'].get('@offset') or 0.0
+            self._vars['outMaps.offset'] = out_maps.get('@offset') or 0.0
         if self._vars['outMaps.validMin'] is None:
-            self._vars['outMaps.validMin'] = exec_conf['OutMaps'].get('@validMin')
+            self._vars['outMaps.validMin'] = out_maps.get('@validMin')
         if self._vars['outMaps.validMax'] is None:
-            self._vars['outMaps.validMax'] = exec_conf['OutMaps'].get('@validMax')
+            self._vars['outMaps.validMax'] = out_maps.get('@validMax')
         if self._vars['outMaps.valueFormat'] is None:
-            self._vars['outMaps.valueFormat'] = exec_conf['OutMaps'].get('@valueFormat')
+            self._vars['outMaps.valueFormat'] = out_maps.get('@valueFormat')
         if self._vars['outMaps.outputStepUnits'] is None:
-            self._vars['outMaps.outputStepUnits'] = exec_conf['OutMaps'].get('@outputStepUnits')
+            self._vars['outMaps.outputStepUnits'] = out_maps.get('@outputStepUnits')
         if self._vars['outMaps.fmap'] == 1:
-            self._vars['outMaps.fmap'] = exec_conf['OutMaps'].get('@fmap') or 1
+            self._vars['outMaps.fmap'] = out_maps.get('@fmap') or 1
         if self._vars['outMaps.ext'] == 1:
-            self._vars['outMaps.ext'] = exec_conf['OutMaps'].get('@ext') or 1
+            self._vars['outMaps.ext'] = out_maps.get('@ext') or 1
         if self._vars['outMaps.format'] == 'notset':
             # default out format to pcraster if not set from commandline nor in execution command json
-            self._vars['outMaps.format'] = exec_conf['OutMaps'].get('@format') or 'pcraster'
+            self._vars['outMaps.format'] = out_maps.get('@format') or 'pcraster'
 
         # if start, end and dataTime are defined via command line input args, these are ignored.
         # if missing, GribReader will read all timesteps for the parameter
@@ -425,4 +533,38 @@ class ExecutionContext(Context):
                 and exec_conf['Aggregation'].get('@forceZeroArray', 'False').lower() not in strings.FALSE_STRINGS
 
         # string interpolation for custom user configurations (i.e. dataset folders)
-        self.configuration.user.interpolate_strings(self)
+        for target in self.targets:
+            self.configuration.user.interpolate_strings(target)
+
+    def _target_params(self, out_maps):
+        # target grid and interpolation parameters of an OutMaps block
+        interpolation_conf = out_maps['Interpolation']
+        return {
+            'outMaps.clone': out_maps['@cloneMap'],
+            'interpolation.mode': interpolation_conf.get('@mode', self.default_values['interpolation.mode']),
+            'interpolation.cdd_map': interpolation_conf.get('@cdd_map', ''),
+            'interpolation.cdd_mode': interpolation_conf.get('@cdd_mode', ''),
+            'interpolation.cdd_options': interpolation_conf.get('@cdd_options', None),
+            'interpolation.use_broadcasting': interpolation_conf.get('@use_broadcasting', False),
+            'interpolation.num_of_splits': interpolation_conf.get('@num_of_splits', None),
+            'interpolation.rotated_target': interpolation_conf.get('@rotated_target', False),
+            'interpolation.latMap': interpolation_conf['@latMap'],
+            'interpolation.lonMap': interpolation_conf['@lonMap'],
+        }
+
+    def _additional_target_params(self, out_maps, short_name):
+        # an additional target also has its own output name, format and folder (relative to the output one)
+        # and its own DEM for correction (mandatory if values are corrected). Other attributes (unitTime, fmap, scaleFactor...) are the ones of the first block
+        params = self._target_params(out_maps)
+        params['outMaps.namePrefix'] = self._vars['outMaps.namePrefix'] or out_maps.get('@namePrefix') or short_name
+        params['outMaps.format'] = self._vars['outMaps.format'] if self._vars['outMaps.format'] != 'notset' \
+            else out_maps.get('@format') or 'pcraster'
+        if out_maps.get('@outDir'):
+            params['outMaps.outDir'] = os.path.join(self._vars['outMaps.outDir'], out_maps['@outDir'])
+        if self._vars['execution.doCorrection']:
+            # the DEM of the first block is on another grid
+            if not out_maps.get('@demMap'):
+                raise ApplicationException.get_exc(MISSING_FORMULAS_IN_EXEC,
+                                                   details='OutMaps blocks of other targets need their own demMap attribute')
+            params['correction.demMap'] = out_maps['@demMap']
+        return params
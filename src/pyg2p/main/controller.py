@@ -1,6 +1,8 @@
 import collections
+from concurrent.futures import ThreadPoolExecutor
 
-from .. import Loggable
+from .. import Loggable, LazyValues
+from ..exceptions import ApplicationException, NO_MESSAGES
 from ..main.manipulation.aggregator import Aggregator
 from ..main.readers.grib import GRIBReader
 from ..main.writers import OutputWriter
@@ -17,7 +19,8 @@ class Controller(Loggable):
         # GRIB reader for second spatial resolution file
         self.grib_reader2 = None
         self._firstMap = True
-        self._writer = None
+        # one writer (interpolator, target grid) for each OutMaps block
+        self._writers = []
 
     def log_execution_context(self):
         self._log(f'[!] Intertables user path as defined in {self.ctx.configuration.user.intertables_path_var}: {self.ctx.configuration.user.geopotentials_path}', 'INFO')
@@ -31,9 +34,14 @@ class Controller(Loggable):
 
     def init_execution(self):
         aggregator = None
-        self.grib_reader = GRIBReader(self.ctx.get('input.file'), w_perturb=self.ctx.has_perturbation_number)
+        if not self.grib_reader:
+            self.grib_reader = GRIBReader(self.ctx.get('input.file'), w_perturb=self.ctx.has_perturbation_number,
+                                          decode_workers=self.ctx.get('input.decodeWorkers'),
+                                          index_next_to_input=self.ctx.get('input.indexNextToInput'))
         grib_info = self.grib_reader.get_grib_info(self.ctx.create_select_cmd_for_aggregation_attrs())
-        self._writer = OutputWriter(self.ctx, grib_info)
+        if not self._writers:
+            # interpolators, intertables and target grids are shared among all members
+            self._writers = [OutputWriter(target, grib_info) for target in self.ctx.targets]
 
         # read grib messages
         start_step = self.ctx.get('parameter.tstart') or 0
@@ -75,12 +83,43 @@ class Controller(Loggable):
 
     def read_2nd_res_messages(self, cmd_args, messages):
         # append messages
-        self.grib_reader2 = GRIBReader(self.ctx.get('input.file2'), w_perturb=self.ctx.has_perturbation_number)
+        if not self.grib_reader2:
+            self.grib_reader2 = GRIBReader(self.ctx.get('input.file2'), w_perturb=self.ctx.has_perturbation_number,
+                                           decode_workers=self.ctx.get('input.decodeWorkers'),
+                                          index_next_to_input=self.ctx.get('input.indexNextToInput'))
         # messages.change_resolution() returns True after Messages.append_2nd_res_messages()
         mess_2nd_res = self.grib_reader2.select_messages(**cmd_args)
         messages.append_2nd_res_messages(mess_2nd_res)
 
+    def members(self):
+        members = self.ctx.get('parameter.members')
+        if members == 'all':
+            if not self.grib_reader:
+                self.grib_reader = GRIBReader(self.ctx.get('input.file'), decode_workers=self.ctx.get('input.decodeWorkers'),
+                                          index_next_to_input=self.ctx.get('input.indexNextToInput'))
+            headers = self.grib_reader.scan_grib(shortName=self.ctx.reader_short_names())
+            members = sorted({h['perturbationNumber'] for h in headers if h.get('perturbationNumber') is not None})
+            if not members:
+                raise ApplicationException.get_exc(NO_MESSAGES, details=f"no EPS members of {self.ctx.reader_short_names()} in {self.ctx.get('input.file')}")
+        return members
+
     def execute(self, write_results=True):
+        if not self.ctx.is_multi_member:
+            return self.execute_member(write_results)
+        # all members are processed with the same GRIB reader, intertables, correction and output grid
+        results = {}
+        members = self.members()
+        self._log(f'Processing {len(members)} EPS members: {members}', 'INFO')
+        for member in members:
+            self._log(f'******** **** EPS MEMBER {member} **** *************', 'INFO')
+            self.ctx['parameter.perturbationNumber'] = member
+            result = self.execute_member(write_results)
+            if not write_results:
+                # values are kept only when they are not written out
+                results[member] = result
+        return results
+
+    def execute_member(self, write_results=True):
         converter = None
         grib_info, grib_select_cmd, end_step, aggregator = self.init_execution()
         mv_grib = grib_info.mv
@@ -97,10 +136,11 @@ class Controller(Loggable):
         # Grib lats/lons are used for interpolation methods nearest, invdist.
         # Not for grib_nearest and grib_invdist
         aux_g, aux_v, aux_g2, aux_v2 = self.grib_reader.get_gids_for_grib_intertable()
-        if self.ctx.is_with_grib_interpolation:
-            # these "aux" values are used by grib interpolation methods to create tables on disk
-            # aux (gid and its values array) are read by GRIBReader which uses the first message selected
-            self._writer.aux_for_intertable_generation(aux_g, aux_v, aux_g2, aux_v2)
+        for writer in self._writers:
+            if writer.ctx.is_with_grib_interpolation:
+                # these "aux" values are used by grib interpolation methods to create tables on disk
+                # aux (gid and its values array) are read by GRIBReader which uses the first message selected
+                writer.aux_for_intertable_generation(aux_g, aux_v, aux_g2, aux_v2)
 
         # Conversion
         if self.ctx.must_do_conversion:
@@ -130,13 +170,39 @@ class Controller(Loggable):
         # cutoff after interpolation
         if converter and converter.must_cut_off:
             values = converter.cut_off_negative(values)
-        values = collections.OrderedDict(sorted(values.items(), key=lambda k: int(k[0].end_step)))
+        ordered_steps = sorted(values.keys(), key=lambda k: int(k.end_step))
+        if isinstance(values, LazyValues):
+            # keep values lazy: they are decoded one by one while writing maps
+            values = values.reorder(ordered_steps)
+        else:
+            values = collections.OrderedDict((step, values[step]) for step in ordered_steps)
         if write_results:
             self._log('******** **** WRITING OUT MAPS (Interpolation, correction) **** *************')
-            self._writer.write_maps(values, messages, change_res_step=change_res_step)
+            self.write_maps(values, messages, change_res_step)
         # ! return non interpolated values
         return values, messages, change_res_step
 
+    def write_maps(self, values, messages, change_res_step):
+        if len(self._writers) == 1:
+            self._writers[0].write_maps(values, messages, change_res_step=change_res_step)
+            return
+        if isinstance(values, LazyValues):
+            # GRIB messages are decoded once for all targets
+            values = collections.OrderedDict(values.items())
+        workers = self.ctx.get('outMaps.targetWorkers') or 1
+        if workers > 1 and not self.ctx.get('interpolation.create'):
+            # targets are interpolated in parallel only with existing intertables:
+            # their creation uses its own parallelism and updates the intertables configuration
+            self._log(f'Writing {len(self._writers)} targets with {workers} workers', 'INFO')
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(writer.write_maps, values, messages, change_res_step=change_res_step)
+                           for writer in self._writers]
+                for future in futures:
+                    future.result()
+        else:
+            for writer in self._writers:
+                writer.write_maps(values, messages, change_res_step=change_res_step)
+
     def close(self):
         if self.grib_reader:
             self.grib_reader.close()
@@ -144,5 +210,5 @@ class Controller(Loggable):
         if self.grib_reader2:
             self.grib_reader2.close()
             self.grib_reader2 = None
-        if self._writer:
-            self._writer.close()
+        for writer in self._writers:
+            writer.close()
@@ -0,0 +1,357 @@
+"""
+Daemon mode: a long-running pyg2p process executing jobs with a bounded pool of warm worker processes.
+
+Worker processes keep libraries imported and keep configuration, intertables, target grids, clone maps
+and correction maps (DEM and geopotentials) loaded between jobs, so that a job only pays for its own computation.
+Those caches are never emptied: a worker is replaced by a new one after max_jobs_per_worker jobs
+(with Python < 3.11, all workers are replaced together after workers * max_jobs_per_worker jobs).
+If a worker dies (e.g. segfault or OOM killer), the pool is broken: its jobs fail and a new pool runs the next jobs.
+
+A job is a pyg2p command line, optionally with parameters to interpolate as in pyg2p.main.api.Command
+(e.g. "pyg2p -c {cmd} -i {input} -o {out}" with params {"cmd": ..., "input": ..., "out": ...}).
+Jobs are submitted:
+    * to a UNIX socket, with one JSON request per line. Each request gets a one line JSON reply:
+        {"action": "submit", "command": "...", "params": {...}} -> {"job": "<id>", "status": "queued"}
+        {"action": "status", "job": "<id>"} -> status of the job (all jobs if "job" is not given)
+        {"action": "shutdown"} -> stops the daemon once running jobs are completed
+    * to a spool folder, as <name>.job files with the command line (or a JSON object with "command" and "params").
+      The job id is <name> and its status is written in <name>.status (JSON).
+Completed jobs of the spool folder are forgotten once their status file is written. The daemon keeps
+the status of the last keep_finished completed jobs of the socket.
+
+Usage: pyg2p-daemon --socket /tmp/pyg2p.sock --spool /data/pyg2p_spool --workers 4
+"""
+import argparse
+import collections
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pyg2p import Loggable
+import pyg2p.util.files
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+JOB_EXT = '.job'
+TAKEN_EXT = '.taken'
+STATUS_EXT = '.status'
+
+
+# queue where workers put (job id, start time) when they start a job
+_started = None
+
+
+def _warm_up(started):
+    # workers import pyg2p (eccodes, GDAL, netCDF4, scipy, numba...) once, before their first job
+    global _started
+    _started = started
+    import pyg2p.main.api  # noqa: F401
+
+
+def _run_job(job_id, command, params):
+    from pyg2p.main.api import Command
+    start = time.time()
+    _started.put((job_id, start))
+    return_code = Command(command, **params).run()
+    return return_code, start, time.time()
+
+
+class Job:
+
+    def __init__(self, job_id, command, params=None):
+        self.id = job_id
+        self.command = command
+        self.params = params or {}
+        self.submitted = time.time()
+        # set when a worker starts the job (future.running() is also True for jobs waiting in the pool call queue)
+        self.started = None
+        self.future = None
+
+    @property
+    def status(self):
+        if self.future is None or not (self.started or self.future.done()):
+            return QUEUED
+        if not self.future.done():
+            return RUNNING
+        if self.future.cancelled() or self.future.exception() is not None:
+            return FAILED
+        return_code, _, _ = self.future.result()
+        return DONE if return_code == 0 else FAILED
+
+    def to_dict(self):
+        res = {'job': self.id, 'command': self.command, 'params': self.params,
+               'status': self.status, 'submitted': self.submitted}
+        if self.future is not None and self.future.done() and not self.future.cancelled():
+            if self.future.exception() is not None:
+                res['error'] = str(self.future.exception())
+            else:
+                return_code, start, end = self.future.result()
+                res.update({'return_code': return_code, 'started': start, 'finished': end, 'elapsed': end - start})
+        return res
+
+
+class Daemon(Loggable):
+
+    def __init__(self, workers=None, socket_path=None, spool_dir=None, poll_interval=1., max_jobs_per_worker=None,
+                 keep_finished=1000):
+        super().__init__()
+        self.workers = workers or os.cpu_count()
+        self.socket_path = socket_path
+        self.spool_dir = spool_dir
+        self.poll_interval = poll_interval
+        self.keep_finished = keep_finished
+        self.max_jobs_per_worker = max_jobs_per_worker
+        # jobs not completed yet
+        self.jobs = {}
+        # status of the last completed jobs submitted to the socket
+        self._finished = collections.OrderedDict()
+        # ids of jobs taken from the spool folder whose final status is not written yet
+        self._spooled = set()
+        # guards jobs, _finished, _spooled and status files. Reentrant: a job done before submit returns
+        # runs its callback in the submitting thread
+        self._lock = threading.RLock()
+        self._ids = itertools.count(1)
+        self._stopped = threading.Event()
+        self._server = None
+        # workers are started from a clean server process: the daemon itself runs threads (socket, spool)
+        self._mp_context = multiprocessing.get_context('forkserver')
+        self._mp_context.set_forkserver_preload(['pyg2p.main.api'])
+        self._started = self._mp_context.SimpleQueue()
+        # jobs submitted to the current pool (with Python < 3.11, the pool is replaced to recycle its workers)
+        self._pool_jobs = 0
+        self._pool = self._new_pool()
+        self._started_thread = threading.Thread(target=self._track_started, daemon=True)
+        self._started_thread.start()
+
+    def _new_pool(self):
+        recycle = {}
+        if self.max_jobs_per_worker and sys.version_info >= (3, 11):
+            recycle['max_tasks_per_child'] = self.max_jobs_per_worker
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=self._mp_context, initializer=_warm_up,
+                                   initargs=(self._started,), **recycle)
+
+    def _replace_pool(self, pool):
+        # called with self._lock held. Jobs already submitted to the old pool are completed before its workers exit
+        if pool is not self._pool:
+            # already replaced
+            return
+        self._pool = self._new_pool()
+        self._pool_jobs = 0
+        pool.shutdown(wait=False)
+
+    def submit(self, command, params=None, job_id=None):
+        job = Job(job_id or f'{next(self._ids):06d}', command, params)
+        with self._lock:
+            self.jobs[job.id] = job
+            if self.max_jobs_per_worker and sys.version_info < (3, 11) and self._pool_jobs >= self.workers * self.max_jobs_per_worker:
+                self._log('Replacing workers', 'INFO')
+                self._replace_pool(self._pool)
+            pool = self._pool
+            try:
+                job.future = pool.submit(_run_job, job.id, command, job.params)
+                self._pool_jobs += 1
+            except BrokenProcessPool as err:
+                # a worker died: the job fails and the next ones run in a new pool
+                self._log(f'Workers pool is broken, starting new workers: {err}', 'ERROR')
+                self._replace_pool(pool)
+                job.future = Future()
+                job.future.set_exception(err)
+        job.future.add_done_callback(lambda _: self._job_done(job, pool))
+        self._log(f'Job {job.id} submitted: {command}', 'INFO')
+        return job
+
+    def _track_started(self):
+        while True:
+            started = self._started.get()
+            if started is None:
+                return
+            job_id, start = started
+            with self._lock:
+                if job_id in self.jobs:
+                    self.jobs[job_id].started = start
+
+    def _job_done(self, job, pool):
+        info = job.to_dict()
+        self._log(f"Job {job.id} {info['status']} {info.get('error', '')}".strip(), 'INFO' if info['status'] == DONE else 'ERROR')
+        with self._lock:
+            if not job.future.cancelled() and isinstance(job.future.exception(), BrokenProcessPool):
+                # a worker of the pool died, e.g. killed by the OOM killer: next jobs run in a new pool
+                self._replace_pool(pool)
+            self.jobs.pop(job.id, None)
+            if job.id in self._spooled:
+                # the status file is the only record of spool jobs
+                self._write_status(job.id, info)
+                pyg2p.util.files.delete_file(os.path.join(self.spool_dir, job.id + TAKEN_EXT))
+                self._spooled.discard(job.id)
+                return
+            self._finished[job.id] = info
+            while len(self._finished) > self.keep_finished:
+                self._finished.popitem(last=False)
+
+    def status(self, job_id=None):
+        with self._lock:
+            if job_id is None:
+                return {'jobs': list(self._finished.values()) + [job.to_dict() for job in self.jobs.values()]}
+            if job_id in self.jobs:
+                return self.jobs[job_id].to_dict()
+            if job_id in self._finished:
+                return self._finished[job_id]
+            return {'job': job_id, 'error': 'unknown job'}
+
+    # ####### SPOOL FOLDER ###################################
+    def _write_status(self, job_id, status):
+        # called with self._lock held
+        status_file = os.path.join(self.spool_dir, job_id + STATUS_EXT)
+        tmp_file = f'{status_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(status, f)
+        os.replace(tmp_file, status_file)
+
+    def _poll_spool(self):
+        while not self._stopped.is_set():
+            for filename in sorted(os.listdir(self.spool_dir)):
+                if not filename.endswith(JOB_EXT):
+                    continue
+                job_id = filename[:-len(JOB_EXT)]
+                taken = os.path.join(self.spool_dir, job_id + TAKEN_EXT)
+                try:
+                    # renaming is atomic: a job file is taken by one daemon only
+                    os.rename(os.path.join(self.spool_dir, filename), taken)
+                except OSError:
+                    continue
+                with open(taken) as f:
+                    content = f.read().strip()
+                try:
+                    job_request = json.loads(content) if content.startswith('{') else {'command': content}
+                    command, params = job_request['command'], job_request.get('params')
+                except (ValueError, KeyError) as err:
+                    self._log(f'Invalid job file {filename}: {err}', 'ERROR')
+                    with self._lock:
+                        self._write_status(job_id, {'job': job_id, 'status': FAILED, 'error': f'Invalid job file: {err}'})
+                    pyg2p.util.files.delete_file(taken)
+                    continue
+                with self._lock:
+                    self._spooled.add(job_id)
+                    job = self.submit(command, params, job_id=job_id)
+                    if job_id in self._spooled:
+                        # not completed yet
+                        self._write_status(job.id, job.to_dict())
+            with self._lock:
+                for job_id in self._spooled:
+                    # update status of jobs started since last poll
+                    job = self.jobs.get(job_id)
+                    if job is not None and job.status == RUNNING:
+                        self._write_status(job.id, job.to_dict())
+            self._stopped.wait(self.poll_interval)
+
+    # ####### UNIX SOCKET ###################################
+    def handle_request(self, request):
+        action = request.get('action')
+        if action == 'submit':
+            job = self.submit(request['command'], request.get('params'))
+            return {'job': job.id, 'status': job.status}
+        elif action == 'status':
+            return self.status(request.get('job'))
+        elif action == 'shutdown':
+            threading.Thread(target=self.shutdown).start()
+            return {'status': 'shutting down'}
+        return {'error': f'unknown action {action}'}
+
+    def _make_server(self):
+        daemon = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        reply = daemon.handle_request(json.loads(line))
+                    except Exception as err:
+                        reply = {'error': str(err)}
+                    self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        return socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+
+    def serve_forever(self):
+        threads = []
+        if self.spool_dir:
+            pyg2p.util.files.create_dir(self.spool_dir)
+            threads.append(threading.Thread(target=self._poll_spool, daemon=True))
+        if self.socket_path:
+            self._server = self._make_server()
+            threads.append(threading.Thread(target=self._server.serve_forever, daemon=True))
+        for thread in threads:
+            thread.start()
+        self._log(f'pyg2p daemon started with {self.workers} workers '
+                  f'(socket: {self.socket_path}, spool: {self.spool_dir})', 'INFO')
+        try:
+            while not self._stopped.wait(self.poll_interval):
+                pass
+        except KeyboardInterrupt:
+            self.shutdown()
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            pyg2p.util.files.delete_file(self.socket_path)
+        self._pool.shutdown(wait=True)
+        self._started.put(None)
+        self._started_thread.join()
+        self._log('pyg2p daemon stopped', 'INFO')
+
+
+def request(socket_path, request_):
+    """Send a request to a running daemon and return its reply"""
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        with s.makefile('rwb') as f:
+            f.write(json.dumps(request_).encode() + b'\n')
+            f.flush()
+            return json.loads(f.readline())
+
+
+def submit(socket_path, command, **params):
+    return request(socket_path, {'action': 'submit', 'command': str(command), 'params': params})
+
+
+def job_status(socket_path, job_id=None):
+    return request(socket_path, {'action': 'status', 'job': job_id})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run pyg2p jobs with warm worker processes')
+    parser.add_argument('-s', '--socket', help='Path of the UNIX socket to listen to')
+    parser.add_argument('-p', '--spool', help='Spool folder to poll for *.job files')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-t', '--poll', type=float, default=1., help='Seconds between spool folder polls')
+    parser.add_argument('-m', '--maxJobsPerWorker', type=int, default=100,
+                        help='Replace a worker after this number of jobs, releasing its cached maps and intertables '
+                             '(default: 100, 0 to keep workers)')
+    parser.add_argument('-k', '--keepFinished', type=int, default=1000,
+                        help='Number of completed socket jobs whose status is kept (default: 1000)')
+    parser.add_argument('-l', '--loggerLevel', default='INFO', help='Log level of the daemon')
+    args = parser.parse_args(argv)
+    if not args.socket and not args.spool:
+        parser.error('at least one of --socket and --spool is required')
+    logging.basicConfig(format='[%(asctime)s][%(name)s] : %(levelname)s %(message)s')
+    logging.getLogger().setLevel(args.loggerLevel)
+    Daemon(workers=args.workers, socket_path=args.socket, spool_dir=args.spool, poll_interval=args.poll,
+           max_jobs_per_worker=args.maxJobsPerWorker, keep_finished=args.keepFinished).serve_forever()
+    return 0
@@ -1,4 +1,3 @@
-import gzip
 import os
 import logging
 from functools import partial
@@ -7,8 +6,11 @@ import numpy as np
 import numpy.ma as ma
 from pyg2p import Loggable
 
-from . import grib_interpolation_lib
+from . import grib_interpolation_lib, intertable
+from .checkpoint import Checkpoint, CHECKPOINTS_DIR
+from .geometry import SourceGeometry
 from .latlong import LatLong
+from .sparse import SparseOperator
 from .scipy_interpolation_lib import ScipyInterpolation, DEBUG_BILINEAR_INTERPOLATION, DEBUG_ADW_INTERPOLATION, \
                                         DEBUG_MIN_LAT, DEBUG_MIN_LON, DEBUG_MAX_LAT, DEBUG_MAX_LON
                                         
@@ -19,12 +21,22 @@ import pyg2p.util.numeric
 
 class Interpolator(Loggable):
     _LOADED_INTERTABLES = {}
+    _LOADED_OPERATORS = {}
     _prefix = 'I'
-    scipy_modes_nnear = {'nearest': 1, 'invdist': 4, 'adw': 11, 'cdd': 11, 'bilinear': 4, 'triangulation': 3, 'bilinear_delaunay': 4}
+    scipy_modes_nnear = {'nearest': 1, 'invdist': 4, 'adw': 11, 'cdd': 11, 'bilinear': 4, 'bilinear_rings': 4,
+                         'triangulation': 3, 'bilinear_delaunay': 4}
     suffixes = {'grib_nearest': 'grib_nearest', 'grib_invdist': 'grib_invdist',
                 'nearest': 'scipy_nearest', 'invdist': 'scipy_invdist', 'adw': 'scipy_adw', 'cdd': 'scipy_cdd',
-                'bilinear': 'scipy_bilinear', 'triangulation': 'scipy_triangulation', 'bilinear_delaunay': 'scipy_bilinear_delaunay'}
+                'bilinear': 'scipy_bilinear', 'bilinear_rings': 'scipy_bilinear_rings',
+                'triangulation': 'scipy_triangulation', 'bilinear_delaunay': 'scipy_bilinear_delaunay'}
     _format_intertable = 'tbl{prognum}_{source_file}_{target_size}_{suffix}.npy.gz'.format
+    # max number of values (source and target points of all timesteps) of a block interpolated with one sparse product
+    max_block_values = 1 << 25
+    # modes whose intertables can be derived from the one of an overlapping target grid (see _parent_intertable).
+    # Not adw: its weights depend on a reference radius computed on the whole target grid
+    derived_modes = ('nearest', 'invdist', 'bilinear', 'bilinear_rings')
+    # min fraction of target cells found in the parent intertable
+    min_derived_overlap = 0.5
 
     def __init__(self, exec_ctx, mv_input):
         super().__init__()
@@ -36,11 +48,16 @@ class Interpolator(Loggable):
         self._cdd_options = exec_ctx.get('interpolation.cdd_options')
         self._use_broadcasting = exec_ctx.get('interpolation.use_broadcasting')
         self._num_of_splits = exec_ctx.get('interpolation.num_of_splits')
+        self._max_memory = exec_ctx.get('interpolation.max_memory')
+        # other scipy modes whose intertables are created along with the one of mode, from the same neighbours search
+        self._modes = [mode for mode in exec_ctx.get('interpolation.modes') or [] if mode != self._mode]
         self._source_filename = pyg2p.util.files.filename(exec_ctx.get('input.file'))
         self._suffix = self.suffixes[self._mode]
         self._intertable_dirs = exec_ctx.get('interpolation.dirs')
         self._rotated_target_grid = exec_ctx.get('interpolation.rotated_target')
         self._target_coords = LatLong(exec_ctx.get('interpolation.latMap'), exec_ctx.get('interpolation.lonMap'))
+        # target maps are recorded in intertables configuration, to derive intertables of overlapping targets
+        self._target_maps = [os.path.abspath(exec_ctx.get('interpolation.latMap')), os.path.abspath(exec_ctx.get('interpolation.lonMap'))]
         self.mv_out = self._target_coords.mv
         self.parallel = exec_ctx.get('interpolation.parallel')
         self.format_intertablename = partial(self._format_intertable,
@@ -65,18 +82,69 @@ class Interpolator(Loggable):
             out_v = self.interpolate_scipy(lats, longs, v, grid_id, geodetic_info)
         return out_v
 
-    def _intertable_filename(self, grid_id):
-        intertable_id = '{}{}_{}{}'.format(self._prefix, grid_id.replace('$', '_'), self._target_coords.identifier, self._suffix)
+    def interpolate_timesteps(self, values, messages, change_res_step=None):
+        """
+        Interpolate values of all timesteps. Consecutive timesteps on the same grid are interpolated in blocks,
+        with a single sparse product per block.
+        :param values: mapping of timesteps (pyg2p.Step instances) to values, in writing order
+        Yield (timestep, grid_id, interpolated values)
+        """
+        is_second_res = False
+        # source coordinates are only needed to create scipy intertables: they're read from grid details then
+        lats, longs = None, None
+        geodetic_info = messages.grid_details
+        grid_id = messages.grid_id
+        block = []
+        for timestep, v in values.items():
+            if messages.have_resolution_change() and timestep == change_res_step:
+                # Switching to second resolution
+                yield from self._interpolate_block(block, lats, longs, grid_id, geodetic_info, is_second_res)
+                block = []
+                geodetic_info = messages.grid_details.get_2nd_resolution()
+                grid_id = messages.grid2_id
+                is_second_res = True
+            block.append((timestep, v))
+            if len(block) * (v.size + self._target_coords.lats.size) >= self.max_block_values:
+                yield from self._interpolate_block(block, lats, longs, grid_id, geodetic_info, is_second_res)
+                block = []
+        yield from self._interpolate_block(block, lats, longs, grid_id, geodetic_info, is_second_res)
+
+    def _interpolate_block(self, block, lats, longs, grid_id, geodetic_info, is_second_res):
+        timesteps = [timestep for timestep, _ in block]
+        values = [v for _, v in block]
+        for timestep, out_v in zip(timesteps, self.interpolate_values(lats, longs, values, grid_id, geodetic_info, is_second_res=is_second_res)):
+            yield timestep, grid_id, out_v
+
+    def interpolate_values(self, lats, longs, values, grid_id, geodetic_info, is_second_res=False):
+        """
+        Interpolate a list of values arrays on the same source grid.
+        Return the list of interpolated arrays
+        """
+        if not values:
+            return []
+        if DEBUG_BILINEAR_INTERPOLATION or DEBUG_ADW_INTERPOLATION:
+            return [self.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res) for v in values]
+        _, intertable_name = self._intertable_filename(grid_id)
+        if not intertable.exists(intertable_name) or self._missing_intertables(grid_id):
+            # first interpolation creates the intertable (and the missing ones of other modes)
+            first = self.interpolate(lats, longs, values[0], grid_id, geodetic_info, is_second_res=is_second_res)
+            return [first] + self.interpolate_values(lats, longs, values[1:], grid_id, geodetic_info, is_second_res=is_second_res)
+        return self._apply_operator(intertable_name, values, self._target_coords.lons.shape)
+
+    def _intertable_filename(self, grid_id, mode=None):
+        # mode is the one of the execution if not given
+        suffix = self.suffixes[mode] if mode else self._suffix
+        intertable_id = '{}{}_{}{}'.format(self._prefix, grid_id.replace('$', '_'), self._target_coords.identifier, suffix)
         if intertable_id not in self.intertables_config.vars:
             # return a new intertable filename to create
             if not self.create_if_missing:
                 raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'Using {intertable_id}')
             self.intertables_config.check_write()
-            filename = self.format_intertablename(prognum='')
+            filename = self.format_intertablename(prognum='', suffix=suffix)
             tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
             i = 1
-            while pyg2p.util.files.exists(tbl_fullpath):
-                filename = self.format_intertablename(prognum='_{}'.format(i))
+            while intertable.exists(tbl_fullpath):
+                filename = self.format_intertablename(prognum='_{}'.format(i), suffix=suffix)
                 tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
                 i += 1
             return intertable_id, tbl_fullpath
@@ -87,9 +155,9 @@ class Interpolator(Loggable):
         tbl_fullpath = None if not self._intertable_dirs.get('user') else os.path.normpath(os.path.join(self._intertable_dirs['user'], filename))
         if self._logger.isEnabledFor(logging.DEBUG):
             self._logger.debug(f'Using {tbl_fullpath} for id {intertable_id}')
-        if not tbl_fullpath or not (pyg2p.util.files.exists(tbl_fullpath) or pyg2p.util.files.exists(tbl_fullpath + '.gz')):
+        if not tbl_fullpath or not intertable.exists(tbl_fullpath):
             tbl_fullpath = os.path.normpath(os.path.join(self._intertable_dirs['global'], filename))
-            if not (pyg2p.util.files.exists(tbl_fullpath) or pyg2p.util.files.exists(tbl_fullpath + '.gz')):
+            if not intertable.exists(tbl_fullpath):
                 # will create a new intertable but with same filename/id
                 # as an existing configuration was already found but file is missing for some reasons
                 if not self.create_if_missing:
@@ -100,66 +168,74 @@ class Interpolator(Loggable):
                 self._logger.warning(f'An entry in configuration was found for {filename} but intertable does not exist.')
         return intertable_id, tbl_fullpath
 
+    def _missing_intertables(self, grid_id):
+        # intertables of other modes to create along with the one of mode (id and filename of each mode)
+        if not self._modes or not self.create_if_missing:
+            return {}
+        tables = {mode: self._intertable_filename(grid_id, mode) for mode in self._modes}
+        return {mode: table for mode, table in tables.items() if not intertable.exists(table[1])}
+
+    @staticmethod
+    def _checkpoint(intertable_id, intertable_name):
+        # completed chunks of a table being created are kept next to it, until the table is written
+        return Checkpoint(os.path.join(os.path.dirname(os.path.abspath(intertable_name)), CHECKPOINTS_DIR, intertable_id))
+
     def _read_intertable(self, tbl_fullpath):
 
         if tbl_fullpath not in self._LOADED_INTERTABLES:
-            f = tbl_fullpath
-            if tbl_fullpath.endswith('.gz'):
-                f = gzip.GzipFile(tbl_fullpath, 'r')
-                intertable = np.load(f)
-                f.close()
-            else:
-                try:
-                    intertable = np.load(tbl_fullpath)
-                except FileNotFoundError:
-                    f = tbl_fullpath + '.gz'
-                    if not pyg2p.util.files.exists(f):
-                        raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'Tried to read both {tbl_fullpath} and {f} but none was found')
-                    f = gzip.GzipFile(f, 'r')
-                    intertable = np.load(f)
-                    f.close()
-            self._LOADED_INTERTABLES[tbl_fullpath] = intertable
+            intertable_ = intertable.load(tbl_fullpath)
+            self._LOADED_INTERTABLES[tbl_fullpath] = intertable_
             self._log(f'Using interpolation table: {tbl_fullpath}', 'INFO')
         else:
-            intertable = self._LOADED_INTERTABLES[tbl_fullpath]
+            intertable_ = self._LOADED_INTERTABLES[tbl_fullpath]
 
         if self._mode == 'grib_nearest':
             # grib nearest neighbour table
-            return intertable[0], intertable[1], intertable[2]
+            return intertable_[0], intertable_[1], intertable_[2]
         elif self._mode == 'grib_invdist':
             # grib inverse distance table is a "recorded numpy array" with keys 'indexes' and 'coeffs'
-            indexes = intertable['indexes']  # first two arrays of this group are target xs and ys indexes
-            coeffs = intertable['coeffs']
+            indexes = intertable_['indexes']  # first two arrays of this group are target xs and ys indexes
+            coeffs = intertable_['coeffs']
             return indexes[0], indexes[1], indexes[2], indexes[3], indexes[4], indexes[5], coeffs[0], coeffs[1], coeffs[2], coeffs[3]
         else:
-            # self._mode in ('invdist', 'adw', 'cdd', 'nearest', 'bilinear', 'triangulation', 'bilinear_delaunay'):
+            # self._mode in ('invdist', 'adw', 'cdd', 'nearest', 'bilinear', 'bilinear_rings', 'triangulation', 'bilinear_delaunay'):
             # return indexes and weighted distances (only used with nnear > 1)
-            indexes = intertable['indexes']
-            coeffs = intertable['coeffs']
+            indexes = intertable_['indexes']
+            coeffs = intertable_['coeffs']
             return indexes, coeffs
 
-    # ####### SCIPY INTERPOLATION ###################################
-    def _interpolate_scipy_append_mv(self, v, weights, indexes, nnear):
-        # append the MV efas value at the end because of how KDTree algo works
-        # It gives (last_index + 1) from original values when value can't be computed.
-        # These "last_index + 1" indexes are stored in intertable so we artificially add a missing value
-        # v[last_index + 1] = mv
-        v = np.append(v, self.mv_output)
-        orig_mask = False if not isinstance(v, ma.core.MaskedArray) else v.mask
-        if nnear == 1:
-            if isinstance(orig_mask, np.ndarray):
-                result = ma.masked_where(orig_mask[indexes], v[indexes], copy=False)
+    def _operator(self, intertable_name, source_size, target_shape):
+        key = (intertable_name, source_size, target_shape)
+        if key not in self._LOADED_OPERATORS:
+            table = self._read_intertable(intertable_name)
+            if self._mode == 'grib_nearest':
+                xs, ys, idxs = table
+                operator = SparseOperator.from_grib(xs, ys, [idxs], None, source_size, target_shape)
+            elif self._mode == 'grib_invdist':
+                xs, ys = table[:2]
+                operator = SparseOperator.from_grib(xs, ys, table[2:6], table[6:], source_size, target_shape)
             else:
-                result = v[indexes]
-        else:
-            result = np.einsum('ij,ij->i', weights, v[indexes])
-            if isinstance(orig_mask, np.ndarray):
-                # there are masks. logic sum of masks from all values used
-                mask = None
-                for i in range(0, indexes.shape[1]):
-                    mask = orig_mask[indexes.T[i]] if mask is None else mask | orig_mask[indexes.T[i]]
-                result = ma.masked_where(mask, result, copy=False)
-        return result
+                indexes, weights = table
+                operator = SparseOperator.from_scipy(indexes, weights, self.scipy_modes_nnear[self._mode], source_size, target_shape)
+            self._LOADED_OPERATORS[key] = operator
+        return self._LOADED_OPERATORS[key]
+
+    def _source_mask(self, v):
+        # mask of source values to propagate to results, None if there isn't any
+        mask = ma.getmask(v)
+        if not isinstance(mask, np.ndarray):
+            return None
+        if not self.interpolate_with_grib and not isinstance(ma.getmask(np.append(v[:1], self.mv_output)), np.ndarray):
+            # scipy interpolation uses the mask of values with the missing value appended (KDTree indexes),
+            # which np.append doesn't keep: results are computed from unmasked data
+            return None
+        return mask
+
+    def _apply_operator(self, intertable_name, values, target_shape):
+        operator = self._operator(intertable_name, values[0].size, tuple(target_shape))
+        return operator.apply(values, self.mv_output, masks=[self._source_mask(v) for v in values])
+
+    # ####### SCIPY INTERPOLATION ###################################
 
     def interpolate_scipy(self, latgrib, longrib, v, grid_id, grid_details=None):
         lonefas = self._target_coords.lons
@@ -217,14 +293,17 @@ class Interpolator(Loggable):
             intertable_id, intertable_name = 'DEBUG_ADW','DEBUG_ADW.npy'
 
         nnear = self.scipy_modes_nnear[self._mode]
+        create_intertable = DEBUG_ADW_INTERPOLATION or not intertable.exists(intertable_name)
+        other_intertables = {} if DEBUG_ADW_INTERPOLATION else self._missing_intertables(grid_id)
 
-        if (not DEBUG_ADW_INTERPOLATION) and \
-            (pyg2p.util.files.exists(intertable_name) or pyg2p.util.files.exists(intertable_name + '.gz')):
-                indexes, weights = self._read_intertable(intertable_name)
-                result = self._interpolate_scipy_append_mv(v, weights, indexes, nnear)
-
-        elif self.create_if_missing:
+        if create_intertable or other_intertables:
+            if not self.create_if_missing:
+                raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
             self.intertables_config.check_write()
+            # source grid structures are cached, except for debug coordinates
+            geometry = SourceGeometry(grid_id) if not DEBUG_ADW_INTERPOLATION else None
+            if latgrib is None and grid_details is not None:
+                latgrib, longrib = geometry.latlons(grid_details) if geometry else grid_details.latlons
             if latgrib is None:
                 self._log('Trying to interpolate without grib lat/lons. Probably a malformed grib!', 'ERROR')
                 raise ApplicationException.get_exc(5000)
@@ -237,42 +316,136 @@ class Interpolator(Loggable):
             # v=np.float32(v)
             # self.mv_out=np.float32(self.mv_out)
             
-            self._log('\nInterpolating table not found\n Id: {}\nWill create file: {}'.format(intertable_id, intertable_name), 'WARN')
+            if create_intertable:
+                self._log('\nInterpolating table not found\n Id: {}\nWill create file: {}'.format(intertable_id, intertable_name), 'WARN')
+            checkpoint = self._checkpoint(intertable_id, intertable_name)
             scipy_interpolation = ScipyInterpolation(longrib, latgrib, grid_details, v.ravel(), nnear, self.mv_out,
                                           self._mv_grib, target_is_rotated=self._rotated_target_grid,
                                           parallel=self.parallel, mode=self._mode, 
                                           cdd_map=self._cdd_map, cdd_mode=self._cdd_mode, cdd_options = self._cdd_options,
                                           use_broadcasting=self._use_broadcasting,
-                                          num_of_splits=self._num_of_splits)
-            _, weights, indexes = scipy_interpolation.interpolate(lonefas, latefas)            
-            result = self._interpolate_scipy_append_mv(v, weights, indexes, nnear)
-
-            # saving interpolation lookup table
-            intertable = np.rec.fromarrays((indexes, weights), names=('indexes', 'coeffs'))
-            if intertable_name.endswith('.gz'):
-                f = gzip.GzipFile(intertable_name, 'w')
-                np.save(f, intertable)
-                f.close()
+                                          num_of_splits=self._num_of_splits, max_memory=self._max_memory,
+                                          checkpoint=checkpoint, geometry=geometry)
+            parent = None
+            if create_intertable and not other_intertables and not DEBUG_BILINEAR_INTERPOLATION and not DEBUG_ADW_INTERPOLATION:
+                parent = self._parent_intertable(grid_id, v.shape)
+            if parent:
+                intertable_ = self._derive_intertable(parent, scipy_interpolation, lonefas, latefas)
+                intertable.save(intertable_name, intertable_)
+            elif other_intertables:
+                # intertables of other modes are created from the same neighbours
+                modes = {mode: self.scipy_modes_nnear[mode] for mode in [self._mode] + list(other_intertables)}
+                results = scipy_interpolation.interpolate_modes(lonefas, latefas, modes)
+                for mode, (mode_intertable_id, mode_intertable_name) in other_intertables.items():
+                    self._log('Interpolating table of {} created\n Id: {}\nFile: {}'.format(mode, mode_intertable_id, mode_intertable_name), 'WARN')
+                    _, weights, indexes = results[mode]
+                    mode_intertable = np.rec.fromarrays((indexes, weights), names=('indexes', 'coeffs'))
+                    intertable.save(mode_intertable_name, mode_intertable)
+                    self.update_intertable_conf(mode_intertable, mode_intertable_id, mode_intertable_name, v.shape, mode=mode)
+                _, weights, indexes = results[self._mode]
+                intertable_ = np.rec.fromarrays((indexes, weights), names=('indexes', 'coeffs'))
+                if create_intertable:
+                    intertable.save(intertable_name, intertable_)
+            elif self._max_memory:
+                # interpolation lookup table is streamed to disk, subset by subset
+                dtype = np.dtype([('indexes', int), ('coeffs', lonefas.dtype)])
+                shape = (lonefas.size,) if nnear == 1 else (lonefas.size, nnear)
+                subsets = scipy_interpolation.interpolate_subsets(lonefas, latefas)
+                intertable.save_stream(intertable_name, shape, dtype,
+                                       (np.rec.fromarrays((indexes, weights), dtype=dtype) for _, _, _, weights, indexes in subsets))
+                intertable_ = None
             else:
-                np.save(intertable_name, intertable)
-            self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
-        else:
-            raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
-
-        # reshape to target (e.g. efas, glofas...)
-        grid_data = result.reshape(lonefas.shape)
+                _, weights, indexes = scipy_interpolation.interpolate(lonefas, latefas)            
+
+                # saving interpolation lookup table
+                intertable_ = np.rec.fromarrays((indexes, weights), names=('indexes', 'coeffs'))
+                intertable.save(intertable_name, intertable_)
+            checkpoint.clear()
+            if create_intertable:
+                self.update_intertable_conf(intertable_, intertable_id, intertable_name, v.shape,
+                                            derived_from=pyg2p.util.files.filename(parent[0]) if parent else None)
+
+        # result is reshaped to target (e.g. efas, glofas...)
+        grid_data = self._apply_operator(intertable_name, [v], lonefas.shape)[0]
         return grid_data
 
+    def _existing_intertable(self, filename):
+        # full path of an intertable file in user or global folder, None if it doesn't exist
+        for folder in (self._intertable_dirs.get('user'), self._intertable_dirs.get('global')):
+            tbl_fullpath = os.path.normpath(os.path.join(folder, filename)) if folder else None
+            if tbl_fullpath and intertable.exists(tbl_fullpath):
+                return tbl_fullpath
+        return None
+
+    def _parent_intertable(self, grid_id, source_shape):
+        """
+        Find an intertable of the same source grid and mode whose target grid overlaps this one on whole rows and columns
+        (e.g. this target is a sub-domain of it, or extends it by some rows) for at least min_derived_overlap of its cells.
+        Return its path, target coordinates and the overlapping windows of both grids, or None
+        """
+        if self._mode not in self.derived_modes:
+            return None
+        prefix = '{}{}_'.format(self._prefix, grid_id.replace('$', '_'))
+        best, best_cells = None, self.min_derived_overlap * self._target_coords.lats.size
+        for intertable_id, conf in self.intertables_config.vars.items():
+            if not intertable_id.startswith(prefix) or conf.get('method') != self._mode or not conf.get('target_maps') \
+                    or list(conf.get('source_shape', [])) != list(source_shape) or conf['target_maps'] == self._target_maps:
+                continue
+            tbl_fullpath = self._existing_intertable(conf['filename'])
+            if not tbl_fullpath or not all(pyg2p.util.files.exists(path) for path in conf['target_maps']):
+                continue
+            parent_coords = LatLong(*conf['target_maps'])
+            if intertable_id != '{}{}{}'.format(prefix, parent_coords.identifier, self._suffix):
+                # target maps were changed after the intertable was created
+                continue
+            window = self._target_coords.window_in(parent_coords)
+            if not window:
+                continue
+            rows, cols = window[0]
+            cells = (rows.stop - rows.start) * (cols.stop - cols.start)
+            if cells >= best_cells:
+                best, best_cells = (tbl_fullpath, parent_coords, window), cells
+        return best
+
+    def _derive_intertable(self, parent, scipy_interpolation, lonefas, latefas):
+        # rows of the parent intertable for the overlapping cells, and new ones for the other cells
+        tbl_fullpath, parent_coords, ((rows, cols), (parent_rows, parent_cols)) = parent
+        self._log(f'Deriving interpolation table from {tbl_fullpath}', 'INFO')
+        parent_table = intertable.load(tbl_fullpath)
+        parent_indexes, parent_coeffs = parent_table['indexes'], parent_table['coeffs']
+        neighbours = parent_indexes.shape[1:]
+        missing = np.ones(lonefas.shape, dtype=bool)
+        missing[rows, cols] = False
+        weights = idxs = None
+        if missing.any():
+            self._log(f'Interpolating {np.count_nonzero(missing)} target points missing from {tbl_fullpath}', 'INFO')
+            _, weights, idxs = scipy_interpolation.interpolate_cells(lonefas[missing], latefas[missing])
+        # weights keep the precision of the parent intertable (e.g. float64 with float32 target coordinates)
+        dtype = parent_coeffs.dtype if weights is None else np.result_type(parent_coeffs.dtype, weights.dtype)
+        indexes = np.empty(lonefas.shape + neighbours, dtype=int)
+        coeffs = np.empty(lonefas.shape + neighbours, dtype=dtype)
+        indexes[rows, cols] = parent_indexes.reshape(parent_coords.lats.shape + neighbours)[parent_rows, parent_cols]
+        coeffs[rows, cols] = parent_coeffs.reshape(parent_coords.lats.shape + neighbours)[parent_rows, parent_cols]
+        if weights is not None:
+            indexes[missing] = idxs
+            coeffs[missing] = weights
+        shape = (lonefas.size,) + neighbours
+        return np.rec.fromarrays((indexes.reshape(shape), coeffs.reshape(shape)), names=('indexes', 'coeffs'))
+
     # #### GRIB API INTERPOLATION ####################
     def interpolate_grib(self, v, gid, grid_id, is_second_res=False):
         return self.grib_methods[self._mode](v, gid, grid_id, is_second_res=is_second_res)
 
+    def _grib_builder(self, mode):
+        if not self.parallel:
+            return getattr(grib_interpolation_lib, mode)
+        # -X without a number of workers uses all CPUs
+        return partial(getattr(grib_interpolation_lib, f'{mode}_parallel'), workers=None if self.parallel is True else int(self.parallel))
+
     def grib_nearest(self, v, gid, grid_id, is_second_res=False, intertable_id=None, intertable_name=None):
         if not intertable_name:
             intertable_id, intertable_name = self._intertable_filename(grid_id)
-        result = np.empty(self._target_coords.lons.shape)
-        result.fill(self.mv_out)
-        if gid == -1 and not pyg2p.util.files.exists(intertable_name):
+        if gid == -1 and not intertable.exists(intertable_name):
             # calling recursive grib_nearest
             # aux_gid and aux_values are only used to create the interlookuptable
             if is_second_res:
@@ -283,25 +456,18 @@ class Interpolator(Loggable):
                 self.grib_nearest(self._aux_val, self._aux_gid, grid_id,
                                   intertable_name=intertable_name, intertable_id=intertable_id)
 
-        if pyg2p.util.files.exists(intertable_name):
-            # interpolation using intertables
-            xs, ys, idxs = self._read_intertable(intertable_name)
-
-        elif self.create_if_missing:
+        if not intertable.exists(intertable_name) and self.create_if_missing:
             if gid == -1:
                 raise ApplicationException.get_exc(6000, details='GRIB message reference was not found.')
             self.intertables_config.check_write()
             self._log('\nInterpolating table not found\n Id: {}\nWill create file: {}'.format(intertable_id, intertable_name), 'WARN')
-            xs, ys, idxs = getattr(grib_interpolation_lib, 'grib_nearest{}'.format('' if not self.parallel else '_parallel'))(gid, self._target_coords.lats, self._target_coords.lons, self._target_coords.mv)
-            intertable = np.asarray([xs, ys, idxs])
-            if intertable_name.endswith('.gz'):
-                f = gzip.GzipFile(intertable_name, 'w')
-                np.save(f, intertable)
-                f.close()
-            else:
-                np.save(intertable_name, intertable)
-            self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
-        else:
+            checkpoint = self._checkpoint(intertable_id, intertable_name)
+            xs, ys, idxs = self._grib_builder('grib_nearest')(gid, self._target_coords.lats, self._target_coords.lons, self._target_coords.mv, checkpoint=checkpoint)
+            intertable_ = np.asarray([xs, ys, idxs])
+            intertable.save(intertable_name, intertable_)
+            checkpoint.clear()
+            self.update_intertable_conf(intertable_, intertable_id, intertable_name, v.shape)
+        elif not intertable.exists(intertable_name):
             if intertable_id not in self.intertables_config.vars:
                 d = {'filename': pyg2p.util.files.filename(intertable_name),
                      'method': self._mode,
@@ -309,18 +475,14 @@ class Interpolator(Loggable):
                      'target_shape': self._target_coords.lons.shape}
                 self._log('If you already have an intertable file, add this configuration to intertables.json and change filename. {} {}'.format(intertable_id, d), 'INFO')
             raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
-        result[xs, ys] = pyg2p.util.numeric.result_masked(v[idxs], self.mv_output)
-        return result
+        return self._apply_operator(intertable_name, [v], self._target_coords.lons.shape)[0]
 
     def grib_inverse_distance(self, v, gid, grid_id, is_second_res=False, intertable_id=None, intertable_name=None):
         if not intertable_name:
             intertable_id, intertable_name = self._intertable_filename(grid_id)
 
-        result = np.empty(self._target_coords.lons.shape)
-        result.fill(self.mv_out)
-
         # check if gid is due to the recursive call
-        if gid == -1 and not pyg2p.util.files.exists(intertable_name):
+        if gid == -1 and not intertable.exists(intertable_name):
             # aux_gid and aux_values are only used to create the interlookuptable
             # since manipulated values messages don't have gid reference to grib file any longer
             aux_gid = self._aux_gid
@@ -331,10 +493,7 @@ class Interpolator(Loggable):
             self.grib_inverse_distance(aux_val, aux_gid, grid_id, intertable_name=intertable_name,
                                        intertable_id=intertable_id, is_second_res=is_second_res)
 
-        if pyg2p.util.files.exists(intertable_name):
-            # interpolation using intertables
-            xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = self._read_intertable(intertable_name)
-        elif self.create_if_missing:
+        if not intertable.exists(intertable_name) and self.create_if_missing:
             # assert...
             if gid == -1:
                 raise ApplicationException.get_exc(6000)
@@ -343,21 +502,18 @@ class Interpolator(Loggable):
             lonefas = self._target_coords.lons
             latefas = self._target_coords.lats
             mv = self._target_coords.mv
-            intrp_result = getattr(grib_interpolation_lib, 'grib_invdist{}'.format('' if not self.parallel else '_parallel'))(gid, latefas, lonefas, mv)
+            checkpoint = self._checkpoint(intertable_id, intertable_name)
+            intrp_result = self._grib_builder('grib_invdist')(gid, latefas, lonefas, mv, checkpoint=checkpoint)
             xs, ys, idxs1, idxs2, idxs3, idxs4, coeffs1, coeffs2, coeffs3, coeffs4 = intrp_result
             indexes = np.asarray([xs, ys, idxs1, idxs2, idxs3, idxs4])
             coeffs = np.asarray([coeffs1, coeffs2, coeffs3, coeffs4, np.zeros(coeffs1.shape), np.zeros(coeffs1.shape)])
-            intertable = np.rec.fromarrays((indexes, coeffs), names=('indexes', 'coeffs'))
+            intertable_ = np.rec.fromarrays((indexes, coeffs), names=('indexes', 'coeffs'))
             # saving interpolation lookup table
-            if intertable_name.endswith('.gz'):
-                f = gzip.GzipFile(intertable_name, 'w')
-                np.save(f, intertable)
-                f.close()
-            else:
-                np.save(intertable_name, intertable)
-            self.update_intertable_conf(intertable, intertable_id, intertable_name, v.shape)
+            intertable.save(intertable_name, intertable_)
+            checkpoint.clear()
+            self.update_intertable_conf(intertable_, intertable_id, intertable_name, v.shape)
 
-        else:
+        elif not intertable.exists(intertable_name):
             if intertable_id not in self.intertables_config.vars:
                 d = {'filename': pyg2p.util.files.filename(intertable_name),
                      'method': self._mode,
@@ -366,16 +522,25 @@ class Interpolator(Loggable):
                 self._log('If you already have an intertable file, add this configuration to intertables.json and change filename. {} {}'.format(intertable_id, d), 'INFO')
             raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=intertable_name)
 
-        res = v[idxs1] * coeffs1 + v[idxs2] * coeffs2 + v[idxs3] * coeffs3 + v[idxs4] * coeffs4
-        result[xs, ys] = pyg2p.util.numeric.result_masked(res, self.mv_output)
-        return result
+        # v[idxs1] * coeffs1 + v[idxs2] * coeffs2 + v[idxs3] * coeffs3 + v[idxs4] * coeffs4, masked results set to mv
+        return self._apply_operator(intertable_name, [v], self._target_coords.lons.shape)[0]
 
-    def update_intertable_conf(self, intertable, intertable_id, intertable_name, source_shape):
-        self._LOADED_INTERTABLES[intertable_name] = intertable
+    def update_intertable_conf(self, intertable, intertable_id, intertable_name, source_shape, mode=None, derived_from=None):
+        if intertable is None:
+            # table was streamed to disk: it's read when used
+            self._LOADED_INTERTABLES.pop(intertable_name, None)
+        else:
+            self._LOADED_INTERTABLES[intertable_name] = intertable
+        for key in [key for key in self._LOADED_OPERATORS if key[0] == intertable_name]:
+            # operators of a previous table with the same name
+            del self._LOADED_OPERATORS[key]
         new_intertable_conf_item = {'filename': pyg2p.util.files.filename(intertable_name),
-                                    'method': self._mode,
+                                    'method': mode or self._mode,
                                     'source_shape': source_shape,
-                                    'target_shape': self._target_coords.lons.shape}
+                                    'target_shape': self._target_coords.lons.shape,
+                                    'target_maps': self._target_maps}
+        if derived_from:
+            new_intertable_conf_item['derived_from'] = derived_from
         # update global configuration
         self.intertables_config.vars[intertable_id] = new_intertable_conf_item
 
@@ -0,0 +1,89 @@
+"""
+Checkpoints of interpolation tables creation.
+
+Tables are computed by chunks of target cells. Completed chunks are saved in a work folder keyed by intertable id,
+so that a creation interrupted (crash, walltime limit...) is resumed from the completed chunks
+when pyg2p is executed again with -B option. The work folder is deleted once the table is written.
+"""
+import os
+import shutil
+
+import numpy as np
+import ujson as json
+
+from pyg2p import Loggable
+import pyg2p.util.files
+
+CHECKPOINTS_DIR = 'checkpoints'
+META_FILE = 'meta.json'
+
+
+class Checkpoint(Loggable):
+
+    def __init__(self, work_dir):
+        super().__init__()
+        self.work_dir = work_dir
+        self.chunk_size = None
+
+    def open(self, chunk_size, **meta):
+        """
+        Start or resume a table creation by chunks of chunk_size target cells.
+        Chunks saved by a previous execution are kept only if it had the same chunk size and meta
+        (e.g. mode, source and target shapes).
+        """
+        meta = json.loads(json.dumps(dict(meta, chunk_size=chunk_size)))
+        meta_file = os.path.join(self.work_dir, META_FILE)
+        self.chunk_size = chunk_size
+        if pyg2p.util.files.exists(meta_file):
+            with open(meta_file) as f:
+                if json.load(f) == meta:
+                    self._log(f'Resuming interpolation table creation from checkpoints in {self.work_dir}', 'INFO')
+                    return self
+            self._log(f'Discarding checkpoints in {self.work_dir}, created with different settings', 'WARN')
+            shutil.rmtree(self.work_dir)
+        pyg2p.util.files.create_dir(self.work_dir)
+        with open(meta_file, 'w') as f:
+            json.dump(meta, f)
+        return self
+
+    def _chunk_file(self, chunk):
+        return os.path.join(self.work_dir, f'chunk_{chunk:06d}.npz')
+
+    def completed(self, chunk):
+        return pyg2p.util.files.exists(self._chunk_file(chunk))
+
+    def load(self, chunk):
+        with np.load(self._chunk_file(chunk)) as f:
+            return tuple(f[f'arr_{i}'] for i in range(len(f.files)))
+
+    def save(self, chunk, arrays):
+        # write and rename, so that a chunk interrupted while saving is not taken as completed
+        chunk_file = self._chunk_file(chunk)
+        tmp_file = f'{chunk_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, *[np.ma.getdata(a) for a in arrays])
+        os.replace(tmp_file, chunk_file)
+
+    def resume(self, arrays):
+        """
+        Load leading completed chunks into arrays of all target cells.
+        Return the first target cell to compute
+        """
+        chunk = 0
+        while self.completed(chunk):
+            start = chunk * self.chunk_size
+            for array, saved in zip(arrays, self.load(chunk)):
+                array[start:start + len(saved)] = saved
+            chunk += 1
+        if chunk:
+            self._log(f'{chunk} chunks of {self.chunk_size} target cells already computed', 'INFO')
+        return min(chunk * self.chunk_size, len(arrays[0]))
+
+    def save_cells(self, stop, arrays):
+        # save the chunk ending at target cell stop (excluded), from arrays of all target cells
+        chunk = (stop - 1) // self.chunk_size
+        self.save(chunk, [array[chunk * self.chunk_size:stop] for array in arrays])
+
+    def clear(self):
+        if pyg2p.util.files.exists(self.work_dir, is_folder=True):
+            shutil.rmtree(self.work_dir)
@@ -0,0 +1,48 @@
+"""
+Cache of source grid geometry.
+
+Structures depending only on the source grid (coordinates, KDTree of their 3D embedding, grid resolution,
+Delaunay triangulation) are saved in a folder keyed by grid id in the user folder ~/.pyg2p/geometry,
+so that interpolation tables for other targets or methods on the same source grid skip their computation.
+"""
+import os
+import pickle
+
+from pyg2p import Loggable
+import pyg2p.util.files
+
+
+class SourceGeometry(Loggable):
+    user_dir = os.path.join(os.path.expanduser('~'), '.pyg2p', 'geometry')
+
+    def __init__(self, grid_id, geometry_dir=None):
+        super().__init__()
+        self.work_dir = os.path.join(geometry_dir or self.user_dir, grid_id.replace('$', '_'))
+
+    def _item_file(self, name):
+        return os.path.join(self.work_dir, f'{name}.pkl')
+
+    def get(self, name, compute):
+        """
+        Return the item name of the source grid, loaded from cache or computed with compute() and saved
+        """
+        item_file = self._item_file(name)
+        if pyg2p.util.files.exists(item_file):
+            self._log(f'Using source grid {name} from {self.work_dir}', 'DEBUG')
+            try:
+                with open(item_file, 'rb') as f:
+                    return pickle.load(f)
+            except Exception as e:
+                # e.g. saved by another version of scipy
+                self._log(f'Computing source grid {name} again, cached item can not be read: {e}', 'WARN')
+        item = compute()
+        pyg2p.util.files.create_dir(self.work_dir)
+        # write and rename, so that processes sharing the folder never read a partial file
+        tmp_file = f'{item_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, item_file)
+        return item
+
+    def latlons(self, grid_details):
+        return self.get('latlons', lambda: grid_details.latlons)
@@ -1,18 +1,19 @@
 """
 Grib interpolation utils.
-Interpolating between global grids it takes 3 days on Intel(R) Core(TM) i7-3610QM CPU @ 2.30GHz.
-Parallelized versions gives 4x gain at least.
+Target points are searched in batches, with eccodes keeping the source grid geometry between searches
+(rotated grids excepted, searched point by point). Parallelized versions split target rows among workers.
 """
 
+import multiprocessing
+import os
 import warnings
-from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from sys import stdout
 
 import eccodes
 import numexpr as ne
 import numpy as np
-from dask import bag
-from dask.diagnostics import ProgressBar
 
 from ...util.generics import progress_step_and_backchar
 from ...util.numeric import empty, int_fill_value
@@ -20,8 +21,106 @@ from ...util.strings import now_string
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
+# target cells of a checkpoint chunk (see pyg2p.main.interpolation.checkpoint)
+CHECKPOINT_CELLS = 1 << 16
+# target cells searched with one eccodes call (a divisor of CHECKPOINT_CELLS)
+NEAREST_BATCH = 1 << 14
+
+
+def _open_checkpoint(checkpoint, mode, target_lats):
+    if checkpoint is not None:
+        checkpoint.open(CHECKPOINT_CELLS, mode=mode, target_shape=target_lats.shape)
+    return checkpoint
+
+
+@contextmanager
+def nearest_handle(gid):
+    """
+    eccodes nearest handle, keeping the source grid geometry between searches.
+    None for rotated grids: eccodes doesn't keep their geometry (searches after the first one fail)
+    """
+    if eccodes.codes_get(gid, 'gridType').startswith('rotated'):
+        yield None
+        return
+    nid = eccodes.codes_grib_nearest_new(gid)
+    try:
+        yield nid
+    finally:
+        eccodes.codes_grib_nearest_delete(nid)
+
+
+def _find_4_nearest_point(gid, nid, lat, lon):
+    if nid is None:
+        return eccodes.codes_grib_find_nearest(gid, lat, lon, npoints=4)
+    return eccodes.codes_grib_nearest_find(nid, gid, lat, lon, eccodes.CODES_GRIB_NEAREST_SAME_GRID)
+
+
+def find_nearest(gid, nid, lats, lons):
+    """
+    Index of the nearest source point of each target point, int_fill_value for points out of the source grid area.
+    Points are searched with one eccodes call, computing the source grid geometry once.
+    If it fails, points out of a limited area source are found with nid (see nearest_handle) and the others
+    are searched again with one call. Without nid, points are searched one by one.
+    """
+    lats, lons = np.ma.getdata(lats).tolist(), np.ma.getdata(lons).tolist()
+    indexes = np.full(len(lats), int_fill_value, dtype=int)
+    if nid is not None and lats:
+        try:
+            indexes[:] = [n['index'] for n in eccodes.codes_grib_find_nearest_multiple(gid, False, lats, lons)]
+            return indexes
+        except eccodes.GribInternalError:
+            pass
+        inside = []
+        for k, (lat, lon) in enumerate(zip(lats, lons)):
+            try:
+                _find_4_nearest_point(gid, nid, lat, lon)
+            except eccodes.GribInternalError:
+                continue
+            inside.append(k)
+        try:
+            if inside:
+                n_nearest = eccodes.codes_grib_find_nearest_multiple(gid, False, [lats[k] for k in inside], [lons[k] for k in inside])
+                indexes[inside] = [n['index'] for n in n_nearest]
+            return indexes
+        except eccodes.GribInternalError:
+            pass
+    for k, (lat, lon) in enumerate(zip(lats, lons)):
+        try:
+            indexes[k] = eccodes.codes_grib_find_nearest(gid, lat, lon)[0]['index']
+        except eccodes.GribInternalError:
+            continue
+    return indexes
+
+
+def find_4_nearest(gid, nid, lats, lons):
+    """
+    Inverse distances and indexes of the four nearest source points of each target point (arrays of shape (4, points)),
+    NaN and int_fill_value for points out of the source grid area.
+    A target point on a source point gets all the weight. nid is a nearest handle (see nearest_handle)
+    """
+    lats, lons = np.ma.getdata(lats).tolist(), np.ma.getdata(lons).tolist()
+    distances = np.full((4, len(lats)), np.nan)
+    indexes = np.full((4, len(lats)), int_fill_value, dtype=int)
+    for k, (lat, lon) in enumerate(zip(lats, lons)):
+        try:
+            n_nearest = _find_4_nearest_point(gid, nid, lat, lon)
+        except eccodes.GribInternalError:
+            # tipically "out of grid" error
+            continue
+        distances[:, k] = [n['distance'] for n in n_nearest]
+        indexes[:, k] = [n['index'] for n in n_nearest]
+
+    exact = distances == 0
+    exact_position = exact.any(axis=0)
+    invs = np.divide(1, distances, out=np.zeros_like(distances), where=~exact_position)
+    invs[:, np.isnan(distances[0])] = np.nan
+    invs[0, exact_position] = 1
+    indexes[0, exact_position] = indexes[exact.argmax(axis=0), np.arange(len(lats))][exact_position]
+    indexes[1:, exact_position] = 0
+    return invs, indexes
 
-def grib_nearest(gid, target_lats, target_lons, mv):
+
+def grib_nearest(gid, target_lats, target_lons, mv, checkpoint=None):
     num_cells = target_lons.size
     indices = np.indices(target_lons.shape)
     valid_target_coords = (target_lons > -1.0e+10) & (target_lons != mv)
@@ -29,30 +128,30 @@ def grib_nearest(gid, target_lats, target_lons, mv):
     ys = np.where(valid_target_coords, indices[1], int_fill_value).ravel()
     idxs = empty(num_cells, fill_value=int_fill_value, dtype=int)
 
-    back_char, progress_step = progress_step_and_backchar(num_cells)
+    back_char, _ = progress_step_and_backchar(num_cells)
     format_progress = '{}Nearest neighbour interpolation: {}/{}  [outs: {}] ({}%)'.format
-    i = 0
+    # first cell to compute, after the ones completed in a previous execution
+    first = 0 if _open_checkpoint(checkpoint, 'grib_nearest', target_lats) is None else checkpoint.resume((xs, ys, idxs))
     outs = 0
     stdout.write('Start interpolation: {}\n'.format(now_string()))
-    stdout.write(format_progress(back_char, 0, num_cells, outs, 0))
+    stdout.write(format_progress(back_char, first, num_cells, outs, first * 100. / num_cells))
     stdout.flush()
 
-    for lat, lon in zip(target_lats.flat, target_lons.flat):
-        if i % progress_step == 0:
-            stdout.write(format_progress(back_char, i, num_cells, outs, i * 100. / num_cells))
+    with nearest_handle(gid) as nid:
+        for start in range(first, num_cells, NEAREST_BATCH):
+            stop = min(start + NEAREST_BATCH, num_cells)
+            valid = start + np.flatnonzero(xs[start:stop] != int_fill_value)
+            indexes = find_nearest(gid, nid, target_lats.flat[valid], target_lons.flat[valid])
+            out = valid[indexes == int_fill_value]
+            xs[out] = ys[out] = int_fill_value
+            idxs[valid] = indexes
+            outs += out.size
+            if checkpoint is not None and (stop % CHECKPOINT_CELLS == 0 or stop == num_cells):
+                checkpoint.save_cells(stop, (xs, ys, idxs))
+            stdout.write(format_progress(back_char, stop, num_cells, outs, stop * 100. / num_cells))
             stdout.flush()
-        if not (lon <= -1.0e+10 or lon == mv):
-            try:
-                n_nearest = eccodes.codes_grib_find_nearest(gid, lat.item(), lon.item())
-            except eccodes.GribInternalError:
-                outs += 1
-                xs[i] = int_fill_value
-                ys[i] = int_fill_value
-            else:
-                idxs[i] = n_nearest[0]['index']
-        i += 1
     stdout.write('{}{:>100}'.format(back_char, ' '))
-    stdout.write(format_progress(back_char, i, num_cells, outs, 100))
+    stdout.write(format_progress(back_char, num_cells, num_cells, outs, 100))
     stdout.write('End interpolation: {}\n\n'.format(now_string()))
     stdout.flush()
     return (xs[xs != int_fill_value],
@@ -60,7 +159,7 @@ def grib_nearest(gid, target_lats, target_lons, mv):
             idxs[idxs != int_fill_value])
 
 
-def grib_invdist(gid, target_lats, target_lons, mv):
+def grib_invdist(gid, target_lats, target_lons, mv, checkpoint=None):
     num_cells = target_lons.size
     indices = np.indices(target_lons.shape)
     valid_target_coords = (target_lons > -1.0e+10) & (target_lons != mv)
@@ -76,29 +175,29 @@ def grib_invdist(gid, target_lats, target_lons, mv):
     invs4 = empty(num_cells)
 
     format_progress = '{}Inverse distance interpolation: {}/{}  [outs: {}] ({}%)'.format
-    i = 0
+    cells = (xs, ys, idxs1, idxs2, idxs3, idxs4, invs1, invs2, invs3, invs4)
+    # first cell to compute, after the ones completed in a previous execution
+    first = 0 if _open_checkpoint(checkpoint, 'grib_invdist', target_lats) is None else checkpoint.resume(cells)
     outs = 0
-    back_char, progress_step = progress_step_and_backchar(num_cells)
+    back_char, _ = progress_step_and_backchar(num_cells)
     stdout.write('Start interpolation: {}\n'.format(now_string()))
-    stdout.write(format_progress(back_char, 0, num_cells, outs, 0))
+    stdout.write(format_progress(back_char, first, num_cells, outs, first * 100. / num_cells))
     stdout.flush()
 
-    for lat, lon in zip(target_lats.flat, target_lons.flat):
-        if i % progress_step == 0:
-            stdout.write(format_progress(back_char, i, num_cells, outs, i * 100. / num_cells))
+    with nearest_handle(gid) as nid:
+        for start in range(first, num_cells, NEAREST_BATCH):
+            stop = min(start + NEAREST_BATCH, num_cells)
+            valid = start + np.flatnonzero(xs[start:stop] != int_fill_value)
+            invs, indexes = find_4_nearest(gid, nid, target_lats.flat[valid], target_lons.flat[valid])
+            out = valid[indexes[0] == int_fill_value]
+            xs[out] = ys[out] = int_fill_value
+            invs1[valid], invs2[valid], invs3[valid], invs4[valid] = invs
+            idxs1[valid], idxs2[valid], idxs3[valid], idxs4[valid] = indexes
+            outs += out.size
+            if checkpoint is not None and (stop % CHECKPOINT_CELLS == 0 or stop == num_cells):
+                checkpoint.save_cells(stop, cells)
+            stdout.write(format_progress(back_char, stop, num_cells, outs, stop * 100. / num_cells))
             stdout.flush()
-        if not (lon < -1.0e+10 or lon == mv):
-
-            try:
-                n_nearest = eccodes.codes_grib_find_nearest(gid, lat.item(), lon.item(), npoints=4)
-            except eccodes.GribInternalError:
-                # tipically "out of grid" error
-                outs += 1
-                xs[i] = int_fill_value
-                ys[i] = int_fill_value
-            else:
-                invs1[i], invs2[i], invs3[i], invs4[i], idxs1[i], idxs2[i], idxs3[i], idxs4[i] = _compute_coeffs_and_idxs(n_nearest)
-        i += 1
 
     # variables seems unused but they are in numexpress expressions (see ne.evaluate())
     # DO NOT DELETE
@@ -112,7 +211,7 @@ def grib_invdist(gid, target_lats, target_lons, mv):
     coeffs3 = ne.evaluate('invs3 / sums')
     coeffs4 = ne.evaluate('invs4 / sums')
     stdout.write('{}{:>100}'.format(back_char, ' '))
-    stdout.write(format_progress(back_char, i, num_cells, outs, 100))
+    stdout.write(format_progress(back_char, num_cells, num_cells, outs, 100))
     stdout.write('End interpolation: {}\n\n'.format(now_string()))
     stdout.flush()
     return (xs[xs != int_fill_value], ys[ys != int_fill_value],
@@ -121,56 +220,37 @@ def grib_invdist(gid, target_lats, target_lons, mv):
             coeffs1, coeffs2, coeffs3, coeffs4)
 
 
-def _compute_coeffs_and_idxs(n_nearest):
-    exact_position = False
-    exact_position_idx = - 1
-    for ig in range(4):
-        if n_nearest[ig]['distance'] == 0:
-            exact_position = True
-            exact_position_idx = ig
-            break
-    inv1 = (1 / n_nearest[0]['distance']) if not exact_position else 1
-    inv2 = (1 / n_nearest[1]['distance']) if not exact_position else 0
-    inv3 = (1 / n_nearest[2]['distance']) if not exact_position else 0
-    inv4 = (1 / n_nearest[3]['distance']) if not exact_position else 0
-    idx1 = n_nearest[0]['index'] if not exact_position else n_nearest[exact_position_idx]['index']
-    idx2 = n_nearest[1]['index'] if not exact_position else 0
-    idx3 = n_nearest[2]['index'] if not exact_position else 0
-    idx4 = n_nearest[3]['index'] if not exact_position else 0
-    return inv1, inv2, inv3, inv4, idx1, idx2, idx3, idx4
+##############################################
+# Parallel versions: blocks of target rows are computed by worker processes,
+# each one searching with its own handle of the source GRIB message
 
+# GRIB message handle of a worker process
+_WORKER_GID = None
 
-##############################################
-# Pallel version of grib api nearest neighbour
 
+def _init_worker(message):
+    global _WORKER_GID
+    _WORKER_GID = eccodes.codes_new_from_message(message)
 
-def apply_nearest_to_chunk(chunk, gid=None, mv=None):
-    return np.apply_along_axis(nearest_parallel_step, 0, chunk, gid, mv)
 
+def apply_nearest_to_chunk(chunk, gid=None):
+    # chunk is the stack of target lats, lons, xs and ys (int_fill_value where lons are missing)
+    gid = _WORKER_GID if gid is None else gid
+    lats, lons, xs, ys = chunk
+    xs, ys = xs.astype(int), ys.astype(int)
+    valid = np.flatnonzero(xs != int_fill_value)
+    idxs = np.full(xs.size, int_fill_value, dtype=int)
+    with nearest_handle(gid) as nid:
+        idxs[valid] = find_nearest(gid, nid, lats[valid], lons[valid])
+    xs[idxs == int_fill_value] = ys[idxs == int_fill_value] = int_fill_value
+    return np.stack((xs, ys, idxs))
 
-def nearest_parallel_step(chunk, gid, mv):
-    lat, lon, x, y = chunk
 
-    idx = int_fill_value
-    if not (lon <= -1.0e+10 or lon == mv):
-        try:
-            n_nearest = eccodes.codes_grib_find_nearest(gid, lat.item(), lon.item())
-        except eccodes.GribInternalError:
-            x = int_fill_value
-            y = int_fill_value
-        else:
-            idx = n_nearest[0]['index']
-    return int(x), int(y), idx
-
-
-def grib_nearest_parallel(gid, target_lats, target_lons, mv):
-    nchunks = target_lats.shape[0]
-    apply_to_chunk_part = partial(apply_nearest_to_chunk, gid=gid, mv=mv)
-    result = init_parallel(apply_to_chunk_part, mv, nchunks, target_lats, target_lons)
-    progress = ProgressBar(dt=10)
-    with progress:
-        result = result.compute()
-    idxs, xs, ys = concatenate_nearest_result(nchunks, result)
+def grib_nearest_parallel(gid, target_lats, target_lons, mv, checkpoint=None, workers=None):
+    if checkpoint is not None:
+        checkpoint.open(CHECKPOINT_CELLS, mode='grib_nearest_parallel', target_shape=target_lats.shape)
+    result = compute_parallel(apply_nearest_to_chunk, gid, mv, target_lats, target_lons, checkpoint, workers)
+    idxs, xs, ys = concatenate_nearest_result(len(result), result)
     return xs, ys, idxs
 
 
@@ -184,39 +264,26 @@ def concatenate_nearest_result(nchunks, result):
     return idxs, xs, ys
 
 
-# Parallel version of grib api invdist
-
+def apply_invdist_to_chunk(chunk, gid=None):
+    # chunk is the stack of target lats, lons, xs and ys (int_fill_value where lons are missing)
+    gid = _WORKER_GID if gid is None else gid
+    lats, lons, xs, ys = chunk
+    valid = np.flatnonzero(xs != int_fill_value)
+    invs = np.full((4, xs.size), np.nan)
+    idxs = np.full((4, xs.size), int_fill_value, dtype=int)
+    with nearest_handle(gid) as nid:
+        invs[:, valid], idxs[:, valid] = find_4_nearest(gid, nid, lats[valid], lons[valid])
+    xs, ys = xs.copy(), ys.copy()
+    xs[idxs[0] == int_fill_value] = ys[idxs[0] == int_fill_value] = int_fill_value
+    # x, y, idx1, idx2, idx3, idx4, inv1, inv2, inv3, inv4 of each target point
+    return np.vstack((xs, ys, idxs, invs))
 
-def apply_invdist_to_chunk(chunk, gid=None, mv=None):
-    return np.apply_along_axis(invdist_parallel_step, 0, chunk, gid, mv)
 
-
-def invdist_parallel_step(chunk, gid, mv):
-    lat, lon, x, y = chunk
-    idx1 = idx2 = idx3 = idx4 = int_fill_value
-    inv1 = inv2 = inv3 = inv4 = np.NaN
-    if not (lon < -1.0e+10 or lon == mv):
-        try:
-            n_nearest = eccodes.codes_grib_find_nearest(gid, lat.item(), lon.item(), npoints=4)
-        except eccodes.GribInternalError:
-            # tipically "out of grid" error
-            x = int_fill_value
-            y = int_fill_value
-        else:
-            inv1, inv2, inv3, inv4, idx1, idx2, idx3, idx4 = _compute_coeffs_and_idxs(n_nearest)
-    return x, y, idx1, idx2, idx3, idx4, inv1, inv2, inv3, inv4
-
-
-def grib_invdist_parallel(gid, target_lats, target_lons, mv):
-
-    apply_to_chunk_part = partial(apply_invdist_to_chunk, gid=gid, mv=mv)
-    nchunks = target_lats.shape[0]
-    result = init_parallel(apply_to_chunk_part, mv, nchunks, target_lats, target_lons)
-
-    progress = ProgressBar(dt=10)
-    with progress:
-        result = result.compute()
-    idxs1, idxs2, idxs3, idxs4, xs, ys, invs1, invs2, invs3, invs4 = concatenate_invdist_result(nchunks, result)
+def grib_invdist_parallel(gid, target_lats, target_lons, mv, checkpoint=None, workers=None):
+    if checkpoint is not None:
+        checkpoint.open(CHECKPOINT_CELLS, mode='grib_invdist_parallel', target_shape=target_lats.shape)
+    result = compute_parallel(apply_invdist_to_chunk, gid, mv, target_lats, target_lons, checkpoint, workers)
+    idxs1, idxs2, idxs3, idxs4, xs, ys, invs1, invs2, invs3, invs4 = concatenate_invdist_result(len(result), result)
 
     sums = ne.evaluate('invs1 + invs2 + invs3 + invs4')
     coeffs1 = ne.evaluate('invs1 / sums')
@@ -257,14 +324,49 @@ def concatenate_invdist_result(nchunks, result):
     return idxs1, idxs2, idxs3, idxs4, xs, ys, invs1, invs2, invs3, invs4
 
 
-def init_parallel(apply_to_chunk_part, mv, nchunks, target_lats, target_lons):
+def _parallel_stack(mv, target_lats, target_lons):
     indices = np.indices(target_lons.shape)
-    npartitions = max(100, int(nchunks / 10))
     valid_coords_mask = (target_lons > -1.0e+10) & (target_lons != mv)
     xs = np.where(valid_coords_mask, indices[0], int_fill_value).ravel()
     ys = np.where(valid_coords_mask, indices[1], int_fill_value).ravel()
-    stack = np.stack((target_lats.flat, target_lons.flat, xs.flat, ys.flat))
-    chunks = np.array_split(stack, nchunks, axis=1)
-    nearest_bag = bag.from_sequence(chunks, npartitions=npartitions)
-    result = nearest_bag.map(apply_to_chunk_part)
+    return np.stack((np.ma.getdata(target_lats).ravel(), np.ma.getdata(target_lons).ravel(), xs, ys))
+
+
+def compute_parallel(apply_to_chunk, gid, mv, target_lats, target_lons, checkpoint=None, workers=None):
+    """
+    Compute blocks of target rows (about CHECKPOINT_CELLS cells) with a pool of worker processes.
+    Workers get the source GRIB message once, at start. With a checkpoint, the result of each block is saved
+    and blocks completed in a previous execution are loaded instead of computed.
+    Return the list of (unfiltered) results of blocks, to pass to concatenate_*_result
+    """
+    stack = _parallel_stack(mv, target_lats, target_lons)
+    rows, cols = target_lats.shape
+    rows_per_block = max(1, CHECKPOINT_CELLS // cols)
+    blocks = list(enumerate(range(0, rows, rows_per_block)))
+    result = [None] * len(blocks)
+    if checkpoint is not None:
+        for k, _ in blocks:
+            if checkpoint.completed(k):
+                result[k] = checkpoint.load(k)[0]
+    todo = [(k, start) for k, start in blocks if result[k] is None]
+    if not todo:
+        return result
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    back_char, _ = progress_step_and_backchar(len(todo))
+    format_progress = '{}Interpolating blocks of {} rows with {} processes: {}/{}'.format
+    stdout.write('Start interpolation: {}\n'.format(now_string()))
+    stdout.write(format_progress(back_char, rows_per_block, workers, 0, len(todo)))
+    stdout.flush()
+    # workers are spawned: eccodes handles (and numba threads) of this process are not inherited
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_worker, initargs=(eccodes.codes_get_message(gid),)) as pool:
+        chunks = (stack[:, start * cols:min(start + rows_per_block, rows) * cols] for _, start in todo)
+        for done, ((k, _), block) in enumerate(zip(todo, pool.map(apply_to_chunk, chunks)), start=1):
+            if checkpoint is not None:
+                checkpoint.save(k, [block])
+            result[k] = block
+            stdout.write(format_progress(back_char, rows_per_block, workers, done, len(todo)))
+            stdout.flush()
+    stdout.write('\nEnd interpolation: {}\n\n'.format(now_string()))
+    stdout.flush()
     return result
@@ -0,0 +1,309 @@
+"""
+Reading and writing of interpolation lookup tables.
+
+Supported layouts, in order of precedence when reading:
+    * mmap: a folder tbl_xxx.mmap/ with indexes.npy and coeffs.npy as separate contiguous arrays,
+            opened with np.load(mmap_mode='r') so that concurrent processes share the table through the page cache
+    * compact: a single tbl_xxx.ptbl file with a versioned JSON header (mode, nnear, source/target shape, grid ids)
+               and arrays stored with the narrowest index dtype and float32 weights,
+               zlib compressed in independent chunks, decompressed in parallel threads
+    * npy: a numpy record array ('indexes', 'coeffs') or a plain array (grib_nearest tables)
+    * npy.gz: same as npy, gzip compressed (default for new tables)
+
+Converted layouts record modification time and size of the npy(.gz) table they were converted from:
+they are not read if that table was written again after conversion, and they are converted again.
+"""
+import gzip
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import ujson as json
+
+from ...exceptions import ApplicationException, NO_INTERTABLE_CREATED
+import pyg2p.util.files
+
+MMAP = 'mmap'
+COMPACT = 'compact'
+LAYOUTS = (MMAP, COMPACT)
+
+COMPACT_MAGIC = b'PYG2PTBL'
+COMPACT_VERSION = 1
+COMPACT_CHUNK_SIZE = 1 << 22  # raw bytes per compressed chunk
+# relative error of weights stored as float32 (half of its machine epsilon): results change by less than
+# this fraction of the sum of absolute weighted source values
+COMPACT_WEIGHTS_TOLERANCE = np.finfo(np.float32).eps / 2
+# file of mmap tables with the signature of the table they were converted from
+MMAP_SOURCE_FILE = 'source.json'
+
+
+def _base_path(tbl_fullpath):
+    # intertable filenames in configuration can be with or without .gz extension
+    return tbl_fullpath[:-3] if tbl_fullpath.endswith('.gz') else tbl_fullpath
+
+
+def mmap_path(tbl_fullpath):
+    # tbl_xxx.npy[.gz] -> tbl_xxx.mmap
+    base = _base_path(tbl_fullpath)
+    return f'{base[:-4] if base.endswith(".npy") else base}.mmap'
+
+
+def compact_path(tbl_fullpath):
+    # tbl_xxx.npy[.gz] -> tbl_xxx.ptbl
+    base = _base_path(tbl_fullpath)
+    return f'{base[:-4] if base.endswith(".npy") else base}.ptbl'
+
+
+def _npy_path(tbl_fullpath):
+    # existing npy or npy.gz file of an intertable, None if there isn't any
+    base = _base_path(tbl_fullpath)
+    for path in (base, base + '.gz'):
+        if pyg2p.util.files.exists(path):
+            return path
+    return None
+
+
+def source_signature(tbl_fullpath):
+    # modification time and size of the npy(.gz) table converted layouts are made from, None if it doesn't exist
+    path = _npy_path(tbl_fullpath)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def converted_source(path, layout):
+    # source signature recorded in a converted table (None for tables converted by older versions)
+    try:
+        if layout == MMAP:
+            with open(os.path.join(path, MMAP_SOURCE_FILE)) as f:
+                return json.load(f)
+        return read_compact_header(path).get('source')
+    except (OSError, ValueError):
+        return None
+
+
+def _is_stale(path, layout, source):
+    recorded = converted_source(path, layout)
+    return source is not None and recorded is not None and recorded != source
+
+
+def exists(tbl_fullpath):
+    base = _base_path(tbl_fullpath)
+    return pyg2p.util.files.exists(mmap_path(tbl_fullpath), is_folder=True) or \
+        pyg2p.util.files.exists(compact_path(tbl_fullpath)) or \
+        pyg2p.util.files.exists(base) or pyg2p.util.files.exists(base + '.gz')
+
+
+def load(tbl_fullpath):
+    """
+    Read an intertable in any of the supported layouts.
+    Return a plain array (grib_nearest tables), a record array or a dict with 'indexes' and 'coeffs' arrays
+    """
+    source = source_signature(tbl_fullpath)
+    folder = mmap_path(tbl_fullpath)
+    if pyg2p.util.files.exists(folder, is_folder=True) and not _is_stale(folder, MMAP, source):
+        return _load_mmap(folder)
+    compact = compact_path(tbl_fullpath)
+    if pyg2p.util.files.exists(compact) and not _is_stale(compact, COMPACT, source):
+        return load_compact(compact)
+    return _load_npy(tbl_fullpath)
+
+
+def _load_npy(tbl_fullpath):
+    base = _base_path(tbl_fullpath)
+    if pyg2p.util.files.exists(base):
+        return np.load(base)
+    if not pyg2p.util.files.exists(base + '.gz'):
+        raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'Tried to read both {base} and {base}.gz but none was found')
+    with gzip.GzipFile(base + '.gz', 'r') as f:
+        return np.load(f)
+
+
+def save(tbl_fullpath, intertable):
+    if tbl_fullpath.endswith('.gz'):
+        with gzip.GzipFile(tbl_fullpath, 'w') as f:
+            np.save(f, intertable)
+    else:
+        np.save(tbl_fullpath, intertable)
+
+
+def save_stream(tbl_fullpath, shape, dtype, chunks):
+    """
+    Write an intertable in npy (or npy.gz) format from consecutive chunks of its flattened array,
+    without having the whole table in memory.
+    """
+    dtype = np.dtype(dtype)
+    header = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': tuple(shape)}
+    tmp_path = f'{tbl_fullpath}.{os.getpid()}.tmp'
+    written = 0
+    with (gzip.GzipFile(tmp_path, 'w') if tbl_fullpath.endswith('.gz') else open(tmp_path, 'wb')) as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        for chunk in chunks:
+            chunk = np.ascontiguousarray(chunk, dtype=dtype)
+            f.write(memoryview(chunk).cast('B'))
+            written += chunk.size
+    if written != np.prod(shape, dtype=np.int64):
+        pyg2p.util.files.delete_file(tmp_path)
+        raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'{tbl_fullpath}: {written} values written, expected shape {shape}')
+    os.replace(tmp_path, tbl_fullpath)
+
+
+def _load_mmap(folder):
+    indexes = np.load(os.path.join(folder, 'indexes.npy'), mmap_mode='r')
+    coeffs_file = os.path.join(folder, 'coeffs.npy')
+    if not pyg2p.util.files.exists(coeffs_file):
+        # grib_nearest tables have no coefficients
+        return indexes
+    return {'indexes': indexes, 'coeffs': np.load(coeffs_file, mmap_mode='r')}
+
+
+def save_mmap(folder, intertable, source=None):
+    # write in a temporary folder and rename, so that concurrent readers never see a partial table
+    tmp_folder = f'{folder}.{os.getpid()}.tmp'
+    pyg2p.util.files.create_dir(tmp_folder, recreate=True)
+    if getattr(intertable.dtype, 'names', None):
+        np.save(os.path.join(tmp_folder, 'indexes.npy'), np.ascontiguousarray(intertable['indexes']))
+        np.save(os.path.join(tmp_folder, 'coeffs.npy'), np.ascontiguousarray(intertable['coeffs']))
+    else:
+        np.save(os.path.join(tmp_folder, 'indexes.npy'), np.ascontiguousarray(intertable))
+    if source is not None:
+        with open(os.path.join(tmp_folder, MMAP_SOURCE_FILE), 'w') as f:
+            json.dump(source, f)
+    if pyg2p.util.files.exists(folder, is_folder=True):
+        # a folder can't replace a non empty one: the old table is moved away first
+        # (files already mapped by readers stay valid)
+        old_folder = f'{folder}.{os.getpid()}.old'
+        os.replace(folder, old_folder)
+        pyg2p.util.files.create_dir(old_folder, recreate=True)
+        os.rmdir(old_folder)
+    os.replace(tmp_folder, folder)
+
+
+def _narrowest_int(array):
+    if array.size == 0:
+        return array.dtype
+    lo, hi = int(array.min()), int(array.max())
+    for dtype in (np.uint8, np.uint16, np.uint32, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return array.dtype
+
+
+def _compact_arrays(intertable, mode):
+    # arrays to store, with their narrowest dtypes
+    if isinstance(intertable, dict) or intertable.dtype.names:
+        indexes, coeffs = np.asarray(intertable['indexes']), np.asarray(intertable['coeffs'])
+    else:
+        indexes, coeffs = np.asarray(intertable), None
+    arrays = {'indexes': indexes.astype(_narrowest_int(indexes), copy=False)}
+    if coeffs is not None:
+        if mode == 'grib_invdist':
+            # only 4 rows of coefficients are used: last two are zero padding of the record array
+            coeffs = coeffs[:4]
+        arrays['coeffs'] = coeffs.astype(np.float32)
+    return arrays
+
+
+def save_compact(tbl_fullpath, intertable, meta=None, source=None):
+    """
+    Write the intertable in the compact format.
+    meta is a dict with table details (e.g. mode, nnear, source_shape, target_shape, grid ids) stored in the header,
+    source the signature of the table it's converted from (see source_signature)
+    """
+    meta = dict(meta or {})
+    arrays = _compact_arrays(intertable, meta.get('mode'))
+    raw_chunks = []
+    header = {'version': COMPACT_VERSION, 'meta': meta, 'arrays': []}
+    if source is not None:
+        header['source'] = source
+    for name, array in arrays.items():
+        raw = memoryview(np.ascontiguousarray(array)).cast('B')
+        chunks = [raw[i:i + COMPACT_CHUNK_SIZE] for i in range(0, len(raw), COMPACT_CHUNK_SIZE)]
+        header['arrays'].append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                                 'chunks': [len(c) for c in chunks]})
+        raw_chunks += chunks
+    # zlib releases the GIL: chunks are compressed (and decompressed) by parallel threads
+    with ThreadPoolExecutor() as pool:
+        compressed = list(pool.map(zlib.compress, raw_chunks))
+    compressed_lengths = iter(len(c) for c in compressed)
+    for array_header in header['arrays']:
+        array_header['chunks'] = [[next(compressed_lengths), raw_len] for raw_len in array_header['chunks']]
+    header_bytes = json.dumps(header).encode()
+    tmp_path = f'{tbl_fullpath}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(COMPACT_MAGIC)
+        f.write(struct.pack('<HI', COMPACT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for chunk in compressed:
+            f.write(chunk)
+    os.replace(tmp_path, tbl_fullpath)
+
+
+def read_compact_header(tbl_fullpath):
+    with open(tbl_fullpath, 'rb') as f:
+        return _read_compact_header(f)
+
+
+def _read_compact_header(f):
+    magic = f.read(len(COMPACT_MAGIC))
+    version, header_length = struct.unpack('<HI', f.read(struct.calcsize('<HI')))
+    if magic != COMPACT_MAGIC or version > COMPACT_VERSION:
+        raise ApplicationException.get_exc(NO_INTERTABLE_CREATED, details=f'{f.name} is not a valid intertable (version {version})')
+    return json.loads(f.read(header_length))
+
+
+def load_compact(tbl_fullpath, workers=None):
+    """
+    Read a compact intertable. Chunks are decompressed in parallel straight into the output arrays.
+    Return a plain array (grib_nearest tables) or a dict with 'indexes' and 'coeffs' arrays
+    """
+    with open(tbl_fullpath, 'rb') as f:
+        header = _read_compact_header(f)
+        data = f.read()
+    arrays = {}
+    jobs = []
+    offset = 0
+    for array_header in header['arrays']:
+        array = np.empty(array_header['shape'], dtype=np.dtype(array_header['dtype']))
+        out = array.reshape(-1).view(np.uint8)
+        out_offset = 0
+        for compressed_len, raw_len in array_header['chunks']:
+            jobs.append((memoryview(data)[offset:offset + compressed_len], out[out_offset:out_offset + raw_len]))
+            offset += compressed_len
+            out_offset += raw_len
+        arrays[array_header['name']] = array
+
+    def _decompress(job):
+        compressed, out = job
+        out[:] = np.frombuffer(zlib.decompress(compressed), dtype=np.uint8)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_decompress, jobs))
+    if 'coeffs' not in arrays:
+        return arrays['indexes']
+    return arrays
+
+
+def convert(tbl_fullpath, layout, out_dir=None, meta=None):
+    """
+    Convert an existing intertable to a new layout.
+    Output is written next to the source table, or in out_dir if given. Return the path of the converted table.
+    An existing converted table is kept if it was converted from the current source table
+    """
+    out_path = {MMAP: mmap_path, COMPACT: compact_path}[layout](tbl_fullpath)
+    if out_dir:
+        out_path = os.path.join(out_dir, os.path.basename(out_path))
+    source = source_signature(tbl_fullpath)
+    if os.path.exists(out_path) and (source is None or converted_source(out_path, layout) == source):
+        return out_path
+    # without npy(.gz) table, the table is converted from another layout
+    table = load(tbl_fullpath) if source is None else _load_npy(tbl_fullpath)
+    if layout == MMAP:
+        save_mmap(out_path, table, source)
+    else:
+        save_compact(out_path, table, meta, source)
+    return out_path
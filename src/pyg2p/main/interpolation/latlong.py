@@ -1,18 +1,33 @@
+import itertools
 import logging
 
+import numpy as np
+
 from pyg2p import Loggable
+import pyg2p.util.files
 from pyg2p.exceptions import ApplicationException, INVALID_INTERPOL_METHOD
 from pyg2p.main.readers.pcr import PCRasterReader
 from pyg2p.main.readers.netcdf import NetCDFReader
 from netCDF4 import default_fillvals
 
+# max distance of coordinates of the same cell in two target grids, relative to the grid spacing
+WINDOW_TOLERANCE = 1e-3
+
+
 class LatLong(Loggable):
+    # target coordinates already read in this process (e.g. by previous jobs of a daemon worker)
+    _LOADED = {}
 
     def __init__(self, lat_map, long_map):
         super().__init__()
         self._lat_map = lat_map
         self._long_map = long_map
         self._logger = logging.getLogger()
+
+        key = pyg2p.util.files.signature(lat_map, long_map)
+        if key in self._LOADED:
+            self.lats, self.lons, self.mv, self._id = self._LOADED[key]
+            return
         
         if self._lat_map.endswith('.nc'):
             if (self._lat_map!=self._long_map):
@@ -37,11 +52,66 @@ class LatLong(Loggable):
             self._id = f'{reader.identifier()}_{reader2.identifier()}'
             reader.close()
             reader2.close()
+        self._LOADED[key] = (self.lats, self.lons, self.mv, self._id)
 
     @property
     def identifier(self):
         return self._id
 
+    def _masked_coordinates(self):
+        # coordinates with nan at missing values
+        lats = np.where(self.lats == self.mv, np.nan, self.lats).astype(np.float64)
+        lons = np.where(self.lons == self.mv, np.nan, self.lons).astype(np.float64)
+        return lats, lons
+
+    def window_in(self, other):
+        """
+        Find this grid in other target grid, shifted by whole rows and columns
+        (e.g. a sub-domain cut out of it, or the same grid extended by some rows).
+        Return the slices of overlapping cells in both grids ((rows, cols), (other_rows, other_cols)) or None
+        """
+        lats, lons = self._masked_coordinates()
+        other_lats, other_lons = other._masked_coordinates()
+        steps = [np.nanmedian(np.hypot(np.diff(lats, axis=axis), np.diff(lons, axis=axis)))
+                 for axis in (0, 1) if lats.shape[axis] > 1]
+        steps = [step for step in steps if step > 0]
+        if not steps:
+            return None
+        tolerance = WINDOW_TOLERANCE * min(steps)
+        rows, cols = lats.shape
+        # cells inside the overlap are searched in the other grid, trying a few of them in case the grid is extended
+        for row, col in itertools.product((rows // 2, rows // 4, 3 * rows // 4), (cols // 2, cols // 4, 3 * cols // 4)):
+            if np.isnan(lats[row, col]) or np.isnan(lons[row, col]):
+                continue
+            found = (np.abs(other_lats - lats[row, col]) <= tolerance) & \
+                    (np.abs(_lon_diff(other_lons, lons[row, col])) <= tolerance)
+            for other_row, other_col in zip(*np.nonzero(found)):
+                window = _overlap(lats.shape, other_lats.shape, other_row - row, other_col - col)
+                if window and _same_coordinates(lats[window[0]], other_lats[window[1]], tolerance) and \
+                        _same_coordinates(lons[window[0]], other_lons[window[1]], tolerance, lon=True):
+                    return window
+        return None
+
+
+def _lon_diff(lons, other_lons):
+    return (lons - other_lons + 180) % 360 - 180
+
+
+def _overlap(shape, other_shape, shift_rows, shift_cols):
+    # overlapping cells of a grid and of another one where its cell (0, 0) is at (shift_rows, shift_cols)
+    rows = slice(max(0, -shift_rows), min(shape[0], other_shape[0] - shift_rows))
+    cols = slice(max(0, -shift_cols), min(shape[1], other_shape[1] - shift_cols))
+    if rows.start >= rows.stop or cols.start >= cols.stop:
+        return None
+    other_rows = slice(rows.start + shift_rows, rows.stop + shift_rows)
+    other_cols = slice(cols.start + shift_cols, cols.stop + shift_cols)
+    return (rows, cols), (other_rows, other_cols)
+
+
+def _same_coordinates(values, other_values, tolerance, lon=False):
+    diff = _lon_diff(values, other_values) if lon else values - other_values
+    return bool(np.all((np.abs(diff) <= tolerance) | (np.isnan(values) & np.isnan(other_values))))
+
 
 class Dem(Loggable):
 
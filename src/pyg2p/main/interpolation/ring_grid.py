@@ -0,0 +1,233 @@
+"""
+Analytic neighbours search on source grids made of latitude rings: regular_ll, regular_gg and
+reduced (or octahedral) gaussian grids.
+
+Points of these grids lie on rings of constant latitude, each one with its number of equally spaced longitudes
+(the same for all rings of regular grids, the pl array of reduced grids), so the nearest points of a target
+and the quadrilateral enclosing it are found from its latitude and longitude with index arithmetic.
+RingGridIndex answers the same queries as scipy.spatial.cKDTree on the 3D source locations
+(same chordal distances and indexes), in a time linear in the number of targets and without building a tree.
+"""
+import numpy as np
+from numba import njit, prange
+
+# tolerance on lower bounds of ring distances, relative to earth radius.
+# It covers rounding errors of 3D coordinates, computed in single precision for float32 grids
+BOUND_TOLERANCE = 1e-6
+# cosine of latitude below which a point is at a pole, where longitude is meaningless
+POLE_TOLERANCE = 1e-10
+# max longitude step of rings used for enclosing quadrilaterals (corners must be less than 90 degrees away)
+MAX_QUAD_STEP = 45.
+
+
+@njit(cache=True)
+def _ring_position(lon, first_lon, step_lon):
+    # fractional position of longitude lon on a ring
+    return ((lon - first_lon) % 360.0) / step_lon
+
+
+@njit(cache=True)
+def _ring_candidates(ring_size, t, is_global, k, out):
+    # write in out the positions on a ring holding its k nearest longitudes to fractional position t
+    # and return their number. A ring is monotonic in longitude distance: they are contiguous around t
+    window = 2 * k + 2
+    if ring_size <= 2 * window:
+        for i in range(ring_size):
+            out[i] = i
+        return ring_size
+    i0 = np.int64(np.floor(t))
+    if is_global:
+        for w in range(window):
+            out[w] = (i0 - k + w) % ring_size
+        return window
+    if t > ring_size - 1:
+        # outside the grid: the nearest longitudes can be on the eastern or the western border
+        for w in range(window):
+            out[w] = w
+            out[window + w] = ring_size - window + w
+        return 2 * window
+    start = min(max(i0 - k, 0), ring_size - window)
+    for w in range(window):
+        out[w] = start + w
+    return window
+
+
+@njit(cache=True)
+def _insert(best_d, best_i, d, idx):
+    # keep best_d sorted by distance (ties by index)
+    k = best_d.size
+    if d > best_d[k - 1] or (d == best_d[k - 1] and idx >= best_i[k - 1]):
+        return
+    p = k - 1
+    while p > 0 and (best_d[p - 1] > d or (best_d[p - 1] == d and best_i[p - 1] > idx)):
+        best_d[p] = best_d[p - 1]
+        best_i[p] = best_i[p - 1]
+        p -= 1
+    best_d[p] = d
+    best_i[p] = idx
+
+
+@njit(parallel=True, fastmath=False, cache=True)
+def ring_grid_query(points, k, data, ring_lats, ring_offsets, ring_sizes, first_lons, step_lons, global_rings,
+                    pole_rings, radius, distances, indexes):
+    n_rings = ring_lats.size
+    n = data.shape[0]
+    for t in prange(points.shape[0]):
+        px = points[t, 0]
+        py = points[t, 1]
+        pz = points[t, 2]
+        rho = np.sqrt(px * px + py * py + pz * pz)
+        lat = np.arcsin(min(1.0, max(-1.0, pz / rho))) if rho > 0 else 0.0
+        lon = np.degrees(np.arctan2(py, px))
+        at_pole = np.sqrt(px * px + py * py) < POLE_TOLERANCE * rho
+        best_d = distances[t]
+        best_i = indexes[t]
+        for j in range(k):
+            best_d[j] = np.inf
+            best_i[j] = n
+        candidates = np.empty(4 * k + 4, dtype=np.int64)
+        # visit rings by increasing latitude distance, until they are farther than the k-th point found
+        lo = np.searchsorted(ring_lats, lat) - 1
+        hi = lo + 1
+        while lo >= 0 or hi < n_rings:
+            if hi >= n_rings or (lo >= 0 and lat - ring_lats[lo] <= ring_lats[hi] - lat):
+                ring = lo
+                lo -= 1
+            else:
+                ring = hi
+                hi += 1
+            # distance to the closest point of the ring, in the meridian plane of the target
+            bound = rho * rho + radius * radius - 2 * rho * radius * np.cos(lat - ring_lats[ring])
+            if np.sqrt(max(bound, 0.0)) - BOUND_TOLERANCE * radius > best_d[k - 1]:
+                break
+            ring_size = ring_sizes[ring]
+            # all points of the ring are candidates when the ring or the target is at a pole
+            whole_ring = at_pole or pole_rings[ring]
+            if whole_ring:
+                num = ring_size
+            else:
+                pos = _ring_position(lon, first_lons[ring], step_lons[ring])
+                num = _ring_candidates(ring_size, pos, global_rings[ring], k, candidates)
+            for c in range(num):
+                idx = ring_offsets[ring] + (c if whole_ring else candidates[c])
+                dx = px - data[idx, 0]
+                dy = py - data[idx, 1]
+                dz = pz - data[idx, 2]
+                _insert(best_d, best_i, np.sqrt(dx * dx + dy * dy + dz * dz), idx)
+
+
+@njit(cache=True)
+def _ring_bracket(ring, lon, ring_offsets, ring_sizes, first_lons, step_lons, global_rings, out, at):
+    # write in out[at], out[at + 1] the points of the ring west and east of longitude lon
+    ring_size = ring_sizes[ring]
+    pos = _ring_position(lon, first_lons[ring], step_lons[ring])
+    i0 = np.int64(np.floor(pos))
+    if global_rings[ring]:
+        i0 = i0 % ring_size
+        i1 = (i0 + 1) % ring_size
+    elif pos <= ring_size - 1:
+        i0 = min(i0, ring_size - 2)
+        i1 = i0 + 1
+    else:
+        return False
+    out[at] = ring_offsets[ring] + i0
+    out[at + 1] = ring_offsets[ring] + i1
+    return True
+
+
+@njit(parallel=True, fastmath=False, cache=True)
+def ring_grid_quads(lats, lons, ring_lats, ring_offsets, ring_sizes, first_lons, step_lons, global_rings, quad_rings,
+                    quads, found):
+    n_rings = ring_lats.size
+    for t in prange(lats.size):
+        lat = lats[t]
+        lon = lons[t]
+        north = np.searchsorted(ring_lats, lat)
+        found[t] = False
+        if 0 < north < n_rings:
+            # two points on the ring north of the target and two on the ring south of it
+            south = north - 1
+            if quad_rings[north] and quad_rings[south]:
+                found[t] = (_ring_bracket(north, lon, ring_offsets, ring_sizes, first_lons, step_lons, global_rings, quads[t], 0) and
+                            _ring_bracket(south, lon, ring_offsets, ring_sizes, first_lons, step_lons, global_rings, quads[t], 2))
+        else:
+            # polar cap: two points around the target and two on the opposite side of the pole, on the last ring
+            ring = n_rings - 1 if north == n_rings else 0
+            if quad_rings[ring] and global_rings[ring]:
+                found[t] = (_ring_bracket(ring, lon, ring_offsets, ring_sizes, first_lons, step_lons, global_rings, quads[t], 0) and
+                            _ring_bracket(ring, lon + 180, ring_offsets, ring_sizes, first_lons, step_lons, global_rings, quads[t], 2))
+
+
+class RingGridIndex(object):
+    """
+    Neighbours search on a source grid made of latitude rings,
+    with the query interface of scipy.spatial.cKDTree built on data, the 3D source locations
+    """
+
+    def __init__(self, data, ring_lats, ring_offsets, ring_sizes, first_lons, step_lons, radius):
+        self.data = np.ascontiguousarray(data, dtype=np.float64)
+        self.radius = radius
+        # rings sorted by latitude (radians)
+        order = np.argsort(ring_lats, kind='stable')
+        self.ring_lats = np.ascontiguousarray(ring_lats[order])
+        self.ring_offsets = ring_offsets[order].astype(np.int64)
+        self.ring_sizes = ring_sizes[order].astype(np.int64)
+        self.first_lons = first_lons[order].astype(np.float64)
+        self.step_lons = step_lons[order].astype(np.float64)
+        self.global_rings = np.abs(self.step_lons * self.ring_sizes - 360) < self.step_lons * 1e-3
+        self.pole_rings = np.abs(np.cos(self.ring_lats)) < POLE_TOLERANCE
+        self.quad_rings = ~self.pole_rings & (self.ring_sizes > 1) & (self.step_lons <= MAX_QUAD_STEP)
+
+    @classmethod
+    def from_grid(cls, data, latgrib, longrib, radius):
+        """
+        Return the index of source locations data, or None if latgrib, longrib are not rings of
+        constant latitude with equally spaced longitudes (e.g. j consecutive scanning)
+        """
+        lats = np.ravel(latgrib)
+        lons = np.ravel(longrib).astype(np.float64)
+        if lats.size < 2:
+            return None
+        starts = np.flatnonzero(np.r_[True, lats[1:] != lats[:-1]])
+        sizes = np.diff(np.r_[starts, lats.size])
+        if np.unique(lats[starts]).size != starts.size:
+            return None
+        # longitude steps inside rings must be the first one of their ring
+        steps = np.diff(lons) % 360
+        inside = np.ones(steps.size, dtype=bool)
+        inside[starts[1:] - 1] = False
+        first_steps = np.where(sizes > 1, steps[np.minimum(starts, steps.size - 1)], 360.)
+        ring_steps = np.repeat(first_steps, sizes)[:-1][inside]
+        if (first_steps == 0).any() or not np.allclose(steps[inside], ring_steps, rtol=0, atol=first_steps.min() * 1e-3):
+            return None
+        # step of rings, from their first and last longitudes
+        step_lons = np.where(sizes > 1, (lons[starts + sizes - 1] - lons[starts]) % 360 / np.maximum(sizes - 1, 1), 360.)
+        return cls(data, np.radians(lats[starts].astype(np.float64)), starts, sizes, lons[starts], step_lons, radius)
+
+    def query(self, x, k=1, workers=1):
+        # workers is accepted for cKDTree compatibility: the search runs on numba threads
+        x = np.asarray(x, dtype=np.float64)
+        points = x.reshape(-1, 3)
+        distances = np.empty((points.shape[0], k), dtype=np.float64)
+        indexes = np.empty((points.shape[0], k), dtype=np.int64)
+        ring_grid_query(np.ascontiguousarray(points), k, self.data, self.ring_lats, self.ring_offsets, self.ring_sizes,
+                        self.first_lons, self.step_lons, self.global_rings, self.pole_rings, float(self.radius),
+                        distances, indexes)
+        shape = x.shape[:-1]
+        if k == 1:
+            return distances.reshape(shape), indexes.reshape(shape)
+        return distances.reshape(shape + (k,)), indexes.reshape(shape + (k,))
+
+    def enclosing(self, lats, lons):
+        """
+        Return the quadrilaterals enclosing target points (degrees): indexes of two points on the ring north of them
+        and two on the ring south of them (on the other side of the pole for points beyond the last rings),
+        and a mask of points with a quadrilateral
+        """
+        lats = np.radians(np.asarray(lats, dtype=np.float64))
+        lons = np.asarray(lons, dtype=np.float64)
+        quads = np.zeros((lats.size, 4), dtype=np.int64)
+        found = np.zeros(lats.size, dtype=bool)
+        ring_grid_quads(lats, lons, self.ring_lats, self.ring_offsets, self.ring_sizes, self.first_lons, self.step_lons,
+                        self.global_rings, self.quad_rings, quads, found)
+        return quads, found
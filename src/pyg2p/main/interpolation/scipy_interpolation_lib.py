@@ -1,4 +1,9 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from math import radians
+import mmap
+import multiprocessing
+import os
 from sys import stdout
 import time
 
@@ -16,11 +21,12 @@ from ...exceptions import ApplicationException, WEIRD_STUFF, INVALID_INTERPOL_ME
 from pyg2p.util.numeric import mask_it, empty
 from pyg2p.util.generics import progress_step_and_backchar
 from pyg2p.util.strings import now_string
+from pyg2p.main.interpolation.ring_grid import RingGridIndex
 
 #from matplotlib import pyplot as plt
-from scipy.integrate import quad
 
-from numba import njit
+import numba
+from numba import njit, prange
 
 
 DEBUG_BILINEAR_INTERPOLATION = False
@@ -314,9 +320,452 @@ def isPointInQuadrilateral(pt, v1, v2, v3, v4, is_convex):
     is_in_t2 = isPointInTriangle(pt, v1,v4,v3)
     return is_in_t1 or is_in_t2
 
-# used in triangulation for the evaluation of space between vertical grid in grib non regular grid files
-def integrand(x):
-    return 1/np.cos(x)
+# used in triangulation for the evaluation of space between vertical grid in grib non regular grid files:
+# integral of 1/cos(x) from 0 to the latitude (in radians), that is the Mercator projection of latitudes
+def stretched_latitudes(lats):
+    lats = np.radians(lats)
+    return np.sign(lats) * np.log(1 / np.cos(np.abs(lats)) + np.tan(np.abs(lats)))
+
+
+###########################################################################################
+###### numba versions of the functions above, used by the parallel bilinear weights ########
+###### corners are 4x4 arrays with rows [lat, lon, value, index] as in _build_weights_bilinear
+###########################################################################################
+
+# status of target points while building bilinear weights
+BILINEAR_ACTIVE = 0         # a replacement of corners is pending
+BILINEAR_OK = 1             # point falls in the quadrilateral
+BILINEAR_NOT_IN_QUAD = 2    # max_retries reached
+BILINEAR_OUT = 3            # point outside the grib bounding box or too far from grib points
+BILINEAR_NEAREST = 4        # no 4 distinct points found on the opposite side of the globe, take the nearest one
+BILINEAR_NO_VERTEX = 5      # non convex quadrilateral without a non convex vertex (should never happen)
+
+# replacement of corners requested by a target point to the KDTree
+REPLACE_NONE = 0
+REPLACE_NEXT = 1            # replaceIndex
+REPLACE_OPPOSITE_SIDE = 2   # replaceIndexOppositeSide
+REPLACE_CLOSE_TO_POINT = 3  # replaceIndexCloseToPoint
+
+
+@njit(cache=True)
+def nb_lon_reference_system(lon_in, corners):
+    if lon_in < -90:
+        # use the reference system with lon in range [-360, 0]
+        for n in range(4):
+            if corners[n, 1] > 0:
+                corners[n, 1] -= 360
+    elif lon_in > 90:
+        # use the reference system with lon in range [0, 360]
+        for n in range(4):
+            if corners[n, 1] < 0:
+                corners[n, 1] += 360
+
+
+# same as get_correct_lats_lons, filling the corners array
+@njit(cache=True)
+def nb_get_corners(lat_in, lon_in, latgrib, longrib, z, ix, corners):
+    for n in range(4):
+        i = ix[n]
+        corners[n, 0] = latgrib[i]
+        corners[n, 1] = longrib[i]
+        if corners[n, 1] > 180:
+            corners[n, 1] = corners[n, 1] - 360
+        corners[n, 2] = z[i]
+        corners[n, 3] = i
+    nb_lon_reference_system(lon_in, corners)
+    for n in range(4):
+        if abs(lon_in - corners[n, 1]) > 90:
+            i = ix[n]
+            corners[n, 0] = 180 * np.sign(latgrib[i]) - latgrib[i]
+            corners[n, 1] = (corners[n, 1] + 180) % 360
+            if corners[n, 1] > 180:
+                corners[n, 1] = corners[n, 1] - 360
+    nb_lon_reference_system(lon_in, corners)
+
+
+# same as getWrongPointDirection: wrong points indexes are written in out, returns their number
+@njit(cache=True)
+def nb_get_wrong_point_direction(lat_in, lon_in, corners, out):
+    count = 0
+    # points with exacly the same lat and lon of a previous one
+    for i in range(4):
+        for j in range(i):
+            if corners[i, 0] == corners[j, 0] and corners[i, 1] == corners[j, 1]:
+                out[count] = corners[i, 3]
+                count += 1
+                break
+    if count > 0:
+        return count
+
+    w = 0.01
+    alive = np.empty(4, dtype=np.bool_)
+    for side in range(2):
+        # side 0: points up (lat <= lat_in), side 1: points down
+        n_alive = 0
+        for i in range(4):
+            alive[i] = (corners[i, 0] <= lat_in) == (side == 0)
+            if alive[i]:
+                n_alive += 1
+        while n_alive > 2:
+            farthest = -1
+            max_distance = 0.
+            for i in range(4):
+                if alive[i]:
+                    distance = abs(corners[i, 0] - lat_in) + w * abs(corners[i, 1] - lon_in)
+                    if farthest < 0 or distance > max_distance:
+                        farthest = i
+                        max_distance = distance
+            point_to_return = corners[farthest, 3]
+            out[count] = point_to_return
+            count += 1
+            for i in range(4):
+                if alive[i] and corners[i, 3] == point_to_return:
+                    alive[i] = False
+                    n_alive -= 1
+    return count
+
+
+# rows of the two points up (lat <= lat_in) and of the two points down
+@njit(cache=True)
+def nb_split_up_down(lat_in, corners):
+    up = np.empty(2, dtype=np.int64)
+    down = np.empty(2, dtype=np.int64)
+    n_up = n_down = 0
+    for i in range(4):
+        if corners[i, 0] <= lat_in:
+            up[n_up] = i
+            n_up += 1
+        else:
+            down[n_down] = i
+            n_down += 1
+    return up, down
+
+
+# same as getWrongPointGridLikeShape, returns -1 when there's no wrong point
+# (called only when getWrongPointDirection found two points up and two points down)
+@njit(cache=True)
+def nb_get_wrong_point_grid_like_shape(lat_in, corners):
+    up, down = nb_split_up_down(lat_in, corners)
+    eps = 0.1 * min(abs(corners[0, 0] - lat_in), abs(corners[1, 0] - lat_in),
+                    abs(corners[2, 0] - lat_in), abs(corners[3, 0] - lat_in))
+    d_up0, d_up1 = corners[up[0], 0] - lat_in, corners[up[1], 0] - lat_in
+    d_down0, d_down1 = corners[down[0], 0] - lat_in, corners[down[1], 0] - lat_in
+    if -d_up1 > -d_up0:
+        d_up0, d_up1 = d_up1, d_up0
+        up[0], up[1] = up[1], up[0]
+    if d_down1 > d_down0:
+        d_down0, d_down1 = d_down1, d_down0
+        down[0], down[1] = down[1], down[0]
+    if abs(d_up0 - d_up1) > eps:
+        return corners[up[0], 3]
+    if abs(d_down0 - d_down1) > eps:
+        return corners[down[0], 3]
+    return -1.
+
+
+# same as isPointInTriangle, with vertex given as rows of the corners array
+@njit(cache=True)
+def nb_is_point_in_triangle(lat, lon, corners, v1, v2, v3):
+    d1 = (lat - corners[v2, 0]) * (corners[v1, 1] - corners[v2, 1]) - (corners[v1, 0] - corners[v2, 0]) * (lon - corners[v2, 1])
+    d2 = (lat - corners[v3, 0]) * (corners[v2, 1] - corners[v3, 1]) - (corners[v2, 0] - corners[v3, 0]) * (lon - corners[v3, 1])
+    d3 = (lat - corners[v1, 0]) * (corners[v3, 1] - corners[v1, 1]) - (corners[v3, 0] - corners[v1, 0]) * (lon - corners[v1, 1])
+    has_neg = (d1 < 0) or (d2 < 0) or (d3 < 0)
+    has_pos = (d1 > 0) or (d2 > 0) or (d3 > 0)
+    return not (has_neg and has_pos)
+
+
+# same as getWrongPointBestGridLikeShape, returns (-1, 0, 0) when there's no wrong point
+@njit(cache=True)
+def nb_get_wrong_point_best_grid_like_shape(lat_in, lon_in, corners):
+    closer = 0
+    for i in range(1, 4):
+        if abs(corners[i, 1] - lon_in) < abs(corners[closer, 1] - lon_in):
+            closer = i
+    closer_lon = corners[closer, 1]
+    up, down = nb_split_up_down(lat_in, corners)
+
+    # get the point below, closer to the one above
+    if abs(corners[down[1], 1] - closer_lon) < abs(corners[down[0], 1] - closer_lon):
+        down[0], down[1] = down[1], down[0]
+    distance_below = (corners[down[0], 1] - closer_lon) - (corners[down[1], 1] - closer_lon)
+    # get the point above, closer to the one below
+    if abs(corners[up[1], 1] - closer_lon) < abs(corners[up[0], 1] - closer_lon):
+        up[0], up[1] = up[1], up[0]
+    distance_above = (corners[up[0], 1] - closer_lon) - (corners[up[1], 1] - closer_lon)
+
+    if distance_below * distance_above < 0:
+        if abs(distance_below) >= abs(distance_above):
+            exclude0, exclude1 = down[1], up[1]
+            include0, include1 = down[0], up[0]
+        else:
+            exclude0, exclude1 = up[1], down[1]
+            include0, include1 = up[0], down[0]
+        if nb_is_point_in_triangle(lat_in, lon_in, corners, exclude1, up[0], down[0]):
+            return corners[exclude0, 3], corners[include0, 0], 2 * corners[include0, 1] - corners[exclude0, 1]
+        return corners[exclude1, 3], corners[include1, 0], 2 * corners[include1, 1] - corners[exclude1, 1]
+    return -1., 0., 0.
+
+
+# same as get_clockwise_points: returns rows of p1, p2, p3, p4
+@njit(cache=True)
+def nb_get_clockwise_points(corners):
+    order = np.arange(4)
+    keys = np.empty(4)
+    for i in range(4):
+        keys[i] = corners[i, 1] * 1000 + corners[i, 0]
+    # stable insertion sort, as np.argsort on 4 elements
+    for i in range(1, 4):
+        j = i
+        while j > 0 and keys[order[j]] < keys[order[j - 1]]:
+            order[j], order[j - 1] = order[j - 1], order[j]
+            j -= 1
+    rows = np.empty(4, dtype=np.int64)
+    if corners[order[0], 0] <= corners[order[1], 0]:
+        rows[0], rows[3] = order[0], order[1]
+    else:
+        rows[0], rows[3] = order[1], order[0]
+    if corners[order[2], 0] <= corners[order[3], 0]:
+        rows[1], rows[2] = order[2], order[3]
+    else:
+        rows[1], rows[2] = order[3], order[2]
+    return rows
+
+
+# same as isConvexQuadrilateral for p1, p2, p3, p4 corners rows
+@njit(cache=True)
+def nb_is_convex_quadrilateral(corners, p1, p2, p3, p4):
+    r0, r1 = corners[p3, 0] - corners[p1, 0], corners[p3, 1] - corners[p1, 1]
+    s0, s1 = corners[p4, 0] - corners[p2, 0], corners[p4, 1] - corners[p2, 1]
+    rxs = r0 * s1 - r1 * s0
+    if rxs == 0:
+        return False
+    qp0, qp1 = corners[p2, 0] - corners[p1, 0], corners[p2, 1] - corners[p1, 1]
+    t = (qp0 * s1 - qp1 * s0) / rxs
+    u = (qp0 * r1 - qp1 * r0) / rxs
+    return 0 < t < 1 and 0 < u < 1
+
+
+@njit(cache=True)
+def nb_get_angle(corners, a, b, c):
+    angle = math.degrees(math.atan2(corners[c, 1] - corners[b, 1], corners[c, 0] - corners[b, 0]) -
+                         math.atan2(corners[a, 1] - corners[b, 1], corners[a, 0] - corners[b, 0]))
+    return angle + 360 if angle < 0 else angle
+
+
+# same as getNonConvexVertex, returns -1 if not found
+@njit(cache=True)
+def nb_get_non_convex_vertex(corners, p1, p2, p3, p4):
+    if nb_get_angle(corners, p1, p2, p3) >= 179.9:
+        return corners[p2, 3]
+    if nb_get_angle(corners, p2, p3, p4) >= 179.9:
+        return corners[p3, 3]
+    if nb_get_angle(corners, p3, p4, p1) >= 179.9:
+        return corners[p4, 3]
+    if nb_get_angle(corners, p4, p1, p2) >= 179.9:
+        return corners[p1, 3]
+    return -1.
+
+
+# one retry round of _build_weights_bilinear for each point, until a point falls in its quadrilateral,
+# runs out of retries or needs new corners from the KDTree (requests are then served in batch for all points)
+@njit(parallel=True, fastmath=False, cache=True)
+def bilinear_retry_round(points, lat_in, lon_in, latgrib, longrib, z, indexes, idxs, additional_points,
+                         additional_checks_completed, status, requests, wrong_points, wrong_count,
+                         request_latlon, clockwise_indexes, has_clockwise, max_retries, latgrib_min, latgrib_max,
+                         skip_convexity):
+    for t in prange(points.size):
+        nn = points[t]
+        requests[nn] = REPLACE_NONE
+        corners = np.empty((4, 4))
+        wrong = np.empty(4)
+        while additional_points[nn] < max_retries:
+            for j in range(4):
+                idxs[nn, j] = indexes[nn, j]
+            nb_get_corners(lat_in[nn], lon_in[nn], latgrib, longrib, z, indexes[nn], corners)
+
+            if not additional_checks_completed[nn]:
+                count = nb_get_wrong_point_direction(lat_in[nn], lon_in[nn], corners, wrong)
+                if count > 0:
+                    for j in range(count):
+                        wrong_points[nn, j] = wrong[j]
+                    wrong_count[nn] = count
+                    if lat_in[nn] > latgrib_max or lat_in[nn] < latgrib_min:
+                        requests[nn] = REPLACE_OPPOSITE_SIDE
+                    else:
+                        additional_points[nn] += count
+                        requests[nn] = REPLACE_NEXT
+                    break
+                wrong_point = nb_get_wrong_point_grid_like_shape(lat_in[nn], corners)
+                if wrong_point >= 0:
+                    wrong_points[nn, 0] = wrong_point
+                    wrong_count[nn] = 1
+                    additional_points[nn] += 1
+                    requests[nn] = REPLACE_NEXT
+                    break
+                wrong_point, new_lat, new_lon = nb_get_wrong_point_best_grid_like_shape(lat_in[nn], lon_in[nn], corners)
+                if wrong_point >= 0:
+                    wrong_points[nn, 0] = wrong_point
+                    wrong_count[nn] = 1
+                    request_latlon[nn, 0] = new_lat
+                    request_latlon[nn, 1] = new_lon
+                    requests[nn] = REPLACE_CLOSE_TO_POINT
+                    break
+                additional_checks_completed[nn] = True
+
+            p = nb_get_clockwise_points(corners)
+            for j in range(4):
+                clockwise_indexes[nn, j] = np.int64(corners[p[j], 3])
+            has_clockwise[nn] = True
+            if not (skip_convexity or nb_is_convex_quadrilateral(corners, p[0], p[1], p[2], p[3])):
+                wrong_point = nb_get_non_convex_vertex(corners, p[0], p[1], p[2], p[3])
+                if wrong_point < 0:
+                    status[nn] = BILINEAR_NO_VERTEX
+                    break
+                wrong_points[nn, 0] = wrong_point
+            elif (nb_is_point_in_triangle(lat_in[nn], lon_in[nn], corners, p[0], p[1], p[2]) or
+                  nb_is_point_in_triangle(lat_in[nn], lon_in[nn], corners, p[0], p[3], p[2])):
+                status[nn] = BILINEAR_OK
+                break
+            else:
+                # get rid of the actual farthest point
+                wrong_points[nn, 0] = indexes[nn, 3]
+            wrong_count[nn] = 1
+            additional_points[nn] += 1
+            requests[nn] = REPLACE_NEXT
+            break
+
+        if requests[nn] == REPLACE_NONE and status[nn] == BILINEAR_ACTIVE:
+            status[nn] = BILINEAR_NOT_IN_QUAD
+
+
+# replace wrong corners of points with replacement indexes found by the KDTree (farthest ones first),
+# as in replaceIndex (exclude_current=True) and replaceIndexCloseToPoint
+@njit(parallel=True, fastmath=False, cache=True)
+def bilinear_replace_points(points, indexes, wrong_points, wrong_count, replacement_indexes, exclude_current):
+    for t in prange(points.size):
+        nn = points[t]
+        replacements = np.empty(replacement_indexes.shape[1], dtype=np.int64)
+        n_replacements = 0
+        for r in replacement_indexes[t]:
+            if exclude_current and (r == indexes[nn, 0] or r == indexes[nn, 1] or r == indexes[nn, 2] or r == indexes[nn, 3]):
+                continue
+            replacements[n_replacements] = r
+            n_replacements += 1
+        for n in range(min(wrong_count[nn], n_replacements)):
+            for j in range(4):
+                if indexes[nn, j] == wrong_points[nn, n]:
+                    indexes[nn, j] = replacements[n_replacements - 1 - n]
+
+
+# solve _functionAlphaBeta with Newton's method for the p1, p2, p3, p4 rows of p.
+# Returns alpha, beta and False if it didn't converge in the [0, 1] range
+@njit(cache=True)
+def nb_solve_alpha_beta(p, lat_in, lon_in):
+    a, b = 0.5, 0.5
+    for _ in range(50):
+        f0 = (1-a)*(1-b)*p[0, 0] + a*(1-b)*p[1, 0] + a*b*p[2, 0] + (1-a)*b*p[3, 0] - lat_in
+        f1 = (1-a)*(1-b)*p[0, 1] + a*(1-b)*p[1, 1] + a*b*p[2, 1] + (1-a)*b*p[3, 1] - lon_in
+        j00 = -(1-b)*p[0, 0] + (1-b)*p[1, 0] + b*p[2, 0] - b*p[3, 0]
+        j01 = -(1-a)*p[0, 0] - a*p[1, 0] + a*p[2, 0] + (1-a)*p[3, 0]
+        j10 = -(1-b)*p[0, 1] + (1-b)*p[1, 1] + b*p[2, 1] - b*p[3, 1]
+        j11 = -(1-a)*p[0, 1] - a*p[1, 1] + a*p[2, 1] + (1-a)*p[3, 1]
+        det = j00 * j11 - j01 * j10
+        if det == 0 or not np.isfinite(det):
+            break
+        da = (f0 * j11 - f1 * j01) / det
+        db = (j00 * f1 - j10 * f0) / det
+        a -= da
+        b -= db
+        if abs(da) <= 1e-13 and abs(db) <= 1e-13:
+            return a, b, -1e-9 <= a <= 1 + 1e-9 and -1e-9 <= b <= 1 + 1e-9
+    return a, b, False
+
+
+# alpha and beta of _build_weights_bilinear, for the quadrilaterals of owners points
+@njit(parallel=True, fastmath=False, cache=True)
+def bilinear_alpha_beta(points, owners, lat_in, lon_in, latgrib, longrib, z, clockwise_indexes):
+    alpha = np.empty(points.size)
+    beta = np.empty(points.size)
+    converged = np.zeros(points.size, dtype=np.bool_)
+    for t in prange(points.size):
+        nn = points[t]
+        owner = owners[t]
+        p = np.empty((4, 4))
+        nb_get_corners(lat_in[owner], lon_in[owner], latgrib, longrib, z, clockwise_indexes[owner], p)
+        alpha[t], beta[t], converged[t] = nb_solve_alpha_beta(p, lat_in[nn], lon_in[nn])
+    return alpha, beta, converged
+
+
+# p1, p2, p3, p4 (clockwise) of the quadrilaterals enclosing points, as found by RingGridIndex.enclosing
+@njit(parallel=True, fastmath=False, cache=True)
+def bilinear_clockwise_quads(points, quads, lat_in, lon_in, latgrib, longrib, z, clockwise_indexes):
+    for t in prange(points.size):
+        nn = points[t]
+        corners = np.empty((4, 4))
+        nb_get_corners(lat_in[nn], lon_in[nn], latgrib, longrib, z, quads[t], corners)
+        p = nb_get_clockwise_points(corners)
+        for j in range(4):
+            clockwise_indexes[nn, j] = np.int64(corners[p[j], 3])
+
+
+# index (0, 1 or 2) of the neighbour triangle to join to each triangle in bilinear_delaunay interpolation:
+# the one on the longest side (opposite to the widest angle)
+@njit(parallel=True, fastmath=False, cache=True)
+def triangulation_neighbour_sides(gribpoints_scaled, vertex):
+    sides = np.zeros(vertex.shape[0], dtype=np.int64)
+    for nn in prange(vertex.shape[0]):
+        angle0 = nb_get_angle(gribpoints_scaled, vertex[nn, 2], vertex[nn, 0], vertex[nn, 1])
+        if angle0 > 180:
+            angle0 = 360 - angle0
+        if angle0 >= 90:
+            continue
+        angle1 = nb_get_angle(gribpoints_scaled, vertex[nn, 0], vertex[nn, 1], vertex[nn, 2])
+        if angle1 > 180:
+            angle1 = 360 - angle1
+        angle2 = 180 - angle0 - angle1
+        if angle1 > angle0 and angle1 >= angle2:
+            sides[nn] = 1
+        elif angle2 > angle0 and angle2 > angle1:
+            sides[nn] = 2
+    return sides
+
+
+# join triangles in pairs, in the order of the target points falling in them
+@njit(cache=True)
+def triangulation_pairs(points, triangles, neighbours, sides, num_triangles):
+    pairs = np.full(num_triangles, -1, dtype=np.int64)
+    for nn in points:
+        neighbour = neighbours[nn, sides[nn]]
+        if neighbour > -1 and pairs[triangles[nn]] == -1 and pairs[neighbour] == -1:
+            pairs[triangles[nn]] = neighbour
+            pairs[neighbour] = triangles[nn]
+    return pairs
+
+
+# alpha and beta of bilinear interpolation on the quadrilaterals made by idxs vertex.
+# Returns also the vertex in clockwise order
+@njit(parallel=True, fastmath=False, cache=True)
+def triangulation_alpha_beta(points, lat_in, lon_in, latgrib, longrib, z, idxs):
+    alpha = np.empty(points.size)
+    beta = np.empty(points.size)
+    converged = np.zeros(points.size, dtype=np.bool_)
+    clockwise_indexes = np.empty((points.size, 4), dtype=np.int64)
+    for t in prange(points.size):
+        nn = points[t]
+        corners = np.empty((4, 4))
+        for j in range(4):
+            i = idxs[nn, j]
+            corners[j, 0] = latgrib[i]
+            corners[j, 1] = longrib[i]
+            corners[j, 2] = z[i]
+            corners[j, 3] = i
+        rows = nb_get_clockwise_points(corners)
+        p = np.empty((4, 4))
+        for j in range(4):
+            p[j] = corners[rows[j]]
+            clockwise_indexes[t, j] = idxs[nn, rows[j]]
+        alpha[t], beta[t], converged[t] = nb_solve_alpha_beta(p, lat_in[nn], lon_in[nn])
+    return alpha, beta, converged, clockwise_indexes
 
 
 @njit(parallel=True, fastmath=False, cache=True)
@@ -513,6 +962,88 @@ def adw_and_cdd_compute_weights_directional_in_broadcasting(
     return weight_directional
 
 
+# estimated memory used to interpolate a target point, as (bytes, bytes per neighbour):
+# target coordinates, KDTree query results, weights and temporaries of each mode (peak RSS measured on ERA5 grids)
+SUBSET_BYTES_PER_POINT = {'nearest': (96, 16), 'invdist': (96, 64), 'adw': (96, 128), 'cdd': (96, 128),
+                          'bilinear': (320, 64), 'bilinear_rings': (320, 64), 'triangulation': (192, 48), 'bilinear_delaunay': (192, 48)}
+# additional bytes per pair of neighbours of adw and cdd directional weights computed in broadcasting
+BROADCASTING_BYTES_PER_PAIR = 24
+# estimated memory used for a source point: coordinates, value and KDTree (and Delaunay triangulation)
+SOURCE_BYTES_PER_POINT = 160
+DELAUNAY_BYTES_PER_POINT = 2048
+
+# modes pruning source points far from the target before building the KDTree
+# (Delaunay triangulations depend on the extent of the whole grid)
+PRUNED_MODES = ('nearest', 'invdist', 'adw', 'cdd', 'bilinear', 'bilinear_rings')
+# source grid is pruned only if less than this fraction of its points is kept
+PRUNE_MAX_FRACTION = 0.5
+# number of neighbours of sampled target points that must lie within the halo (or 4 times nnear if more)
+PRUNE_HALO_NEIGHBOURS = 24
+# target points sampled to check the halo: borders and one row and column every PRUNE_SAMPLE_STEP
+PRUNE_SAMPLE_STEP = 8
+# angular tolerance (radians) of the check that queried target points lie in the box of the pruned target
+PRUNE_BOX_TOLERANCE = 1e-9
+
+
+def lon_arc(lons):
+    # smallest arc covering longitudes, as (west, width) in degrees, on 1 degree bins: it is the complement of the widest gap
+    occupied = np.flatnonzero(np.bincount(np.floor(np.mod(lons, 360)).astype(int) % 360, minlength=360))
+    gaps = np.diff(np.append(occupied, occupied[0] + 360))
+    widest = np.argmax(gaps)
+    return float(occupied[(widest + 1) % occupied.size]), float(360 - gaps[widest] + 1)
+
+
+def halo_mask(lats, lons, lat_min, lat_max, arc, halo):
+    # mask of points at an angular distance less than halo (radians) from the box of latitudes [lat_min, lat_max] and longitudes arc.
+    # Longitudes are widened by the halo at the latitude of the box farthest from the equator
+    lat_min, lat_max = lat_min - np.degrees(halo), lat_max + np.degrees(halo)
+    mask = (lats >= lat_min) & (lats <= lat_max)
+    west, width = arc
+    if lat_min > -90 and lat_max < 90:
+        # points at distance halo from latitude phi are within arcsin(sin(halo) / cos(phi)) in longitude
+        sin_lon = np.sin(halo) / np.cos(np.radians(max(abs(lat_min), abs(lat_max))))
+        delta = np.degrees(np.arcsin(sin_lon)) if sin_lon < 1 else 180.
+        if width + 2 * delta < 360:
+            mask &= np.mod(lons - (west - delta), 360) <= width + 2 * delta
+    return mask
+
+# state of the running ScipyInterpolation.interpolate_subsets call, inherited by forked workers computing target subsets
+_SPLIT_STATE = None
+
+
+def shared_empty(shape, dtype):
+    # array in anonymous shared memory: writes of forked processes are visible to the parent
+    dtype = np.dtype(dtype)
+    buffer = mmap.mmap(-1, max(1, int(np.prod(shape)) * dtype.itemsize))
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def _fork_safe():
+    # TBB (and GNU OpenMP) thread pools started by numba kernels in this process are broken by fork:
+    # the process hangs at exit
+    try:
+        return numba.threading_layer() == 'workqueue'
+    except ValueError:
+        # no parallel kernel was run yet
+        return True
+
+
+def _interpolate_subset(slot, start, stop):
+    # runs in a worker process: parallelism comes from the other workers
+    interpolation, lonefas, latefas, ref_radius, result, weights, indexes, threads = _SPLIT_STATE
+    interpolation.njobs = 1
+    numba.set_num_threads(threads)
+
+    # Call the interpolate function for the subset
+    subset_result, subset_weights, subset_indexes = interpolation.interpolate_split(lonefas[start:stop, :], latefas[start:stop, :], ref_radius)
+
+    # Write the results in the slot of this subset
+    size = (stop - start) * lonefas.shape[1]
+    weights[slot, :size] = subset_weights
+    indexes[slot, :size] = subset_indexes
+    result[slot, :size] = subset_result
+
+
 class ScipyInterpolation(object):
     """
     http://docs.scipy.org/doc/scipy/reference/spatial.html
@@ -523,12 +1054,13 @@ class ScipyInterpolation(object):
     def __init__(self, longrib, latgrib, grid_details, source_values, nnear, 
                     mv_target, mv_source, target_is_rotated=False, parallel=False,
                     mode='nearest', cdd_map='', cdd_mode='', cdd_options = None, use_broadcasting = False,
-                    num_of_splits = None):
+                    num_of_splits = None, max_memory = None, checkpoint = None, geometry = None):
         stdout.write('Start scipy interpolation: {}\n'.format(now_string()))
         self.geodetic_info = grid_details
         self.source_grid_is_rotated = 'rotated' in grid_details.get('gridType')
         self.target_grid_is_rotated = target_is_rotated
-        self.njobs = 1 if not parallel else -1
+        # parallel is True to use all CPUs, or the number of workers
+        self.njobs = 1 if not parallel else -1 if parallel is True else int(parallel)
         
         self.longrib = longrib
         self.latgrib = latgrib
@@ -539,6 +1071,12 @@ class ScipyInterpolation(object):
         self.cdd_options = cdd_options
         self.use_broadcasting = use_broadcasting
         self.num_of_splits = num_of_splits
+        # memory budget in bytes: target rows are interpolated in subsets fitting it
+        self.max_memory = max_memory
+        # pyg2p.main.interpolation.checkpoint.Checkpoint saving completed subsets
+        self.checkpoint = checkpoint
+        # pyg2p.main.interpolation.geometry.SourceGeometry caching KDTree, resolution and triangulation of source grid
+        self.geometry = geometry
         
         if DEBUG_ADW_INTERPOLATION:
             self.use_broadcasting = True
@@ -546,73 +1084,383 @@ class ScipyInterpolation(object):
         self._mv_target = mv_target
         self._mv_source = mv_source
         self.z = source_values
-        
-        # we receive rotated coords from GRIB_API iterator before 1.14.3
-        x, y, zz = self.to_3d(longrib, latgrib, to_regular=not self.rotated_bugfix_gribapi)
-        source_locations = np.vstack((x.ravel(), y.ravel(), zz.ravel())).T
+        self.source_size = len(source_values)
         try:
-            assert len(source_locations) == len(source_values), "len(coordinates) {} != len(values) {}".format(len(source_locations), len(source_values))
+            assert np.size(latgrib) == len(source_values), "len(coordinates) {} != len(values) {}".format(np.size(latgrib), len(source_values))
         except AssertionError as e:
             ApplicationException.get_exc(WEIRD_STUFF, details=str(e))
 
-        stdout.write('Building KDTree...\n')
-        self.tree = KDTree(source_locations, leafsize=30)  # build the tree
+        # indexes in the whole source grid of the points kept by _prune_source (None if not pruned)
+        self.source_indexes = None
+        # pruned source points whose distance to the nearest point is the same as in the whole grid
+        self._resolution_points = None
+        self._is_global_source = None
+        # whole source grid (latgrib, longrib, z) and (lat_min, lat_max, arc, halo) of the pruned one
+        self._whole_source = None
+        self._pruned_box = None
+        # KDTree and min_upper_bound are built on first use, after the source is pruned (if it is)
+        self._tree = self._ring_grid_index()
+        self._min_upper_bound = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = self._source_geometry('kdtree', self._build_tree)
+        return self._tree
+
+    @tree.setter
+    def tree(self, tree):
+        self._tree = tree
+
+    @property
+    def min_upper_bound(self):
+        if self.mode == 'adw':
+            # not used in adw (Shepard) algorithm
+            return None
+        if self._min_upper_bound is None:
+            self._min_upper_bound = self._source_geometry('min_upper_bound', self._source_resolution)
+        return self._min_upper_bound
+
+    @min_upper_bound.setter
+    def min_upper_bound(self, min_upper_bound):
+        self._min_upper_bound = min_upper_bound
+
+    def _source_geometry(self, name, compute):
+        # source grid structures are reused from (and saved to) the geometry cache, if any.
+        # Structures of a pruned source grid depend on the target and are not cached
+        if self.geometry is None or self.source_indexes is not None:
+            return compute()
+        return self.geometry.get(name, compute)
+
+    def _source_locations(self):
+        # we receive rotated coords from GRIB_API iterator before 1.14.3
+        x, y, zz = self.to_3d(self.longrib, self.latgrib, to_regular=not self.rotated_bugfix_gribapi)
+        return np.vstack((x.ravel(), y.ravel(), zz.ravel())).T
 
-        if self.mode == "adw":
-            self.min_upper_bound = None # not used in adw (Shepard) algorithm
+    def _build_tree(self):
+        source_locations = self._source_locations()
+        stdout.write('Building KDTree...\n')
+        return KDTree(source_locations, leafsize=30)  # build the tree
+
+    def _ring_grid_index(self):
+        # neighbours in regular and reduced gaussian grids are found analytically from their latitude rings, without KDTree
+        if self.source_grid_is_rotated or self.geodetic_info.get('gridType') not in ('regular_ll', 'regular_gg', 'reduced_gg'):
+            return None
+        index = RingGridIndex.from_grid(self._source_locations(), self.latgrib, self.longrib,
+                                        self.geodetic_info.get('radius'))
+        if index is not None:
+            stdout.write('Using analytic index of {} source grid\n'.format(self.geodetic_info.get('gridType')))
+        return index
+
+    def _source_resolution(self):
+        # we can calculate resolution in KM as described here:
+        # http://math.boisestate.edu/~wright/montestigliano/NearestNeighborSearches.pdf
+        # sphdist = R*acos(1-maxdist^2/2);
+        # Finding actual resolution of source GRID
+        points = self.tree.data if self._resolution_points is None else self.tree.data[self._resolution_points]
+        distances, indexes = self.tree.query(points, k=2, workers=self.njobs)
+        # set max of distances as min upper bound and add an empirical correction value
+        return np.max(distances) + np.max(distances) * 4 / self.geodetic_info.get('Nj')
+
+    def _prune_source(self, lonefas, latefas):
+        """
+        Keep only source points around the target (its box of latitudes and longitudes and a halo) before the KDTree is built.
+        The halo is widened until the nearest PRUNE_HALO_NEIGHBOURS source points of sampled target points lie within it,
+        so that neighbours found in the pruned grid are the ones of the whole grid. Neighbours of all target points are
+        checked again when queried (see _query_tree).
+        Indexes of results are mapped back to the whole grid by interpolate_split
+        """
+        # old GRIB_API gives rotated coordinates of rotated grids
+        if self._tree is not None or self.mode not in PRUNED_MODES or not self.rotated_bugfix_gribapi or DEBUG_ADW_INTERPOLATION:
+            return
+        if self.target_grid_is_rotated:
+            # coordinates of target points in the regular frame of source coordinates
+            x, y, z = self.to_3d(lonefas, latefas, to_regular=True)
+            target_lats, target_lons = np.degrees(np.arcsin(np.clip(z / self.geodetic_info.get('radius'), -1, 1))), np.degrees(np.arctan2(y, x))
         else:
-            # we can calculate resolution in KM as described here:
-            # http://math.boisestate.edu/~wright/montestigliano/NearestNeighborSearches.pdf
-            # sphdist = R*acos(1-maxdist^2/2);
-            # Finding actual resolution of source GRID
-            distances, indexes = self.tree.query(source_locations, k=2, workers=self.njobs)
-            # set max of distances as min upper bound and add an empirical correction value
-            self.min_upper_bound = np.max(distances) + np.max(distances) * 4 / self.geodetic_info.get('Nj')
+            target_lats, target_lons = latefas, lonefas
+        finite = np.isfinite(target_lats) & np.isfinite(target_lons)
+        if not finite.any():
+            return
+        lat_min, lat_max = target_lats[finite].min(), target_lats[finite].max()
+        arc = lon_arc(target_lons[finite])
+
+        rows, cols = lonefas.shape
+        sample_rows = np.unique(np.r_[0:rows:PRUNE_SAMPLE_STEP, rows - 1])
+        sample_cols = np.unique(np.r_[0:cols:PRUNE_SAMPLE_STEP, cols - 1])
+        sample = [a[np.ix_(sample_rows, sample_cols)].ravel() for a in (lonefas, latefas)]
+        sample = [np.concatenate((s, a[0, :], a[-1, :], a[:, 0], a[:, -1])) for s, a in zip(sample, (lonefas, latefas))]
+        x, y, z = self.to_3d(sample[0], sample[1], to_regular=self.target_grid_is_rotated)
+        sample_locations = np.vstack((x, y, z)).T[np.isfinite(x)]
+
+        latgrib, longrib = np.ravel(self.latgrib), np.ravel(self.longrib)
+        source_locations = self._source_locations()
+        radius = self.geodetic_info.get('radius')
+        k = max(PRUNE_HALO_NEIGHBOURS, 4 * self.nnear)
+        # first halo from the distance of consecutive points (grid spacing along rows)
+        halo = np.median(np.linalg.norm(np.diff(source_locations, axis=0), axis=1)) / radius * (2 + np.sqrt(k))
+        while True:
+            keep = halo_mask(latgrib, longrib, lat_min, lat_max, arc, halo)
+            kept = np.count_nonzero(keep)
+            if kept > PRUNE_MAX_FRACTION * keep.size:
+                return
+            if kept >= k:
+                tree = KDTree(source_locations[keep], leafsize=30)
+                distances, _ = tree.query(sample_locations, k=k, workers=self.njobs)
+                # pruned points are farther than the chord of the halo from all target points
+                if distances[:, -1].max() < 2 * radius * np.sin(halo / 2):
+                    break
+            halo *= 2
+
+        stdout.write('Source grid pruned around target: {} of {} points\n'.format(kept, keep.size))
+        self._is_global_source = self._is_global_map(self.longrib)
+        self._whole_source = (self.latgrib, self.longrib, self.z)
+        self._pruned_box = (lat_min, lat_max, arc, halo)
+        self.source_indexes = np.flatnonzero(keep)
+        self.latgrib, self.longrib = latgrib[keep], longrib[keep]
+        self.z = self.z[keep]
+        inner = halo_mask(self.latgrib, self.longrib, lat_min, lat_max, arc, halo / 2)
+        self._resolution_points = np.flatnonzero(inner) if inner.any() else None
+        self._tree = tree
+
+    def _restore_source(self):
+        # back to the whole source grid, after a query found neighbours that may have been pruned
+        self.latgrib, self.longrib, self.z = self._whole_source
+        self.source_indexes = self._resolution_points = self._is_global_source = None
+        self._whole_source = self._pruned_box = None
+        self._tree = None
+
+    def _query_tree(self, locations, k):
+        distances, indexes = self.tree.query(locations, k=k, workers=self.njobs)
+        if self.source_indexes is None:
+            return distances, indexes
+        # neighbours found in the pruned grid are the ones of the whole grid if points are in the target box
+        # and their k-th neighbour is nearer than the pruned points, that lie beyond the halo
+        lat_min, lat_max, arc, halo = self._pruned_box
+        radius = self.geodetic_info.get('radius')
+        finite = np.isfinite(locations).all(axis=1)
+        lats = np.degrees(np.arcsin(np.clip(locations[finite, 2] / radius, -1, 1)))
+        lons = np.degrees(np.arctan2(locations[finite, 1], locations[finite, 0]))
+        farthest = distances[finite] if k == 1 else distances[finite, -1]
+        inside = halo_mask(lats, lons, lat_min, lat_max, arc, PRUNE_BOX_TOLERANCE)
+        if not inside.all() or (farthest >= 2 * radius * np.sin((halo - PRUNE_BOX_TOLERANCE) / 2)).any():
+            stdout.write('Neighbours may lie out of the pruned source grid: using the whole source grid\n')
+            self._restore_source()
+            distances, indexes = self.tree.query(locations, k=k, workers=self.njobs)
+        return distances, indexes
+
+    def _is_global_map(self, longrib):
+        if self._is_global_source is not None:
+            # the source grid was pruned
+            return self._is_global_source
+        # evaluate an approx_grib_resolution by using 10 times the first longidure values
+        # to check if the whole globe is covered
+        approx_grib_resolution = abs(longrib[0]-longrib[1])*1.5
+        return (360-(longrib.max()-longrib.min()))<approx_grib_resolution
 
     def interpolate(self, lonefas, latefas):        
-        if (self.num_of_splits is not None):
-            ref_radius = None
-            if self.mode == 'adw' and self.nnear == 11:
-                start = time.time()
-                stdout.write('Finding global reference radius {} interpolation k=7\n'.format(self.mode))
-                x, y, z = self.to_3d(lonefas, latefas, to_regular=self.target_grid_is_rotated)
-                efas_locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
-                distances, indexes = self.tree.query(efas_locations, k=7, workers=self.njobs) 
-                if efas_locations.dtype==np.dtype('float32'):
-                    distances=np.float32(distances)
-
-                ref_radius=np.mean(distances[:, 6])
-                checktime = time.time()
-                stdout.write('KDtree find radius time (sec): {}\n'.format(checktime - start))
-
-            # Define the size of the subsets, only in lonm
-            subset_size = lonefas.shape[0]//self.num_of_splits
-
-            # Initialize empty arrays to store the results
-            weights = np.empty((lonefas.shape[0]*lonefas.shape[1],self.nnear),dtype=lonefas.dtype)
-            indexes = np.empty((lonefas.shape[0]*lonefas.shape[1],self.nnear),dtype=int)
-            result = np.empty((lonefas.shape[0]*lonefas.shape[1]),dtype=lonefas.dtype)
+        self._prune_source(lonefas, latefas)
+        if self.num_of_splits is None and self.max_memory is None:
+            return self.interpolate_split(lonefas, latefas)
+
+        # Initialize empty arrays to store the results
+        # (nearest neighbour weights and indexes are 1D)
+        shape = (lonefas.size,) if self.nnear == 1 else (lonefas.size, self.nnear)
+        weights = np.empty(shape, dtype=lonefas.dtype)
+        indexes = np.empty(shape, dtype=int)
+        result = np.empty(lonefas.size, dtype=lonefas.dtype)
+
+        # Collect the results of subsets back into the weights and indexes arrays
+        for start, stop, subset_result, subset_weights, subset_indexes in self.interpolate_subsets(lonefas, latefas, keep_results=True):
+            weights[start:stop] = subset_weights
+            indexes[start:stop] = subset_indexes
+            result[start:stop] = subset_result
+        return result, weights, indexes
 
+    def interpolate_modes(self, lonefas, latefas, modes):
+        """
+        Interpolate with several modes searching neighbours in the KDTree (modes maps them to their nnear),
+        with a single query of the largest number of neighbours: as neighbours are sorted by distance,
+        the ones of each mode are the first nnear ones.
+        Target rows are interpolated in subsets (see split_rows), in this process.
+        Return a dict of (result, weights, indexes) of each mode
+        """
+        mode, nnear = self.mode, self.nnear
+        k = max(modes.values())
+        # the source grid is pruned and memory is estimated for the mode with most neighbours
+        self.mode, self.nnear = next(m for m in modes if modes[m] == k), k
+        try:
+            self._prune_source(lonefas, latefas)
+            subsets, _ = self.split_rows(lonefas.shape, keep_results=True)
+            ref_radius = None
+            if modes.get('adw') == 11 and len(subsets) > 1:
+                ref_radius = self._reference_radius(lonefas, latefas, subsets)
+            results = {}
+            for m, nn in modes.items():
+                shape = (lonefas.size,) if nn == 1 else (lonefas.size, nn)
+                results[m] = (np.empty(lonefas.size, dtype=lonefas.dtype), np.empty(shape, dtype=lonefas.dtype), np.empty(shape, dtype=int))
+            cols = lonefas.shape[1]
+            for start, stop in subsets:
+                stdout.write('Finding indexes for {} interpolation k={}\n'.format(', '.join(modes), k))
+                neighbours = self._query_neighbours(lonefas[start:stop, :], latefas[start:stop, :], k)
+                for m, nn in modes.items():
+                    self.mode, self.nnear = m, nn
+                    subset = self.interpolate_split(lonefas[start:stop, :], latefas[start:stop, :], ref_radius, neighbours)
+                    for array, values in zip(results[m], subset):
+                        array[start*cols:stop*cols] = values
+        finally:
+            self.mode, self.nnear = mode, nnear
+        return results
+
+    def interpolate_cells(self, target_lons, target_lats):
+        """
+        Interpolate target points given as 1D arrays (e.g. cells of a target grid missing from the intertable
+        it's derived from). Not for adw, whose reference radius needs the whole target grid.
+        Return (result, weights, indexes)
+        """
+        target_lons, target_lats = target_lons[:, np.newaxis], target_lats[:, np.newaxis]
+        self._prune_source(target_lons, target_lats)
+        return self.interpolate_split(target_lons, target_lats)
+
+    def interpolate_subsets(self, lonefas, latefas, keep_results=False):
+        """
+        Interpolate subsets of target rows (see split_rows), one after another or in worker processes.
+        Yield (start, stop, result, weights, indexes) of each subset in order, start and stop being offsets of
+        the flattened target points. Arrays are only valid until the next subset is yielded.
+        With a checkpoint, completed subsets are saved and the ones saved by a previous execution are not computed again
+        """
+        self._prune_source(lonefas, latefas)
+        # source structures are built once, before workers are forked
+        self.tree, self.min_upper_bound
+        subsets, workers = self.split_rows(lonefas.shape, keep_results)
+        cols = lonefas.shape[1]
+        done = [False] * len(subsets)
+        if self.checkpoint is not None:
+            self.checkpoint.open((subsets[0][1] - subsets[0][0]) * cols, mode=self.mode, nnear=self.nnear,
+                                 source_size=self.source_size, target_shape=lonefas.shape, subsets=subsets)
+            done = [self.checkpoint.completed(k) for k in range(len(subsets))]
+        todo = deque((k, start, stop) for k, (start, stop) in enumerate(subsets) if not done[k])
+        workers = min(workers, len(todo))
+        ref_radius = None
+        if todo and self.mode == 'adw' and self.nnear == 11:
+            ref_radius = self._reference_radius(lonefas, latefas, subsets)
+
+        if workers <= 1:
             # Iterate over the subsets of the arrays
-            for i in range(0, lonefas.shape[0], subset_size):
-                subset_lonefas = lonefas[i:i+subset_size, :]
-                subset_latefas = latefas[i:i+subset_size, :]
-
-                # Call the interpolate function for the subset
-                subset_result, subset_weights, subset_indexes = self.interpolate_split(subset_lonefas, subset_latefas, ref_radius)
-
-                # Collect the results back into the weights and indexes arrays
-                weights[i*lonefas.shape[1]:(i+subset_size)*lonefas.shape[1],:] = subset_weights
-                indexes[i*lonefas.shape[1]:(i+subset_size)*lonefas.shape[1],:] = subset_indexes
-                result[i*lonefas.shape[1]:(i+subset_size)*lonefas.shape[1]] = subset_result
-        
-        else:
-            result, weights, indexes = self.interpolate_split(lonefas, latefas)
-
-        return result, weights, indexes
+            for k, (start, stop) in enumerate(subsets):
+                if done[k]:
+                    yield (start*cols, stop*cols) + self.checkpoint.load(k)
+                    continue
+                subset = tuple(self.interpolate_split(lonefas[start:stop, :], latefas[start:stop, :], ref_radius))
+                if self.checkpoint is not None:
+                    self.checkpoint.save(k, subset)
+                yield (start*cols, stop*cols) + subset
+            return
+
+        # each worker writes the results of its subset in a slot of arrays in shared memory
+        slot_size = (subsets[0][1] - subsets[0][0]) * cols
+        shape = (workers, slot_size) if self.nnear == 1 else (workers, slot_size, self.nnear)
+        result = shared_empty((workers, slot_size), dtype=lonefas.dtype)
+        weights = shared_empty(shape, dtype=lonefas.dtype)
+        indexes = shared_empty(shape, dtype=int)
+
+        global _SPLIT_STATE
+        _SPLIT_STATE = (self, lonefas, latefas, ref_radius, result, weights, indexes, max(1, numba.config.NUMBA_NUM_THREADS // workers))
+        stdout.write('Interpolating {} subsets with {} processes\n'.format(len(todo), workers))
+        try:
+            # workers are forked: they share source coordinates and KDTree with this process
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                running = deque()
+                for slot in range(workers):
+                    k, start, stop = todo.popleft()
+                    running.append((slot, pool.submit(_interpolate_subset, slot, start, stop)))
+                for k, (start, stop) in enumerate(subsets):
+                    if done[k]:
+                        yield (start*cols, stop*cols) + self.checkpoint.load(k)
+                        continue
+                    # running subsets are in order
+                    slot, future = running.popleft()
+                    future.result()
+                    size = (stop - start) * cols
+                    subset = (result[slot, :size], weights[slot, :size], indexes[slot, :size])
+                    if self.checkpoint is not None:
+                        self.checkpoint.save(k, subset)
+                    yield (start*cols, stop*cols) + subset
+                    if todo:
+                        # the slot is free again
+                        _, next_start, next_stop = todo.popleft()
+                        running.append((slot, pool.submit(_interpolate_subset, slot, next_start, next_stop)))
+        finally:
+            _SPLIT_STATE = None
+
+    def split_rows(self, target_shape, keep_results=False):
+        """
+        Return the subsets of target rows to interpolate separately, as (start, stop) tuples, and the number of
+        worker processes computing them.
+        Rows are split in num_of_splits subsets, or more if needed to keep memory usage within max_memory
+        (keep_results is True when results of all subsets are kept in memory)
+        """
+        rows, cols = target_shape
+        workers = 1 if self.njobs == 1 else os.cpu_count() if self.njobs == -1 else self.njobs
+        if workers > 1 and not _fork_safe():
+            stdout.write('Numba threads already started: subsets are computed in this process\n')
+            workers = 1
+        num_of_splits = self.num_of_splits or 1
+
+        if self.max_memory is not None:
+            base_bytes, neighbour_bytes = SUBSET_BYTES_PER_POINT[self.mode]
+            point_bytes = base_bytes + neighbour_bytes * self.nnear
+            if self.use_broadcasting and self.mode in ('adw', 'cdd'):
+                point_bytes += BROADCASTING_BYTES_PER_PAIR * self.nnear ** 2
+            # memory used all along: source grid and KDTree, target coordinates and (if kept) results
+            fixed_bytes = self.z.size * (SOURCE_BYTES_PER_POINT + (DELAUNAY_BYTES_PER_POINT if self.mode in ('triangulation', 'bilinear_delaunay') else 0))
+            fixed_bytes += rows * cols * (16 + (8 + 16 * self.nnear if keep_results else 0))
+            rows_per_subset = (self.max_memory - fixed_bytes) // (point_bytes * cols * workers)
+            if rows_per_subset < 1:
+                stdout.write('Memory budget of {} bytes is too low (about {} bytes needed): interpolating one row per subset\n'.format(
+                    self.max_memory, fixed_bytes + point_bytes * cols * workers))
+                rows_per_subset = 1
+            num_of_splits = max(num_of_splits, -(-rows // rows_per_subset))
+            stdout.write('Memory budget of {} bytes: interpolating {} rows in {} subsets\n'.format(self.max_memory, rows, num_of_splits))
+
+        # Define the size of the subsets, only in lonm
+        subset_size = max(1, -(-rows // num_of_splits) if self.max_memory is not None else rows // num_of_splits)
+        subsets = [(i, min(i+subset_size, rows)) for i in range(0, rows, subset_size)]
+        return subsets, min(len(subsets), workers)
+
+    def _reference_radius(self, lonefas, latefas, subsets):
+        # global reference radius of adw: mean distance of the 7th neighbour of all target points
+        # (see adw_compute_weights_from_cutoff_distances)
+        start = time.time()
+        stdout.write('Finding global reference radius {} interpolation k=7\n'.format(self.mode))
+        if self.max_memory is None:
+            subsets = [(0, lonefas.shape[0])]
+        distances_7th = []
+        for start_row, stop_row in subsets:
+            x, y, z = self.to_3d(lonefas[start_row:stop_row, :], latefas[start_row:stop_row, :], to_regular=self.target_grid_is_rotated)
+            efas_locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+            distances, indexes = self._query_tree(efas_locations, 7)
+            if efas_locations.dtype==np.dtype('float32'):
+                distances=np.float32(distances)
+            distances_7th.append(distances[:, 6])
 
+        ref_radius=np.mean(np.concatenate(distances_7th))
+        checktime = time.time()
+        stdout.write('KDtree find radius time (sec): {}\n'.format(checktime - start))
+        return ref_radius
 
-    def interpolate_split(self, target_lons, target_lats, ref_radius=None):        
+    def _query_neighbours(self, target_lons, target_lats, k):
+        start = time.time()
+        x, y, z = self.to_3d(target_lons, target_lats, to_regular=self.target_grid_is_rotated)
+        efas_locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+        distances, indexes = self._query_tree(efas_locations, k)
+        if efas_locations.dtype==np.dtype('float32'):
+            distances=np.float32(distances)
+        checktime = time.time()
+        stdout.write('KDtree time (sec): {}\n'.format(checktime - start))
+        return efas_locations, distances, indexes
+
+    def interpolate_split(self, target_lons, target_lats, ref_radius=None, neighbours=None):        
         # Target coordinates  HAVE to be rotated coords in case GRIB grid is rotated
         # Example of target rotated coords are COSMO lat/lon/dem PCRASTER maps
         self.target_latsOR=target_lats
@@ -620,14 +1468,14 @@ class ScipyInterpolation(object):
 
         start = time.time()
         if self.mode != 'triangulation' and self.mode != 'bilinear_delaunay':
-            stdout.write('Finding indexes for {} interpolation k={}\n'.format(self.mode, self.nnear))
-            x, y, z = self.to_3d(target_lons, target_lats, to_regular=self.target_grid_is_rotated)
-            efas_locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
-            distances, indexes = self.tree.query(efas_locations, k=self.nnear, workers=self.njobs) 
-            if efas_locations.dtype==np.dtype('float32'):
-                distances=np.float32(distances)
-            checktime = time.time()
-            stdout.write('KDtree time (sec): {}\n'.format(checktime - start))
+            if neighbours is None:
+                stdout.write('Finding indexes for {} interpolation k={}\n'.format(self.mode, self.nnear))
+                efas_locations, distances, indexes = self._query_neighbours(target_lons, target_lats, self.nnear)
+            else:
+                # neighbours searched for several modes (see interpolate_modes): the first nnear ones are the ones of this mode
+                efas_locations, distances, indexes = neighbours
+                distances, indexes = (distances[:, 0].copy(), indexes[:, 0].copy()) if self.nnear == 1 else \
+                                     (distances[:, :self.nnear].copy(), indexes[:, :self.nnear].copy())
         
         if self.mode == 'nearest' and self.nnear == 1:
             # return results, indexes
@@ -642,7 +1490,7 @@ class ScipyInterpolation(object):
             elif self.mode == 'cdd':
                 result, weights, indexes = self._build_weights_invdist(distances, indexes, self.nnear, adw_type='CDD', use_broadcasting=self.use_broadcasting, ref_radius=None,
                                                                        cdd_map=self.cdd_map, cdd_mode=self.cdd_mode, cdd_options=self.cdd_options)
-            elif self.mode == 'bilinear' and self.nnear == 4: # bilinear interpolation only supported with nnear = 4
+            elif self.mode in ('bilinear', 'bilinear_rings') and self.nnear == 4: # bilinear interpolation only supported with nnear = 4
                 # BILINEAR INTERPOLATION
                 result, weights, indexes = self._build_weights_bilinear(distances, indexes, efas_locations, self.nnear) 
             elif self.mode == 'triangulation':
@@ -656,6 +1504,10 @@ class ScipyInterpolation(object):
                             f"interpolation method not supported (mode = {self.mode}, nnear = {self.nnear})")
                     
                
+        if self.source_indexes is not None:
+            # indexes of the whole source grid (missing value is its size)
+            indexes = np.append(self.source_indexes, self.source_size)[indexes]
+
         stdout.write('End scipy interpolation: {}\n'.format(now_string()))
         end = time.time()
         stdout.write('Interpolation time (sec): {}\n'.format(end - start))
@@ -698,31 +1550,19 @@ class ScipyInterpolation(object):
     def _build_nn(self, distances, indexes):
         z = self.z
         result = mask_it(np.empty((len(distances),) + np.shape(z[0])), self._mv_target, 1)
-        jinterpol = 0
         num_cells = result.size
-        back_char, progress_step = progress_step_and_backchar(num_cells)
+        back_char, _ = progress_step_and_backchar(num_cells)
         stdout.write('Skipping neighbors at distance > {}\n'.format(self.min_upper_bound))
-        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
         stdout.flush()
 
+        # neighbours farther than min_upper_bound (or not found by KDTree) are out: index z.size is the missing value
+        within = distances <= self.min_upper_bound
+        outs = num_cells - np.count_nonzero(within)
         idxs = empty((len(indexes),), fill_value=z.size, dtype=int)
-        # wsum will be saved in intertable
-        outs = 0
-        for dist, ix in zip(distances, indexes):
-            if jinterpol % progress_step == 0:
-                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, jinterpol, num_cells, outs, jinterpol * 100. / num_cells))
-                stdout.flush()
-            if dist <= self.min_upper_bound:
-                wz = z[ix]
-                idxs[jinterpol] = ix
-            else:
-                # stdout.write('\nneighbour discarded. distance: {}\n'.format(dist))
-                outs += 1
-                wz = self._mv_target
-            result[jinterpol] = wz
-            jinterpol += 1
-        stdout.write('{}{:>100}'.format(back_char, ' '))
-        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, jinterpol, num_cells, outs))
+        idxs[within] = indexes[within]
+        result[within] = z[indexes[within]]
+        result[~within] = self._mv_target
+        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, num_cells, num_cells, outs))
         stdout.flush()
         return result, idxs
 
@@ -1123,209 +1963,142 @@ class ScipyInterpolation(object):
         return True
 
     def _build_weights_bilinear(self, distances, indexes, efas_locations, nnear):
+        # same algorithm of the point by point version (see tests/bilinear_loop.py), processing all target points at once:
+        # retry rounds run in parallel with numba and new corners are queried to the KDTree in batch
         z = self.z
         result = mask_it(np.empty((len(distances),) +
                          np.shape(z[0])), self._mv_target, 1)
         weights = np.empty((len(distances),) + (nnear,))
         idxs = empty((len(indexes),) + (nnear,), fill_value=z.size, dtype=int)
-        weight1 = empty((len(distances),))
-        weight2 = empty((len(distances),))
-        weight3 = empty((len(distances),))
-        weight4 = empty((len(distances),))
         empty_array = empty(z[0].shape, self._mv_target)
 
         self.lat_inALL = self.target_latsOR.ravel()
         self.lon_inALL = self.target_lonsOR.ravel()
+        lat_in = self.lat_inALL.astype(np.float64)
+        lon_in = self.lon_inALL.astype(np.float64)
+        latgrib = np.asarray(self.latgrib, dtype=np.float64)
+        longrib = np.asarray(self.longrib, dtype=np.float64)
+        values = np.ma.getdata(z).astype(np.float64)
 
         num_cells = result.size
-        back_char, progress_step = progress_step_and_backchar(num_cells)
+        back_char, _ = progress_step_and_backchar(num_cells)
 
         stdout.write('Skipping bilinear interpolation at distance > {}\n'.format(self.min_upper_bound))
-        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
         stdout.flush()
 
-        outs = 0            # number of points falling outside the min_upper_bound distance
-        not_in_quad = 0     # number of points falling outside quadrilaterals after max_retries
-
         # max number of retry equals to a full lenght of lon coordinates
-        max_retries = self.target_lonsOR.shape[0]        
-        max_used_additional_points = 0
-        nn_max_used_additional_points = -1
+        max_retries = self.target_lonsOR.shape[0] if not self.source_grid_is_rotated else 20
 
         latgrib_max = self.latgrib.max()
         latgrib_min = self.latgrib.min()
         longrib_max = self.longrib.max()
         longrib_min = self.longrib.min()
-        # evaluate an approx_grib_resolution by using 10 times the first longidure values 
-        # to check if the whole globe is covered
-        approx_grib_resolution = abs(self.longrib[0]-self.longrib[1])*1.5
-        is_global_map = (360-(longrib_max-longrib_min))<approx_grib_resolution
-        # for nn in range(25898400,len(indexes)):
-        for nn in range(len(indexes)):
-            skip_current_point = False
-            if nn % progress_step == 0:
-                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, nn, num_cells, outs, nn * 100. / num_cells))
-                stdout.flush()
-
-            dist = distances[nn]
-            ix = indexes[nn]
+        is_global_map = self._is_global_map(self.longrib)
+
+        status = np.full(num_cells, BILINEAR_ACTIVE, dtype=np.int8)
+        # check distances
+        exact = distances[:, 0] <= 1e-10
+        too_far = ~exact & (distances[:, 0].astype(np.float64) > self.min_upper_bound)
+        idxs[exact] = indexes[exact]
+        weights[exact] = np.array([1., 0., 0., 0.])
+        result[exact] = z[indexes[exact, 0]]  # take exactly the point, weight = 1
+        idxs[too_far] = indexes[too_far]
+        weights[too_far] = np.array([np.nan, 0., 0., 0.])
+        result[too_far] = empty_array
+        status[exact] = BILINEAR_OK
+        status[too_far] = BILINEAR_OUT
+
+        points = np.flatnonzero(~exact & ~too_far)
+        if not is_global_map:
+            # in non-global maps, skip all points falling outside the grib min and max values
+            outside = points[(lat_in[points] > latgrib_max) | (lat_in[points] < latgrib_min) |
+                             (lon_in[points] > longrib_max) | (lon_in[points] < longrib_min)]
+            idxs[outside] = indexes[outside, 0:4]
+            weights[outside] = np.array([np.nan, 0., 0., 0.])
+            result[outside] = empty_array
+            status[outside] = BILINEAR_OUT
+            points = points[status[points] == BILINEAR_ACTIVE]
+
+        additional_points = np.zeros(num_cells, dtype=np.int64)
+        # additional checks only if source_grid_is_rotated is False
+        additional_checks_completed = np.full(num_cells, self.source_grid_is_rotated, dtype=bool)
+        requests = np.zeros(num_cells, dtype=np.int8)
+        wrong_points = np.zeros((num_cells, 4))
+        wrong_count = np.zeros(num_cells, dtype=np.int64)
+        request_latlon = np.zeros((num_cells, 2))
+        # last p1, p2, p3, p4 points (in clockwise order) found for each point
+        clockwise_indexes = np.zeros((num_cells, 4), dtype=np.int64)
+        has_clockwise = np.zeros(num_cells, dtype=bool)
+
+        if self.mode == 'bilinear_rings' and isinstance(self.tree, RingGridIndex):
+            # grids of latitude rings: corners are the two points around the target on the rings north and south of it.
+            # Only points without such a quadrilateral (e.g. at borders of regional grids) go through retry rounds
+            quads, found = self.tree.enclosing(lat_in[points], lon_in[points])
+            direct = points[found]
+            bilinear_clockwise_quads(direct, quads[found], lat_in, lon_in, latgrib, longrib, values, clockwise_indexes)
+            has_clockwise[direct] = True
+            status[direct] = BILINEAR_OK
+            points = points[~found]
+
+        retry_round = 0
+        while points.size:
+            stdout.write('{}Building coeffs: round {}, points to check: {}'.format(back_char, retry_round, points.size))
+            stdout.flush()
+            bilinear_retry_round(points, lat_in, lon_in, latgrib, longrib, values, indexes, idxs, additional_points,
+                                 additional_checks_completed, status, requests, wrong_points, wrong_count,
+                                 request_latlon, clockwise_indexes, has_clockwise, max_retries, latgrib_min, latgrib_max,
+                                 self.source_grid_is_rotated)
+            no_vertex = np.flatnonzero(status[points] == BILINEAR_NO_VERTEX)
+            if no_vertex.size:
+                raise ApplicationException.get_exc(WEIRD_STUFF, details='index_nonconvex is None for nn={}'.format(points[no_vertex[0]]))
+            points = points[requests[points] != REPLACE_NONE]
+            self._replace_corners(points, requests, indexes, efas_locations, additional_points, wrong_points, wrong_count, request_latlon)
+
+            # if there is no replacement with 4 points on the opposite side of the globe, get only the nearest point
+            opposite = points[requests[points] == REPLACE_OPPOSITE_SIDE]
+            sorted_corners = np.sort(indexes[opposite, 0:4], axis=1)
+            nearest = opposite[(sorted_corners[:, 1:] == sorted_corners[:, :-1]).any(axis=1)]
+            status[nearest] = BILINEAR_NEAREST
+            weights[nearest] = np.array([1., 0., 0., 0.])
+            result[nearest] = z[idxs[nearest, 0]]  # take exactly the point, weight = 1
+            points = points[status[points] == BILINEAR_ACTIVE]
+            retry_round += 1
+
+        # points that ran out of retries before getting a quadrilateral of their own use the last one found for the
+        # target points before them, as the point by point algorithm did (its p1, p2, p3, p4 were kept from point to
+        # point), so that tables are the same as the ones created by previous versions.
+        # Points with no quadrilateral found before them take the nearest point
+        owners = np.maximum.accumulate(np.where(has_clockwise, np.arange(num_cells), -1))
+        solved = ((status == BILINEAR_OK) | (status == BILINEAR_NOT_IN_QUAD)) & ~exact
+        nearest = np.flatnonzero(solved & (owners < 0))
+        status[nearest] = BILINEAR_NEAREST
+        weights[nearest] = np.array([1., 0., 0., 0.])
+        result[nearest] = z[idxs[nearest, 0]]
+        solved = np.flatnonzero(solved & (owners >= 0))
+        owners = owners[solved]
+        alpha, beta, converged = bilinear_alpha_beta(solved, owners, lat_in, lon_in, latgrib, longrib, values, clockwise_indexes)
+        for t in np.flatnonzero(~converged):
+            # quadrilaterals without a solution in [0, 1]: use the fsolve solver of _functionAlphaBeta
+            nn, owner = solved[t], owners[t]
+            lats, lons = get_correct_lats_lons(lat_in[owner], lon_in[owner], latgrib, longrib, *clockwise_indexes[owner])
+            self.p1, self.p2, self.p3, self.p4 = [np.array([lats[n], lons[n], values[i], i]) for n, i in enumerate(clockwise_indexes[owner])]
             self.lat_in = self.lat_inALL[nn]
             self.lon_in = self.lon_inALL[nn]
-
-            # if DEBUG_BILINEAR_INTERPOLATION:
-            #     # # if nn==14753:
-            #     # if nn==72759:
-            # if nn==25898400:
-            #     print('self.lat_in = {}, self.lon_in = {}, nn = {}'.format(self.lat_in,self.lon_in,nn))
-            #     if abs(self.lat_in-69.958)<0.02 and abs(self.lon_in-(-23.608))<0.02:
-            #         print('self.lat_in = {}, self.lon_in = {}, nn = {}'.format(self.lat_in,self.lon_in,nn))
-
-            # check distances 
-            if dist[0] <= 1e-10:  
-                result[nn] = z[ix[0]]  # take exactly the point, weight = 1
-                idxs[nn] = ix
-                weights[nn] = np.array([1., 0., 0., 0.])
-            elif dist[0] > self.min_upper_bound:
-                outs += 1
-                idxs[nn] = ix
-                weights[nn] = np.array([np.nan, 0., 0., 0.])
-                result[nn] = empty_array
-            else:
-                self.target_location = efas_locations[nn]
-                additional_points = 0
-                quadrilateral_is_ok = False
-                # additional checks only if source_grid_is_rotated is False
-                if self.source_grid_is_rotated == False:
-                    additional_checks_completed = False
-                else:
-                    additional_checks_completed = True
-                    max_retries = 20
-                while quadrilateral_is_ok == False and additional_points<max_retries:  
-                    # find the 4 corners
-                    i1, i2, i3, i4 = indexes[nn, 0:4]
-                    idxs[nn, :] = indexes[nn, 0:4]
-
-                    # check the point on lat lon coords system:
-                    # I need that my location falls in the quadrilateral
-                    # (actually the quadrilateral should be convex as per bilinear interpolation (bilinear warp) definition,
-                    # but the interpolation works also on non-convex poligon
-                    # N.B: when the quadrilateral is not a rectangle, we have a so called "bilinear transformation, 
-                    # bilinear warp or bilinear distortion", instead of a bilinear interpolation. 
-                    # See : https://en.wikipedia.org/wiki/Bilinear_interpolation
-
-                    lats, lons = get_correct_lats_lons(self.lat_in, self.lon_in, self.latgrib, self.longrib, i1, i2, i3, i4)
-
-                    corners_points = np.array([[lats[0], lons[0], self.z[i1], i1],
-                        [lats[1], lons[1], self.z[i2], i2],
-                        [lats[2], lons[2], self.z[i3], i3],
-                        [lats[3], lons[3], self.z[i4], i4]])
-
-                    # in non-global maps, skip all points falling outside the grib min and max values
-                    if is_global_map==False and \
-                        (self.lat_in>latgrib_max or self.lat_in<latgrib_min or self.lon_in>longrib_max or self.lon_in<longrib_min):
-                            quadrilateral_is_ok = True
-                            outs += 1
-                            weights[nn] = np.array([np.nan, 0., 0., 0.])
-                            result[nn] = empty_array
-                            skip_current_point = True
-
-                    # check grib type (if grig is on parallels or projected (self.source_grid_is_rotated=True))
-                    # in case we are not in parallel-like grib files, let's use the old bilinear method 
-                    # that works with every grid but is less precise
-                    # see here for possible grib files https://apps.ecmwf.int/codes/grib/format/grib1/grids/10/
-                    if additional_checks_completed == False and skip_current_point == False:
-                        # the grib file has different number of longitude points for each latitude,
-                        # thus I will make sure to use only 2 above and two below of the current point
-                        # the function will return the wrong point, if any
-                        index_wrong_points = getWrongPointDirection(self.lat_in, self.lon_in, corners_points)
-                        if len(index_wrong_points):
-                            # check if the latitude point is above the maximum or below the minimun latitude, 
-                            if self.lat_in>latgrib_max or self.lat_in<latgrib_min:
-                                # to speed up the process and retrieve better "close points" from the KDTree 
-                                # I will look for nearest points of the opposite side of the globe
-                                if self.replaceIndexOppositeSide(index_wrong_points, indexes, nn) == False:
-                                    # if there is no replacement with 4 points, get only the nearest point
-                                    quadrilateral_is_ok = True
-                                    outs += 1
-                                    result[nn] = z[idxs[nn,0]]  # take exactly the point, weight = 1
-                                    weights[nn] = np.array([1., 0., 0., 0.])
-                                    skip_current_point = True
-
-                            else:
-                                additional_points = self.replaceIndex(index_wrong_points, indexes, nn, additional_points)
-                        else:
-                            # check for points in grid-like shape
-                            index_wrong_point = getWrongPointGridLikeShape(self.lat_in, self.lon_in, corners_points)
-                            if index_wrong_point is not None:
-                                additional_points = self.replaceIndex([index_wrong_point], indexes, nn, additional_points)
-                            else:
-                                # check for best grid-like shape:
-                                index_wrong_point, new_lat, new_lon = getWrongPointBestGridLikeShape(self.lat_in, self.lon_in, corners_points)
-                                if index_wrong_point is not None:
-                                    self.replaceIndexCloseToPoint([index_wrong_point], new_lat, new_lon, indexes, nn)
-                                else:
-                                    additional_checks_completed = True
-                    if additional_checks_completed == True and skip_current_point == False:
-                        #get p1,p2,p3,p4 in clockwise order
-                        self.p1, self.p2, self.p3, self.p4 = get_clockwise_points(corners_points)
-                        # check for convexity
-                        is_convex = isConvexQuadrilateral(self.p1[0:2], self.p2[0:2], self.p3[0:2], self.p4[0:2])
-                        if self.source_grid_is_rotated:
-                            # in case of rotated grid, actually the convexity check give worst results
-                            # so let's just skip this check
-                            is_convex = True 
-
-                        index_nonconvex = -1
-                        if is_convex == False:                            
-                            index_nonconvex = getNonConvexVertex(self.p1, 
-                                                    self.p2, 
-                                                    self.p3, 
-                                                    self.p4,)
-                            if (index_nonconvex is None):
-                                print("Error, index_nonconvex is None for nn={}".format(nn))
-                            
-                            assert(index_nonconvex is not None)    
-                            additional_points = self.replaceIndex([index_nonconvex], indexes, nn, additional_points)
-                        else:
-                            # check for point in quadrilateral
-                            is_in_quadrilateral = isPointInQuadrilateral([self.lat_in,self.lon_in], 
-                                                                            self.p1[0:2], 
-                                                                            self.p2[0:2], 
-                                                                            self.p3[0:2], 
-                                                                            self.p4[0:2], 
-                                                                            is_convex)
-                            if is_in_quadrilateral == False:
-                                # get rid of the wrong point (the actual farthest one) and add the new one 
-                                # (that is the farthest in the new list of replacement_indexes)
-                                additional_points = self.replaceIndex([indexes[nn, 3]], indexes, nn, additional_points)                                
-                            else:
-                                quadrilateral_is_ok = True
-
-                if skip_current_point == False:
-                    if max_used_additional_points<additional_points:
-                        max_used_additional_points = additional_points
-                        nn_max_used_additional_points = nn
-                        print("\nmax_used_additional_points: {}, nn_max_used_additional_points: {}".format(max_used_additional_points, nn_max_used_additional_points))
-
-                    try:
-                        assert(len(np.unique(indexes[nn, 0:4]))==4) 
-                    except AssertionError as e:
-                        ApplicationException.get_exc(WEIRD_STUFF, details=str(e) + "\nLess then 4 distinct point! nn={} lat={} lon={}".format(nn, self.lat_in, self.lon_in))
-                    
-                    if quadrilateral_is_ok==False:
-                        #print("\nError: quadrilateral_is_ok is False, failed to find a correct quadrilateral: nn is {}, lat={} lon={}".format(nn, self.lat_in, self.lon_in))
-                        not_in_quad+=1
-
-                    [alpha, beta] = np.clip(opt.fsolve(self._functionAlphaBeta, (0.5, 0.5)), 0, 1)
-                    weight1[nn] = (1-alpha)*(1-beta)
-                    weight2[nn] = alpha*(1-beta)
-                    weight3[nn] = alpha*beta
-                    weight4[nn] = (1-alpha)*beta
-
-                    weights[nn, 0:4] = np.array([weight1[nn], weight2[nn], weight3[nn], weight4[nn]])
-                    idxs[nn, 0:4] = np.array([self.p1[3], self.p2[3], self.p3[3], self.p4[3]])
-                    result[nn] = weight1[nn]*self.p1[2] + weight2[nn]*self.p2[2] + weight3[nn] * self.p3[2] + weight4[nn] * self.p4[2]  
-
+            alpha[t], beta[t] = opt.fsolve(self._functionAlphaBeta, (0.5, 0.5))
+        alpha = np.clip(alpha, 0, 1)
+        beta = np.clip(beta, 0, 1)
+        weights[solved, 0] = (1-alpha)*(1-beta)
+        weights[solved, 1] = alpha*(1-beta)
+        weights[solved, 2] = alpha*beta
+        weights[solved, 3] = (1-alpha)*beta
+        idxs[solved, 0:4] = clockwise_indexes[owners]
+        p_values = values[clockwise_indexes[owners]]
+        result[solved] = weights[solved, 0]*p_values[:, 0] + weights[solved, 1]*p_values[:, 1] + weights[solved, 2]*p_values[:, 2] + weights[solved, 3]*p_values[:, 3]
+
+        outs = np.count_nonzero((status == BILINEAR_OUT) | (status == BILINEAR_NEAREST))
+        not_in_quad = np.count_nonzero(status == BILINEAR_NOT_IN_QUAD)
+        max_used_additional_points = additional_points[solved].max() if solved.size else 0
+        nn_max_used_additional_points = solved[additional_points[solved].argmax()] if max_used_additional_points > 0 else -1
         stdout.write('{}{:>100}'.format(back_char, ' '))
         stdout.write('{}Building coeffs: {}/{} [outs: {}, not_in_quad: {}] (100%)\n'.format(back_char, num_cells, num_cells, outs, not_in_quad))
         stdout.write('debug info: max_used_additional_points is {}, nn is {}\n'.format(max_used_additional_points, nn_max_used_additional_points))
@@ -1333,6 +2106,33 @@ class ScipyInterpolation(object):
 
         return result, weights, idxs
 
+    # replaceIndex, replaceIndexOppositeSide and replaceIndexCloseToPoint for all the points of a retry round:
+    # KDTree is queried once for each number of needed points
+    def _replace_corners(self, points, requests, indexes, efas_locations, additional_points, wrong_points, wrong_count, request_latlon):
+        replace_next = points[requests[points] == REPLACE_NEXT]
+        num_points = self.nnear + additional_points[replace_next]
+        for k in np.unique(num_points):
+            group = replace_next[num_points == k]
+            _, replacement_indexes = self.tree.query(efas_locations[group], k=k, workers=self.njobs)
+            bilinear_replace_points(group, indexes, wrong_points, wrong_count, replacement_indexes, True)
+
+        for request in (REPLACE_OPPOSITE_SIDE, REPLACE_CLOSE_TO_POINT):
+            selected = points[requests[points] == request]
+            if not selected.size:
+                continue
+            if request == REPLACE_OPPOSITE_SIDE:
+                new_lat, new_lon = 180-self.lat_inALL[selected], self.lon_inALL[selected]
+            else:
+                new_lat, new_lon = request_latlon[selected, 0], request_latlon[selected, 1]
+            x, y, z = self.to_3d(new_lon, new_lat, to_regular=self.target_grid_is_rotated)
+            new_target_locations = np.vstack((x, y, z)).T
+            num_points = wrong_count[selected]
+            for k in np.unique(num_points):
+                group = num_points == k
+                _, replacement_indexes = self.tree.query(new_target_locations[group], k=k, workers=self.njobs)
+                bilinear_replace_points(selected[group], indexes, wrong_points, wrong_count,
+                                        replacement_indexes.reshape(np.count_nonzero(group), k), False)
+
     def _functionAlphaBeta(self, variables):
         (alpha, beta) = variables
         # This is the function that we want to make 0
@@ -1389,12 +2189,10 @@ class ScipyInterpolation(object):
         # so adjust the grid spaces for an effective triangulation
         # In case of rotated grid, instead, use the original grid points, that is fine for the spece even if it is rotaded
         if self.source_grid_is_rotated == False:
-            for i in range(gribpoints_scaled.shape[0]):
-                gribpoints_scaled[i,0], error = quad(integrand, 0, np.radians(gribpoints_scaled[i,0]))
-
+            gribpoints_scaled[:,0] = stretched_latitudes(gribpoints_scaled[:,0])
             gribpoints_scaled[:,0] = gribpoints_scaled[:,0]*90*10/max(gribpoints_scaled[:,0])
 
-        tri = Delaunay(gribpoints_scaled)        
+        tri = self._source_geometry('delaunay', lambda: Delaunay(gribpoints_scaled))
         #tri = Delaunay(gribpoints)
         p = np.stack((self.target_latsOR[:,:].ravel(),self.target_lonsOR[:,:].ravel()),axis=-1)
         target_latsORscaled = self.target_latsOR[:,0].copy()
@@ -1402,9 +2200,7 @@ class ScipyInterpolation(object):
         # so adjust the grid spaces for an effective triangulation
         # In case of rotated grid, instead, use the original grid points, that is fine for the spece even if it is rotaded
         if self.source_grid_is_rotated == False:
-            for i in range(target_latsORscaled[:].shape[0]):
-                target_latsORscaled[i], error = quad(integrand, 0, np.radians(target_latsORscaled[i]))
-            target_latsORscaled[:] = target_latsORscaled[:]*90*10/max(quad(integrand, 0, np.radians(max(gribpoints[:,0]))))
+            target_latsORscaled[:] = stretched_latitudes(target_latsORscaled)*90*10/stretched_latitudes(max(gribpoints[:,0]))
         
         target_latsORscaled = np.ones((1, self.target_latsOR.shape[1])) * target_latsORscaled.reshape(-1,1)
         p_scaled = np.stack((target_latsORscaled.ravel(),self.target_lonsOR[:,:].ravel()),axis=-1)
@@ -1413,108 +2209,77 @@ class ScipyInterpolation(object):
                          np.shape(z[0])), self._mv_target, 1)
         weights = np.empty((p.shape[0],) + (nnear,))
 
-        # plt.triplot(gribpoints[:,0], gribpoints[:,1], tri.simplices)
-        # plt.plot(gribpoints[:,0], gribpoints[:,1], 'o')
-        # # plt.plot(p[:,0], p[:,1], 'x')
-        # plt.show()
-
         # store in idxs_tri the nr of triangle of the grib in which each p is in, from p[0] to p[max]
         idxs_tri=tri.find_simplex(p_scaled)  
         #idxs contains the indexes of the grib vertex of the triagles that contain p
         # e.g. idxs[nn] contains the indexes of the grib vertex containing p[nn]
         idxs = tri.simplices[idxs_tri]
-        outs = 0
         empty_array = empty(z[0].shape, self._mv_target)
         num_cells = result.size
-        back_char, progress_step = progress_step_and_backchar(num_cells)
-        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
+        stdout.write('Building coeffs for {} points\n'.format(num_cells))
         stdout.flush()
 
-        numbi=0
-        numtri=0
-
+        # Here, skip points that are not in triangles, or that are in triangles having a side > min_upper_bound in global maps.
+        # In non-global maps, skip all points falling outside the grib values using nearest neighbor method
+        is_out = idxs_tri == -1
+        if is_global_map==False:
+            is_out |= distances > self.min_upper_bound
+            # evaluate the location of vertex and exclude triangles with very far vertex
+            x_tmp, y_tmp, z_tmp = self.to_3d(normalized_longrib[idxs], normalized_latgrib[idxs], to_regular=not self.rotated_bugfix_gribapi)
+            vertex_locations = np.stack((x_tmp, y_tmp, z_tmp), axis=-1)
+            for v1, v2 in ((0, 1), (1, 2), (0, 2)):
+                is_out |= np.linalg.norm(vertex_locations[:, v1] - vertex_locations[:, v2], axis=-1) > self.min_upper_bound*10
+        outs = np.count_nonzero(is_out)
+        weights[is_out] = np.nan
+        result[is_out] = empty_array
+        points = np.flatnonzero(~is_out)
+
+        is_bilinear = np.zeros(p.shape[0], dtype=bool)
         if use_bilinear:
-            # add the fourth point to each idxs[nn] from the near triangle on the longest side
+            # In case of bilinear interpolation, when possible, use the neighbor triangle to form a quadrilateral.
+            # As neighbor to use, take the triangle on the longest side (opposite to the widest angle)
+            sides = triangulation_neighbour_sides(gribpoints_scaled, idxs)
+            pairs = triangulation_pairs(points, idxs_tri, tri.neighbors[idxs_tri], sides, tri.nsimplex)
+            # add the fourth point to each idxs[nn] from the paired triangle
             idxs = np.column_stack((idxs,empty(idxs.shape[0],-1,dtype=idxs.dtype)))
-            idxs_tri_neighbors = tri.neighbors[idxs_tri]
-            idxs_tri_neighbors_to_use = empty(idxs_tri_neighbors.max()+1,-1,dtype=idxs_tri.dtype)
-
-        for nn in range(len(idxs_tri)):
-            if nn % progress_step == 0:
-                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, nn, num_cells, outs, nn * 100. / num_cells))
-                stdout.flush()
-            # Here, skip points that are not in triangles, or that are in triangles having a side > min_upper_bound in global maps.
-            # In non-global maps, skip all points falling outside the grib values using nearest neighbor method
-            if (idxs_tri[nn]==-1) or \
-                (is_global_map==False and distances[nn] > self.min_upper_bound):
-                outs += 1
-                weights[nn] = empty(z[0].shape)
-                result[nn] = empty_array
-            else:
-                # evaluate the location of vertex and exclude triangles with very far vertex
-                x_tmp, y_tmp, z_tmp = self.to_3d(normalized_longrib[idxs[nn]], normalized_latgrib[idxs[nn]], to_regular=not self.rotated_bugfix_gribapi)
-                vertex_locations = np.vstack((x_tmp.ravel(), y_tmp.ravel(), z_tmp.ravel())).T
-                if (is_global_map==False) and \
-                    ((np.linalg.norm(vertex_locations[0] - vertex_locations[1]) > self.min_upper_bound*10) or \
-                    (np.linalg.norm(vertex_locations[1] - vertex_locations[2]) > self.min_upper_bound*10) or \
-                    (np.linalg.norm(vertex_locations[0] - vertex_locations[2]) > self.min_upper_bound*10)):
-                    outs += 1
-                    weights[nn] = empty(z[0].shape)
-                    result[nn] = empty_array
-                else:
-                    if use_bilinear:
-                        # In case of bilinear interpolation, when possible, use the neighbor triangle to form a quadrilateral.
-                        # As neighbor to use, take the triangle on the longest side (opposite to the widest angle)
-                        angles=np.zeros(3)
-                        angles[0]=get_angle(gribpoints_scaled[idxs[nn,2]], gribpoints_scaled[idxs[nn,0]], gribpoints_scaled[idxs[nn,1]])
-                        if angles[0]>180:
-                            angles[0] = 360 - angles[0] 
-                        if angles[0]>=90:
-                            idx_to_use = 0
-                        else:
-                            angles[1]=get_angle(gribpoints_scaled[idxs[nn,0]], gribpoints_scaled[idxs[nn,1]], gribpoints_scaled[idxs[nn,2]])
-                            if angles[1]>180:
-                                angles[1] = 360 - angles[1] 
-                            angles[2]=180-angles[0]-angles[1]
-                            idx_to_use = np.argmax(angles)
-                        if idxs_tri_neighbors[nn,idx_to_use]>-1:
-                            if idxs_tri_neighbors_to_use[idxs_tri[nn]] == -1 and idxs_tri_neighbors_to_use[idxs_tri_neighbors[nn,idx_to_use]] == -1:
-                                idxs_tri_neighbors_to_use[idxs_tri[nn]] = idxs_tri_neighbors[nn,idx_to_use]
-                                idxs_tri_neighbors_to_use[idxs_tri_neighbors[nn,idx_to_use]] = idxs_tri[nn]
-                        if idxs_tri_neighbors_to_use[idxs_tri[nn]]>-1:
-                            idxs[nn]=np.unique(np.append(idxs[nn,0:3],tri.simplices[idxs_tri_neighbors_to_use[idxs_tri[nn]]]))
-                    
-                    if len(idxs[nn][idxs[nn]>=0])==4:
-                        self.lat_in, self.lon_in = p[nn]
-                        lats = normalized_latgrib[idxs[nn]]
-                        lons = normalized_longrib[idxs[nn]]
-
-                        corners_points = np.array([[lats[0], lons[0], z[idxs[nn,0]], idxs[nn,0]],
-                            [lats[1], lons[1], z[idxs[nn,1]], idxs[nn,1]],
-                            [lats[2], lons[2], z[idxs[nn,2]], idxs[nn,2]],
-                            [lats[3], lons[3], z[idxs[nn,3]], idxs[nn,3]]])
-                        self.p1, self.p2, self.p3, self.p4 = get_clockwise_points(corners_points)
-                        [alpha, beta] = np.clip(opt.fsolve(self._functionAlphaBeta, (0.5, 0.5)), 0, 1)
-                        weight1 = (1-alpha)*(1-beta)
-                        weight2 = alpha*(1-beta)
-                        weight3 = alpha*beta
-                        weight4 = (1-alpha)*beta
-
-                        weights[nn, 0:4] = np.array([weight1, weight2, weight3, weight4])
-                        idxs[nn, 0:4] = np.array([self.p1[3], self.p2[3], self.p3[3], self.p4[3]])
-                        result[nn] = weight1*self.p1[2] + weight2*self.p2[2] + weight3 * self.p3[2] + weight4 * self.p4[2]                          
-                        numbi+=1
-                    else:
-                        numtri+=1
-                        b = tri.transform[idxs_tri[nn],:2].dot(np.transpose(p_scaled[nn] - tri.transform[idxs_tri[nn],2]))
-                        weights[nn] = np.append(np.append(np.transpose(b),1 - b.sum(axis=0)),np.zeros(nnear-3))
-                        result[nn] = weights[nn,0]*z[idxs[nn,0]] + weights[nn,1]*z[idxs[nn,1]] + weights[nn,2]*z[idxs[nn,2]]
+            is_bilinear[points] = pairs[idxs_tri[points]] > -1
+            quadrilaterals = np.flatnonzero(is_bilinear)
+            vertex = np.sort(np.column_stack((idxs[quadrilaterals, 0:3], tri.simplices[pairs[idxs_tri[quadrilaterals]]])), axis=1)
+            is_first = np.ones(vertex.shape, dtype=bool)
+            is_first[:, 1:] = vertex[:, 1:] != vertex[:, :-1]
+            idxs[quadrilaterals] = vertex[is_first].reshape(-1, 4)
+
+            values = np.ma.getdata(z).astype(np.float64)
+            alpha, beta, converged, clockwise_indexes = triangulation_alpha_beta(quadrilaterals, p[:, 0], p[:, 1], normalized_latgrib, normalized_longrib, values, idxs)
+            for t in np.flatnonzero(~converged):
+                # quadrilaterals without a solution in [0, 1]: use fsolve
+                self.lat_in, self.lon_in = p[quadrilaterals[t]]
+                self.p1, self.p2, self.p3, self.p4 = [np.array([normalized_latgrib[i], normalized_longrib[i], values[i], i]) for i in clockwise_indexes[t]]
+                alpha[t], beta[t] = opt.fsolve(self._functionAlphaBeta, (0.5, 0.5))
+            alpha = np.clip(alpha, 0, 1)
+            beta = np.clip(beta, 0, 1)
+            weights[quadrilaterals, 0] = (1-alpha)*(1-beta)
+            weights[quadrilaterals, 1] = alpha*(1-beta)
+            weights[quadrilaterals, 2] = alpha*beta
+            weights[quadrilaterals, 3] = (1-alpha)*beta
+            idxs[quadrilaterals, 0:4] = clockwise_indexes
+            p_values = values[clockwise_indexes]
+            result[quadrilaterals] = weights[quadrilaterals, 0]*p_values[:, 0] + weights[quadrilaterals, 1]*p_values[:, 1] + weights[quadrilaterals, 2]*p_values[:, 2] + weights[quadrilaterals, 3]*p_values[:, 3]
+
+        # linear barycentric interpolation, with coordinates straight from the affine transforms of the triangles
+        triangles = points[~is_bilinear[points]]
+        transform = tri.transform[idxs_tri[triangles]]
+        b = np.einsum('ijk,ik->ij', transform[:, :2], p_scaled[triangles] - transform[:, 2])
+        weights[triangles, 0:2] = b
+        weights[triangles, 2] = 1 - b.sum(axis=1)
+        weights[triangles, 3:] = 0
+        result[triangles] = weights[triangles, 0]*z[idxs[triangles, 0]] + weights[triangles, 1]*z[idxs[triangles, 1]] + weights[triangles, 2]*z[idxs[triangles, 2]]
+
         if (is_global_map==True):
             idxs[idxs>len(self.latgrib)]=original_indexes[idxs[idxs>len(self.latgrib)]-len(self.latgrib)]
-        stdout.write('{}{:>100}'.format(back_char, ' '))
-        stdout.write('{}Building coeffs: {}/{} [outs: {}] (100%)\n'.format(back_char, num_cells, num_cells, outs))
+        stdout.write('Building coeffs: {}/{} [outs: {}] (100%)\n'.format(num_cells, num_cells, outs))
         if use_bilinear:
-            stdout.write('{}Num Bilinear interpolated points: {}, Num triangle barycentric interpolated points: {}\n'.format(back_char, numbi, numtri))
+            stdout.write('Num Bilinear interpolated points: {}, Num triangle barycentric interpolated points: {}\n'.format(len(quadrilaterals), len(triangles)))
         stdout.flush()
 
         return result, weights, idxs
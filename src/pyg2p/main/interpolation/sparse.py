@@ -0,0 +1,122 @@
+"""
+Interpolation tables as sparse linear operators.
+
+Every intertable kind is represented by a CSR matrix of shape (target points, source points + 1).
+The extra last column is the missing value, same as KDTree indexes (index == len(values) when a value can't be computed).
+The operator is built once per table and applied to a block of timesteps with a single sparse product.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import numpy.ma as ma
+import scipy.sparse as sparse
+
+# minimum number of stored coefficients to split the sparse product among threads
+MIN_PARALLEL_NNZ = 1 << 20
+
+
+class SparseOperator:
+
+    def __init__(self, indptr, indices, weights, source_size, target_shape, xs=None, ys=None, gather=False):
+        """
+        :param indptr, indices, weights: CSR arrays. Entries of each row are kept in table order
+        (no sorting nor summing of duplicates) so that results are summed in the same order as the tables define them
+        :param xs, ys: target coordinates of rows (grib intertables), None when rows are all target points
+        :param gather: True when each row is a single entry with unused weight (nearest neighbour tables)
+        """
+        shape = (len(indptr) - 1, source_size + 1)
+        self.matrix = sparse.csr_matrix((weights, indices, indptr), shape=shape, copy=False)
+        self.source_size = source_size
+        self.target_shape = tuple(target_shape)
+        self.xs, self.ys = xs, ys
+        self._gather = indices if gather else None
+        self._pattern = None
+        self._workers = os.cpu_count() or 1
+        self._row_blocks = None
+
+    @classmethod
+    def from_scipy(cls, indexes, weights, nnear, source_size, target_shape):
+        indexes = np.asarray(indexes).reshape(-1, nnear)
+        indptr = np.arange(0, indexes.size + 1, nnear)
+        weights = np.ones(indexes.size) if nnear == 1 else np.asarray(weights, dtype=np.float64).reshape(-1)
+        return cls(indptr, indexes.reshape(-1), weights, source_size, target_shape, gather=nnear == 1)
+
+    @classmethod
+    def from_grib(cls, xs, ys, indexes, coeffs, source_size, target_shape):
+        """
+        :param indexes: list of source indexes arrays (one for grib_nearest, four for grib_invdist)
+        :param coeffs: list of coefficients arrays, None for grib_nearest
+        """
+        nnear = len(indexes)
+        indices = np.stack(indexes, axis=1).reshape(-1)
+        indptr = np.arange(0, indices.size + 1, nnear)
+        weights = np.ones(indices.size) if coeffs is None else np.stack(coeffs, axis=1).astype(np.float64, copy=False).reshape(-1)
+        return cls(indptr, indices, weights, source_size, target_shape, xs=np.asarray(xs), ys=np.asarray(ys), gather=coeffs is None)
+
+    @property
+    def pattern(self):
+        # boolean matrix used to propagate masks: a result is masked if any of its source values is masked
+        if self._pattern is None:
+            self._pattern = sparse.csr_matrix((np.ones(self.matrix.nnz, dtype=bool), self.matrix.indices, self.matrix.indptr),
+                                              shape=self.matrix.shape, copy=False)
+        return self._pattern
+
+    def _product(self, block):
+        if self._gather is not None:
+            return block[self._gather]
+        if self._workers == 1 or self.matrix.nnz < MIN_PARALLEL_NNZ:
+            return self.matrix @ block
+        # sparsetools release the GIL: blocks of rows are multiplied by parallel threads
+        if self._row_blocks is None:
+            step = -(-self.matrix.shape[0] // self._workers)
+            self._row_blocks = [(start, self.matrix[start:start + step]) for start in range(0, self.matrix.shape[0], step)]
+        out = np.empty((self.matrix.shape[0], block.shape[1]), dtype=np.float64)
+
+        def _multiply(row_block):
+            start, matrix = row_block
+            out[start:start + matrix.shape[0]] = matrix @ block
+
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            list(pool.map(_multiply, self._row_blocks))
+        return out
+
+    def apply(self, values, mv, masks=None):
+        """
+        Interpolate a list of source values arrays (one per timestep) with one sparse product.
+        :param mv: missing value, used for target points that can't be interpolated
+        :param masks: list of source masks (or None), one per timestep
+        Return a list of arrays with target shape. Results of grib intertables are filled with mv where masked,
+        results of scipy intertables are masked arrays when masks are given
+        """
+        block = np.empty((self.source_size + 1, len(values)), dtype=np.float64)
+        for k, v in enumerate(values):
+            block[:-1, k] = ma.getdata(v).reshape(-1)
+        block[-1] = mv
+        result = self._product(block)
+
+        masks = masks or [None] * len(values)
+        result_masks = None
+        if any(m is not None for m in masks):
+            mask_block = np.zeros(block.shape, dtype=bool)
+            for k, m in enumerate(masks):
+                if m is not None:
+                    mask_block[:-1, k] = m.reshape(-1)
+            result_masks = self.pattern @ mask_block
+
+        out = []
+        for k in range(len(values)):
+            res = result[:, k]
+            if self.xs is None:
+                res = res.reshape(self.target_shape)
+                if result_masks is not None and masks[k] is not None:
+                    res = ma.masked_where(result_masks[:, k].reshape(self.target_shape), res, copy=False)
+                out.append(res)
+                continue
+            if result_masks is not None and masks[k] is not None:
+                res = np.where(result_masks[:, k], mv, res)
+            grid = np.empty(self.target_shape)
+            grid.fill(mv)
+            grid[self.xs, self.ys] = res
+            out.append(grid)
+        return out
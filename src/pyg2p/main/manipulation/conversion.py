@@ -1,6 +1,6 @@
 import numexpr as ne
 from numpy import ma
-from pyg2p import Loggable
+from pyg2p import Loggable, LazyValues
 
 
 class Converter(Loggable):
@@ -43,7 +43,9 @@ class Converter(Loggable):
 
     def cut_off_negative(self, xs):
         self._log('Cutting off negative values...')
-        if isinstance(xs, dict):
+        if isinstance(xs, LazyValues):
+            return xs.map(self.cut_off_negative)
+        elif isinstance(xs, dict):
             for timestep, values in xs.items():
                 xs[timestep] = ne.evaluate('where(values<0, 0, values)')
         else:
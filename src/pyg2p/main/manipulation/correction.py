@@ -27,7 +27,8 @@ class Corrector(Loggable):
     def get_instance(cls, ctx, grid_id):
         geo_file_ = ctx.geo_file(grid_id)
         dem_map = ctx.get('correction.demMap')
-        key = f'{grid_id}{dem_map}'
+        # geopotential is interpolated on the target grid
+        key = f"{grid_id}{dem_map}{ctx.get('interpolation.latMap')}{ctx.get('interpolation.mode')}"
         if key in cls.instances:
             return cls.instances[key]
         else:
@@ -1,19 +1,29 @@
 import os
+import mmap
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
-from eccodes import (codes_is_defined,
-                     codes_index_new_from_file, codes_new_from_index, codes_new_from_file, codes_index_select,
-                     codes_index_release, codes_release,
-                     codes_get, codes_get_double_array, codes_get_double,
-                     GribInternalError, codes_get_array, CODES_PRODUCT_GRIB)
+import ujson as json
+from eccodes import (codes_is_defined, codes_new_from_file, codes_new_from_message, codes_release,
+                     codes_get, codes_get_double_array, codes_get_array, CODES_PRODUCT_GRIB)
 from numpy import ma
 
 from ...util import generics as utils
+from ...util import files
 from ...exceptions import ApplicationException, NO_MESSAGES
-from ... import Loggable, Step, GRIBInfo, GribGridDetails, Messages
+from ... import Loggable, Step, GRIBInfo, GribGridDetails, Messages, LazyValues
 
 
 class GRIBReader(Loggable):
+    # header keys read once per message and kept in memory to select messages without rescanning the file
+    catalogue_keys = ('shortName', 'perturbationNumber', 'startStep', 'endStep', 'level',
+                      'dataDate', 'dataTime', 'Nj', 'stepType', 'missingValue')
+    # catalogue is persisted in an index file in the user folder. With index_next_to_input, it's written
+    # in a sidecar file next to the GRIB (or in user folder if input folder is read-only)
+    index_suffix = '.pyg2p.idx'
+    index_version = 1
+    index_user_dir = os.path.join(os.path.expanduser('~'), '.pyg2p', 'indexes')
 
     def __repr__(self):
         return f'GRIBReader<{self._grib_file}>'
@@ -21,24 +31,20 @@ class GRIBReader(Loggable):
     def __str__(self):
         return self.__repr__()
 
-    def __init__(self, grib_file, w_perturb=False):
-        # codes_no_fail_on_wrong_length(True)
+    def __init__(self, grib_file, w_perturb=False, decode_workers=None, index_next_to_input=False):
+        # w_perturb is kept for backward compatibility: perturbationNumber is always in the catalogue
         super().__init__()
+        # with more than one worker, selected messages are decoded in parallel by a thread pool
+        self._decode_workers = decode_workers
+        self._index_next_to_input = index_next_to_input
         self._grib_file = os.path.abspath(grib_file)
-        self._file_handler = None
-        self._grbindx = None
         self._logger = logging.getLogger()
         self._log(f'Opening GRIBReader for {self._grib_file}')
-
-        try:
-            index_keys = ['shortName']
-            if w_perturb:
-                index_keys.append('perturbationNumber')
-            self._grbindx = codes_index_new_from_file(str(self._grib_file), index_keys)
-        except GribInternalError:
-            self._log(f"Can't use index on {self._grib_file}", 'WARN')
-            self._file_handler = open(self._grib_file, 'rb')
-        self._selected_grbs = []
+        self._file_handler = open(self._grib_file, 'rb')
+        self._mmap = self._map_file()
+        self._catalogue = self._load_catalogue()
+        # eccodes handles kept open after selection (first message of each spatial resolution)
+        self._aux_gids = []
         self._mv = -1
         self._step_grib = -1
         self._step_grib2 = -1
@@ -49,21 +55,149 @@ class GRIBReader(Loggable):
     @classmethod
     def get_id(cls, grib_file, reader_args):
         reader = GRIBReader(grib_file)
-        gribs_for_id = reader._get_gids(**reader_args)
-        grid = GribGridDetails(gribs_for_id[0])
+        headers = reader._get_headers(**reader_args)
+        if not headers:
+            reader.close()
+            raise ApplicationException.get_exc(NO_MESSAGES, details=f'using {reader_args}')
+        gid = reader._new_handle(headers[0])
+        grid = GribGridDetails(gid)
+        codes_release(gid)
         reader.close()
         return grid.grid_id
 
+    def _map_file(self):
+        # input is memory-mapped: messages are sliced without copies and
+        # readers on the same file (e.g. in concurrent processes) share the page cache
+        try:
+            return mmap.mmap(self._file_handler.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            # empty files or filesystems not supporting mmap
+            self._log(f"Can't memory-map {self._grib_file}: {e}. Reading from file", 'WARN')
+            return None
+
+    def _message_boundaries(self):
+        # offset and length of each message from the GRIB section 0, checking the end marker 7777.
+        # Returns None if the layout can't be trusted (e.g. GRIB1 messages larger than 8MB)
+        boundaries = []
+        offset = self._mmap.find(b'GRIB')
+        while offset != -1:
+            edition = self._mmap[offset + 7]
+            if edition == 1:
+                length = int.from_bytes(self._mmap[offset + 4:offset + 7], 'big')
+            elif edition == 2:
+                length = int.from_bytes(self._mmap[offset + 8:offset + 16], 'big')
+            else:
+                return None
+            if self._mmap[offset + length - 4:offset + length] != b'7777':
+                return None
+            boundaries.append((offset, length))
+            offset = self._mmap.find(b'GRIB', offset + length)
+        return boundaries
+
+    def _scan_headers(self):
+        # single pass over the file: only headers are parsed, data sections are not decoded
+        boundaries = self._message_boundaries() if self._mmap else None
+        if boundaries is None:
+            return self._scan_headers_from_file()
+        catalogue = []
+        for offset, length in boundaries:
+            gid = codes_new_from_message(memoryview(self._mmap)[offset:offset + length])
+            header = {k: codes_get(gid, k) for k in self.catalogue_keys if codes_is_defined(gid, k)}
+            header['offset'] = offset
+            header['totalLength'] = length
+            catalogue.append(header)
+            codes_release(gid)
+        self._log(f'Catalogued {len(catalogue)} grib messages from {self._grib_file}')
+        return catalogue
+
+    def _scan_headers_from_file(self):
+        catalogue = []
+        self._file_handler.seek(0)
+        while 1:
+            gid = codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB, headers_only=True)
+            if gid is None:
+                break
+            header = {k: codes_get(gid, k) for k in self.catalogue_keys if codes_is_defined(gid, k)}
+            header['offset'] = int(codes_get(gid, 'offset'))
+            header['totalLength'] = codes_get(gid, 'totalLength')
+            catalogue.append(header)
+            codes_release(gid)
+        self._log(f'Catalogued {len(catalogue)} grib messages from {self._grib_file}')
+        return catalogue
+
+    def _index_paths(self, writing=False):
+        # paths of index files in order of precedence. A sidecar next to the GRIB is always read if it exists
+        # (e.g. written by another user), but only written with index_next_to_input
+        sidecar_index = self._grib_file + self.index_suffix
+        user_index = os.path.join(self.index_user_dir, files.normalize_path(self._grib_file) + self.index_suffix)
+        if self._index_next_to_input:
+            return sidecar_index, user_index
+        return (user_index,) if writing else (user_index, sidecar_index)
+
+    def _index_signature(self):
+        stat = os.stat(self._grib_file)
+        return {'version': self.index_version, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                'keys': list(self.catalogue_keys)}
+
+    def _load_catalogue(self):
+        # reuse a sidecar index if it was written for this very file (same size and mtime)
+        signature = self._index_signature()
+        for index_path in self._index_paths():
+            if not files.exists(index_path):
+                continue
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if index.get('signature') == signature:
+                self._log(f'Using GRIB index {index_path}')
+                return index['messages']
+            self._log(f'GRIB index {index_path} is outdated')
+        catalogue = self._scan_headers()
+        self._dump_catalogue(catalogue, signature)
+        return catalogue
+
+    def _dump_catalogue(self, catalogue, signature):
+        for index_path in self._index_paths(writing=True):
+            index_dir = os.path.dirname(index_path)
+            try:
+                files.create_dir(index_dir)
+                if not files.can_write(index_dir):
+                    continue
+                # write and rename, so that concurrent readers never load a partial index
+                tmp_path = f'{index_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'signature': signature, 'messages': catalogue}, f)
+                os.replace(tmp_path, index_path)
+            except OSError as e:
+                self._log(f"Can't write GRIB index {index_path}: {e}", 'WARN')
+                continue
+            self._log(f'Written GRIB index {index_path}')
+            return
+
+    def _read_message(self, header):
+        # raw bytes of a single GRIB message
+        if self._mmap:
+            return memoryview(self._mmap)[header['offset']:header['offset'] + header['totalLength']]
+        self._file_handler.seek(header['offset'])
+        return self._file_handler.read(header['totalLength'])
+
+    def _new_handle(self, header):
+        # build an eccodes handle only for a message that is going to be decoded
+        return codes_new_from_message(self._read_message(header))
+
     @staticmethod
-    def _find(gid, **kwargs):
+    def _find(header, **kwargs):
         for k, v in kwargs.items():
-            if not codes_is_defined(gid, k):
+            if k not in header:
                 return False
+            value = header[k]
             iscontainer = utils.is_container(v)
             iscallable = utils.is_callable(v)
-            if (not iscontainer and not iscallable and codes_get(gid, k) == v) or\
-                    (iscontainer and codes_get(gid, k) in v) or \
-                    (iscallable and v(codes_get(gid, k))):
+            if (not iscontainer and not iscallable and value == v) or\
+                    (iscontainer and value in v) or \
+                    (iscallable and v(value)):
                 continue
             else:
                 return False
@@ -71,155 +205,153 @@ class GRIBReader(Loggable):
 
     def close(self):
         self._log(f'Closing gribs messages from {self._grib_file}')
-        for g in self._selected_grbs:
-            codes_release(g)
-        self._selected_grbs = None
-        if self._grbindx:
-            codes_index_release(self._grbindx)
-            self._grbindx = None
+        self._release_aux()
+        if self._mmap:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # some message slices are still referenced: mapping is released when they are collected
+                pass
+            self._mmap = None
         if self._file_handler:
             self._file_handler.close()
             self._file_handler = None
 
     def has_geopotential(self):
-        has_geo = False
         from pyg2p.main.config import GeopotentialsConfiguration
         v_selected = GeopotentialsConfiguration.short_names
-        if self._grbindx:
-            for v in v_selected:
-                codes_index_select(self._grbindx, 'shortName', str(v))
-                while 1:
-                    gid = codes_new_from_index(self._grbindx)
-                    if gid is None:
-                        break
-                    has_geo = True
-                    codes_release(gid)
-
-        elif self._file_handler:
-            while 1:
-                gid = codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB)
-                if gid is None:
-                    break
-                has_geo = True
-                codes_release(gid)
-        return has_geo
+        return any(h.get('shortName') in v_selected for h in self._catalogue)
 
     def scan_grib(self, **kwargs):
-        gribs = []
+        # returns catalogue headers of matching messages, grouped by shortName in the order they were requested
         v_selected = kwargs['shortName']
-        v_pert = kwargs.get('perturbationNumber', -1)
         if not utils.is_container(v_selected):
             v_selected = [v_selected]
-        if self._grbindx:
-            for v in v_selected:
-                codes_index_select(self._grbindx, 'shortName', str(v))
-                if v_pert != -1:
-                    codes_index_select(self._grbindx, 'perturbationNumber', int(v_pert))
-                while 1:
-                    gid = codes_new_from_index(self._grbindx)
-                    if gid is None:
-                        break
-                    if GRIBReader._find(gid, **kwargs):
-                        gribs.append(gid)
-                    else:
-                        # release unused grib
-                        codes_release(gid)
-        elif self._file_handler:
-            while 1:
-                gid = codes_new_from_file(self._file_handler, product_kind=CODES_PRODUCT_GRIB)
-                if gid is None:
-                    break
-                if GRIBReader._find(gid, **kwargs):
-                    gribs.append(gid)
-                else:
-                    # release unused grib
-                    codes_release(gid)
-        return gribs
-
-    def _get_gids(self, **kwargs):
+        headers = []
+        for v in dict.fromkeys(str(v) for v in v_selected):
+            headers += [h for h in self._catalogue if h.get('shortName') == v and GRIBReader._find(h, **kwargs)]
+        return headers
+
+    def _get_headers(self, **kwargs):
+        headers = self.scan_grib(**kwargs)
+        if (len(headers) == 0) and ('startStep' in kwargs and utils.is_callable(kwargs['startStep']) and not kwargs['startStep'](0)):
+            kwargs['startStep'] = lambda s: s >= 0
+            headers = self.scan_grib(**kwargs)
+        return headers
+
+    def _decode(self, header):
+        # values are decoded only when requested and the eccodes handle is released straight after
+        return self._decode_message(self._read_message(header))
+
+    @staticmethod
+    def _decode_message(message):
+        gid = codes_new_from_message(message)
         try:
-            gribs = self.scan_grib(**kwargs)
-            if (len(gribs) == 0) and ('startStep' in kwargs and utils.is_callable(kwargs['startStep']) and not kwargs['startStep'](0)):
-                kwargs['startStep'] = lambda s: s >= 0
-                gribs = self.scan_grib(**kwargs)
-            return gribs
-        except ValueError:
-            raise ApplicationException.get_exc(NO_MESSAGES, details=f'using {kwargs}')
+            values = codes_get_double_array(gid, 'values')
+            # Handling missing grib values.
+            # If bitmap is present, array will be a masked_array
+            # and array.mask will be used later
+            # in interpolation and manipulation
+            bitmap_present = codes_get(gid, 'bitmapPresent')
+            if bitmap_present:
+                # Get the bitmap array which contains 0s and 1s
+                bitmap = codes_get_array(gid, 'bitmap', int)
+                values = ma.masked_where(bitmap == 0, values, copy=False)
+        finally:
+            codes_release(gid)
+        return values
+
+    def _release_aux(self):
+        for g in self._aux_gids:
+            codes_release(g)
+        self._aux_gids = []
 
     def select_messages(self, **kwargs):
-        self._selected_grbs = self._get_gids(**kwargs)
-        self._log(f'Selected {len(self._selected_grbs)} grib messages')
-
-        if len(self._selected_grbs) > 0:
-            self._gid_main_res = self._selected_grbs[0]
-            grid = GribGridDetails(self._selected_grbs[0])
+        headers = self._get_headers(**kwargs)
+        self._log(f'Selected {len(headers)} grib messages')
+
+        if len(headers) > 0:
+            self._release_aux()
+            # handle of the first message is kept open: it's used for grid coordinates and grib intertables
+            self._gid_main_res = self._new_handle(headers[0])
+            self._gid_ext_res = None
+            self._aux_gids.append(self._gid_main_res)
+            grid = GribGridDetails(self._gid_main_res)
             # some cumulated messages come with the message at step=0 as instant, to permit aggregation
             # cumulated rainfall rates could have the step zero instant message as kg/m^2, instead of kg/(m^2*s)
-            if len(self._selected_grbs) > 1:
-                unit = codes_get(self._selected_grbs[1], 'units')
-                type_of_step = codes_get(self._selected_grbs[1], 'stepType')
+            if len(headers) > 1:
+                gid = self._new_handle(headers[1])
+                unit = codes_get(gid, 'units')
+                codes_release(gid)
+                type_of_step = headers[1]['stepType']
             else:
-                type_of_step = codes_get(self._selected_grbs[0], 'stepType')
-                unit = codes_get(self._selected_grbs[0], 'units')
+                type_of_step = headers[0]['stepType']
+                unit = codes_get(self._gid_main_res, 'units')
 
-            step_units = codes_get(self._selected_grbs[0], 'stepUnits', ktype=str) 
+            step_units = codes_get(self._gid_main_res, 'stepUnits', ktype=str)
 
-            type_of_level = codes_get(self._selected_grbs[0], 'levelType')
+            type_of_level = codes_get(self._gid_main_res, 'levelType')
 
-            missing_value = codes_get(self._selected_grbs[0], 'missingValue')
-            data_date = codes_get(self._selected_grbs[0], 'dataDate')
-            data_time = codes_get(self._selected_grbs[0], 'dataTime')
+            missing_value = headers[0]['missingValue']
+            data_date = headers[0]['dataDate']
+            data_time = headers[0]['dataTime']
             all_values = {}
             all_values_second_res = {}
             grid2 = None
             input_step = self._step_grib
-            for g in self._selected_grbs:
-                start_step = codes_get(g, 'startStep')
-                end_step = codes_get(g, 'endStep')
-                points_meridian = codes_get(g, 'Nj')
-                level = codes_get(g, 'level')
+            for h in headers:
+                start_step = h['startStep']
+                end_step = h['endStep']
+                points_meridian = h['Nj']
+                level = h['level']
                 if f'{start_step}-{end_step}' == self._change_step_at:
                     # second time resolution
                     input_step = self._step_grib2
 
                 step_key = Step(start_step, end_step, points_meridian, input_step, level)
 
-                if points_meridian != grid.num_points_along_meridian and grid.get_2nd_resolution() is None:
+                if points_meridian != grid.num_points_along_meridian and not grid2:
                     # found second resolution messages
-                    grid2 = GribGridDetails(g)
-                    self._gid_ext_res = g
-                values = codes_get_double_array(g, 'values')
-
-                # Handling missing grib values.
-                # If bitmap is present, array will be a masked_array
-                # and array.mask will be used later
-                # in interpolation and manipulation
-                bitmap_present = codes_get(g, 'bitmapPresent')
-                if bitmap_present:
-                    # Get the bitmap array which contains 0s and 1s
-                    bitmap = codes_get_array(g, 'bitmap', int)
-                    values = ma.masked_where(bitmap == 0, values, copy=False)
+                    self._gid_ext_res = self._new_handle(h)
+                    self._aux_gids.append(self._gid_ext_res)
+                    grid2 = GribGridDetails(self._gid_ext_res)
 
                 if not grid2:
-                    all_values[step_key] = values
+                    all_values[step_key] = h
                 elif points_meridian != grid.num_points_along_meridian:
-                    all_values_second_res[step_key] = values
+                    all_values_second_res[step_key] = h
 
             if grid2:
                 key_2nd_spatial_res = min(all_values_second_res.keys())
                 grid.set_2nd_resolution(grid2, key_2nd_spatial_res)
-            return Messages(all_values, missing_value, unit, type_of_level, type_of_step, step_units, grid, all_values_second_res, data_date=data_date, data_time=str(data_time)[:2])
+            if self._decode_workers and self._decode_workers > 1:
+                all_values, all_values_second_res = self._decode_parallel(all_values, all_values_second_res)
+            else:
+                all_values = LazyValues({k: partial(self._decode, h) for k, h in all_values.items()})
+                all_values_second_res = LazyValues({k: partial(self._decode, h) for k, h in all_values_second_res.items()})
+            return Messages(all_values, missing_value, unit, type_of_level, type_of_step, step_units, grid,
+                            all_values_second_res, data_date=data_date, data_time=str(data_time)[:2])
         # no messages found
         else:
             raise ApplicationException.get_exc(NO_MESSAGES, details=f'using {kwargs}')
 
+    def _decode_parallel(self, *headers_dicts):
+        # file is read sequentially, then eccodes decoding (which releases the GIL) runs in worker threads.
+        # Values are all decoded upfront, in the same order of the serial path.
+        keys = [k for headers in headers_dicts for k in headers]
+        messages = [self._read_message(headers[k]) for headers in headers_dicts for k in headers]
+        self._log(f'Decoding {len(messages)} grib messages with {self._decode_workers} workers')
+        with ThreadPoolExecutor(max_workers=self._decode_workers) as pool:
+            decoded = dict(zip(keys, pool.map(self._decode_message, messages)))
+        return tuple({k: decoded[k] for k in headers} for headers in headers_dicts)
+
     @staticmethod
-    def _find_start_end_steps(gribs):
+    def _find_start_end_steps(headers):
         # return input_steps,
         # change step if a second time resolution is found
 
-        start_steps = [codes_get(gribs[i], 'startStep') for i in range(len(gribs))]
-        end_steps = [codes_get(gribs[i], 'endStep') for i in range(len(gribs))]
+        start_steps = [h['startStep'] for h in headers]
+        end_steps = [h['endStep'] for h in headers]
         start_grib = min(start_steps)
         end_grib = max(end_steps)
         ord_end_steps = sorted(end_steps)
@@ -241,18 +373,14 @@ class GRIBReader(Loggable):
         return start_grib, end_grib, step, step2, change_step_at
 
     def get_grib_info(self, select_args):
-        _gribs_for_utils = self._get_gids(**select_args)
-        if len(_gribs_for_utils) > 0:
+        headers = self._get_headers(**select_args)
+        if len(headers) > 0:
             # instant, avg, cumul. get last stepType available because first one is sometimes misleading
-            type_of_step = codes_get(_gribs_for_utils[-1], 'stepType')
-            self._mv = codes_get_double(_gribs_for_utils[0], 'missingValue')
-            start_grib, end_grib, self._step_grib, self._step_grib2, self._change_step_at = self._find_start_end_steps(_gribs_for_utils)
+            type_of_step = headers[-1]['stepType']
+            self._mv = float(headers[0]['missingValue'])
+            start_grib, end_grib, self._step_grib, self._step_grib2, self._change_step_at = self._find_start_end_steps(headers)
             self._log("Grib input step %d [type of step: %s]" % (self._step_grib, type_of_step))
             self._log('Gribs from %d to %d' % (start_grib, end_grib))
-            for g in _gribs_for_utils:
-                codes_release(g)
-            _gribs_for_utils = None
-            del _gribs_for_utils
             info = GRIBInfo(input_step=self._step_grib, input_step2=self._step_grib2,
                             change_step_at=self._change_step_at, type_of_param=type_of_step,
                             start=start_grib, end=end_grib, mv=self._mv)
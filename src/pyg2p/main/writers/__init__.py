@@ -1,10 +1,12 @@
 import os
 import abc
 import collections
+import threading
 
 import numpy as np
 
 from pyg2p import Loggable
+from pyg2p.util import files
 from pyg2p.main.interpolation import Interpolator
 from pyg2p.main.manipulation.correction import Corrector
 
@@ -30,6 +32,9 @@ class OutputWriter(Loggable):
     """
     This class performs interpolation and write resulting values to PCRaster/netCDF files.
     """
+    # netCDF/HDF5 and GDAL files are written one at a time when several targets are processed in parallel
+    _WRITE_LOCK = threading.Lock()
+
     def __init__(self, ctx, grib_info):
         super().__init__()
         self.ctx = ctx
@@ -46,22 +51,10 @@ class OutputWriter(Loggable):
         Note that lats and lons values are prepared from netcdf writer init_dataset method
         They come from latitude/longitude pcraster maps values
         """
-        is_second_res = False
-        lats, longs = messages.latlons
-        geodetic_info = messages.grid_details
-        grid_id = messages.grid_id
         time_values = []
         out_values = []
-        for i, (timestep, v) in enumerate(values.items()):
+        for timestep, grid_id, out_v in self.interpolator.interpolate_timesteps(values, messages, change_res_step):
             # note: timestep and change_res_step are instances of domain.step.Step class
-            # writing map i
-            if messages.have_resolution_change() and timestep == change_res_step:
-                # Switching to second resolution
-                lats, longs = messages.latlons_2nd
-                geodetic_info = messages.grid_details.get_2nd_resolution()
-                grid_id = messages.grid2_id
-                is_second_res = True
-            out_v = self.interpolator.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res)
             if self.ctx.must_do_correction:
                 corrector = Corrector.get_instance(self.ctx, grid_id)
                 out_v = corrector.correct(out_v)
@@ -83,30 +76,21 @@ class OutputWriter(Loggable):
                         value_format=self.ctx.get('outMaps.valueFormat'),
                         offset=self.ctx.get('outMaps.offset'),
                         scale_factor=self.ctx.get('outMaps.scaleFactor'))
-        self.writer.init_dataset(out_filename)
+        with self._WRITE_LOCK:
+            self.writer.init_dataset(out_filename)
 
-        self.writer.write(out_values, time_values, **var_args)
+            self.writer.write(out_values, time_values, **var_args)
 
     def _write_maps_pcraster(self, values, messages, change_res_step):
-        is_second_res = False
-        lats, longs = messages.latlons
-        geodetic_info = messages.grid_details
-        grid_id = messages.grid_id
-
-        for i, (timestep, v) in enumerate(values.items(), start=1):
+        interpolated = self.interpolator.interpolate_timesteps(values, messages, change_res_step)
+        for i, (timestep, grid_id, out_v) in enumerate(interpolated, start=1):
             # note: timestep and change_res_step are instances of pyg2p.Step class
             # writing map i
-            if messages.have_resolution_change() and timestep == change_res_step:
-                # Switching to second resolution
-                lats, longs = messages.latlons_2nd
-                geodetic_info = messages.grid_details.get_2nd_resolution()
-                grid_id = messages.grid2_id
-                is_second_res = True
-            out_v = self.interpolator.interpolate(lats, longs, v, grid_id, geodetic_info, is_second_res=is_second_res)
             if self.ctx.must_do_correction:
                 corrector = Corrector.get_instance(self.ctx, grid_id)
                 out_v = corrector.correct(out_v)
-            self.writer.write(self._name_pcr_map(i), out_v)
+            with self._WRITE_LOCK:
+                self.writer.write(self._name_pcr_map(i), out_v)
 
     def write_maps(self, values, messages, change_res_step=None):
         write_method = getattr(self, f"_write_maps_{self.ctx.get('outMaps.format')}")
@@ -116,9 +100,17 @@ class OutputWriter(Loggable):
 
     def _name_netcdf_file(self):
         filename = f"{self.ctx.get('outMaps.namePrefix')}_{self.ctx.get('aggregation.type')}.nc"
-        out_filename = os.path.join(self.ctx.get('outMaps.outDir'), filename)
+        out_filename = os.path.join(self._out_dir(), filename)
         return out_filename
 
+    def _out_dir(self):
+        out_dir = self.ctx.get('outMaps.outDir')
+        if self.ctx.is_multi_member:
+            # one subfolder for each EPS member (e.g. out_dir/01/)
+            out_dir = os.path.join(out_dir, f"{self.ctx.get('parameter.perturbationNumber'):02d}")
+            files.create_dir(out_dir)
+        return out_dir
+
     def _name_pcr_map(self, i_map):
         # Used for pcraster output maps
         # return a full path for output map, of the type 8.3  {prefix}[000000].0[0]{seq}
@@ -129,7 +121,7 @@ class OutputWriter(Loggable):
             filename += '0'
         filename += str(map_number)
         filename = filename[0:8] + '.' + filename[8:11]
-        filename = os.path.join(self.ctx.get('outMaps.outDir'), filename)
+        filename = os.path.join(self._out_dir(), filename)
         return filename
 
     def close(self):
@@ -6,6 +6,7 @@ import numpy.ma as ma
 from netCDF4 import Dataset, default_fillvals
 
 from pyg2p.main.readers.pcr import PCRasterReader
+import pyg2p.util.files
 from pyg2p.main.writers import Writer
 from pyg2p.exceptions import ApplicationException, INVALID_INTERPOL_METHOD
 from pyg2p.main.readers.netcdf import NetCDFReader
@@ -18,38 +19,50 @@ class NetCDFWriter(Writer):
     FORMAT = 'netcdf'
     esri_pe_string = 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["Degree",0.0174532925199433]]'
 
+    # clone and coordinates already read in this process (e.g. by previous jobs of a daemon worker)
+    _GRIDS = {}
+
     def __init__(self, *args):
         super().__init__(*args)
         self.nf = None
         self.filepath = None
         lats_map, lons_map = args[1], args[2]
+        key = pyg2p.util.files.signature(self._clone_map, lats_map, lons_map)
+        if key not in self._GRIDS:
+            self._GRIDS[key] = self._read_grids(lats_map, lons_map)
+        self.area, self._mask, self.lats, self.lons = self._GRIDS[key]
+
+    def _read_grids(self, lats_map, lons_map):
         if self._clone_map.endswith('.nc'):
             area = NetCDFReader(self._clone_map)
-            self.area = area.values
+            area_values = area.values
         else:
             area = PCRasterReader(self._clone_map)
-            self.area = area.values
+            area_values = area.values
         
         # add mask from clone map
-        self.area = ma.masked_values(self.area, area.mv)
-        self._mask = ma.getmask(self.area)
+        area_values = ma.masked_values(area_values, area.mv)
+        mask = ma.getmask(area_values)
         
         if lats_map.endswith('.nc'):
             if (lats_map!=lons_map):
                 raise ApplicationException.get_exc(INVALID_INTERPOL_METHOD, 
                     f"lat map and long map should coincide when using netCDF target map, used {lats_map} amd {lons_map}")
 
-            self.lats_map = NetCDFReader(lats_map)
-            self.lats, self.lons = self.lats_map.get_lat_lon_values()
+            lats, lons = NetCDFReader(lats_map).get_lat_lon_values()
         else:
-            self.lats_map = PCRasterReader(lats_map)
-            coordinates_mv = self.lats_map.mv
-            self.lats = self.lats_map.values
-            self.lons = PCRasterReader(lons_map).values
-            self.lats[self.lats == coordinates_mv] = np.nan
-            self.lons[self.lons == coordinates_mv] = np.nan
+            lats_reader = PCRasterReader(lats_map)
+            coordinates_mv = lats_reader.mv
+            lats = lats_reader.values
+            lons = PCRasterReader(lons_map).values
+            lats[lats == coordinates_mv] = np.nan
+            lons[lons == coordinates_mv] = np.nan
+        return area_values, mask, lats, lons
 
     def init_dataset(self, out_filename):
+        if self.nf:
+            # a new dataset is started for each EPS member
+            self.nf.close()
         self.nf = Dataset(out_filename, 'w', format='NETCDF4_CLASSIC')
         self.filepath = out_filename
         time_created = time.ctime(time.time())
@@ -95,6 +95,11 @@ def copy_dir(source_dir, target_dir, recreate=False):
         [copy(f, target_dir) for f in contents]
 
 
+def normalize_path(pathname):
+    # flat filename from an absolute path, e.g. /data/eps/input.grb -> data_eps_input.grb
+    return os.path.abspath(pathname).strip(os.sep).replace(os.sep, '_')
+
+
 def normalize_filename(name):
 
     normalized_name = without_ext(name).lower()
@@ -108,3 +113,15 @@ def normalize_filename(name):
         return name.replace('.', '_')
     # return only first 10 chars
     return normalized_name[:10]
+
+
+def signature(*pathnames):
+    # modification time and size of files, to reuse data read from them as long as they don't change
+    sig = []
+    for pathname in pathnames:
+        try:
+            stat = os.stat(pathname)
+            sig.append((pathname, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            sig.append((pathname, None, None))
+    return tuple(sig)
@@ -33,6 +33,47 @@ def to_argdict(string_):
     return dict(zip(c[0::2], c[1::2]))
 
 
+def to_members(string_):
+    """
+    Parse the EPS members selector.
+
+    Return: an int for a single member (e.g. '10'), a sorted list of ints for lists and ranges
+    (e.g. '1,3,5', '1-50', '0-10,20') or the string 'all'.
+    """
+    if string_.strip().lower() == 'all':
+        return 'all'
+    if string_.strip().lstrip('-').isdigit():
+        return int(string_)
+    members = set()
+    for item in string_.split(','):
+        start, sep, end = item.strip().partition('-')
+        members.update(range(int(start), int(end) + 1) if sep else [int(start)])
+    return sorted(members)
+
+
+def to_list(string_):
+    """
+    Parse a comma separated list of names (e.g. 'nearest,invdist,adw').
+
+    Return: a list of strings, without blanks and duplicates, in the given order
+    """
+    items = [item.strip() for item in string_.split(',')] if isinstance(string_, str) else list(string_)
+    return list(dict.fromkeys(item for item in items if item))
+
+
+def to_bytes(string_):
+    """
+    Parse a memory size, in bytes or with a K, M, G, T suffix (powers of 1024, e.g. '16G', '512M', '1.5GB').
+
+    Return: the number of bytes as an int
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([KMGT]?)i?B?\s*', str(string_), re.IGNORECASE)
+    if not match:
+        raise ValueError(f'Invalid memory size: {string_}')
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
+
 FALSE_STRINGS = ['FALSE', 'F', 'f', 'False', 'false', 'NO', 'no', 'No', '0', 'off', 'OFF', 'Off', 'nO']
 
 
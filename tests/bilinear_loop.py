@@ -0,0 +1,233 @@
+"""
+Reference implementation of ScipyInterpolation._build_weights_bilinear, one target point at a time, used to check
+the weights built in parallel retry rounds. The method is the one of pyg2p before retry rounds, unchanged.
+"""
+from sys import stdout
+
+import numpy as np
+import scipy.optimize as opt
+
+from pyg2p.exceptions import ApplicationException, WEIRD_STUFF
+from pyg2p.main.interpolation.scipy_interpolation_lib import (
+    get_correct_lats_lons, get_clockwise_points, getWrongPointDirection, getWrongPointGridLikeShape,
+    getWrongPointBestGridLikeShape, isConvexQuadrilateral, getNonConvexVertex, isPointInQuadrilateral,
+)
+from pyg2p.util.generics import progress_step_and_backchar
+from pyg2p.util.numeric import mask_it, empty
+
+
+def build_weights_bilinear_loop(interpolation, distances, indexes, efas_locations, nnear):
+    return PointByPointBilinear._build_weights_bilinear(interpolation, distances, indexes, efas_locations, nnear)
+
+
+class PointByPointBilinear:
+    def _build_weights_bilinear(self, distances, indexes, efas_locations, nnear):
+        z = self.z
+        result = mask_it(np.empty((len(distances),) +
+                         np.shape(z[0])), self._mv_target, 1)
+        weights = np.empty((len(distances),) + (nnear,))
+        idxs = empty((len(indexes),) + (nnear,), fill_value=z.size, dtype=int)
+        weight1 = empty((len(distances),))
+        weight2 = empty((len(distances),))
+        weight3 = empty((len(distances),))
+        weight4 = empty((len(distances),))
+        empty_array = empty(z[0].shape, self._mv_target)
+
+        self.lat_inALL = self.target_latsOR.ravel()
+        self.lon_inALL = self.target_lonsOR.ravel()
+
+        num_cells = result.size
+        back_char, progress_step = progress_step_and_backchar(num_cells)
+
+        stdout.write('Skipping bilinear interpolation at distance > {}\n'.format(self.min_upper_bound))
+        stdout.write('{}Building coeffs: 0/{} [outs: 0] (0%)'.format(back_char, num_cells))
+        stdout.flush()
+
+        outs = 0            # number of points falling outside the min_upper_bound distance
+        not_in_quad = 0     # number of points falling outside quadrilaterals after max_retries
+
+        # max number of retry equals to a full lenght of lon coordinates
+        max_retries = self.target_lonsOR.shape[0]        
+        max_used_additional_points = 0
+        nn_max_used_additional_points = -1
+
+        latgrib_max = self.latgrib.max()
+        latgrib_min = self.latgrib.min()
+        longrib_max = self.longrib.max()
+        longrib_min = self.longrib.min()
+        # evaluate an approx_grib_resolution by using 10 times the first longidure values 
+        # to check if the whole globe is covered
+        approx_grib_resolution = abs(self.longrib[0]-self.longrib[1])*1.5
+        is_global_map = (360-(longrib_max-longrib_min))<approx_grib_resolution
+        # for nn in range(25898400,len(indexes)):
+        for nn in range(len(indexes)):
+            skip_current_point = False
+            if nn % progress_step == 0:
+                stdout.write('{}Building coeffs: {}/{} [outs: {}] ({:.2f}%)'.format(back_char, nn, num_cells, outs, nn * 100. / num_cells))
+                stdout.flush()
+
+            dist = distances[nn]
+            ix = indexes[nn]
+            self.lat_in = self.lat_inALL[nn]
+            self.lon_in = self.lon_inALL[nn]
+
+            # if DEBUG_BILINEAR_INTERPOLATION:
+            #     # # if nn==14753:
+            #     # if nn==72759:
+            # if nn==25898400:
+            #     print('self.lat_in = {}, self.lon_in = {}, nn = {}'.format(self.lat_in,self.lon_in,nn))
+            #     if abs(self.lat_in-69.958)<0.02 and abs(self.lon_in-(-23.608))<0.02:
+            #         print('self.lat_in = {}, self.lon_in = {}, nn = {}'.format(self.lat_in,self.lon_in,nn))
+
+            # check distances 
+            if dist[0] <= 1e-10:  
+                result[nn] = z[ix[0]]  # take exactly the point, weight = 1
+                idxs[nn] = ix
+                weights[nn] = np.array([1., 0., 0., 0.])
+            elif dist[0] > self.min_upper_bound:
+                outs += 1
+                idxs[nn] = ix
+                weights[nn] = np.array([np.nan, 0., 0., 0.])
+                result[nn] = empty_array
+            else:
+                self.target_location = efas_locations[nn]
+                additional_points = 0
+                quadrilateral_is_ok = False
+                # additional checks only if source_grid_is_rotated is False
+                if self.source_grid_is_rotated == False:
+                    additional_checks_completed = False
+                else:
+                    additional_checks_completed = True
+                    max_retries = 20
+                while quadrilateral_is_ok == False and additional_points<max_retries:  
+                    # find the 4 corners
+                    i1, i2, i3, i4 = indexes[nn, 0:4]
+                    idxs[nn, :] = indexes[nn, 0:4]
+
+                    # check the point on lat lon coords system:
+                    # I need that my location falls in the quadrilateral
+                    # (actually the quadrilateral should be convex as per bilinear interpolation (bilinear warp) definition,
+                    # but the interpolation works also on non-convex poligon
+                    # N.B: when the quadrilateral is not a rectangle, we have a so called "bilinear transformation, 
+                    # bilinear warp or bilinear distortion", instead of a bilinear interpolation. 
+                    # See : https://en.wikipedia.org/wiki/Bilinear_interpolation
+
+                    lats, lons = get_correct_lats_lons(self.lat_in, self.lon_in, self.latgrib, self.longrib, i1, i2, i3, i4)
+
+                    corners_points = np.array([[lats[0], lons[0], self.z[i1], i1],
+                        [lats[1], lons[1], self.z[i2], i2],
+                        [lats[2], lons[2], self.z[i3], i3],
+                        [lats[3], lons[3], self.z[i4], i4]])
+
+                    # in non-global maps, skip all points falling outside the grib min and max values
+                    if is_global_map==False and \
+                        (self.lat_in>latgrib_max or self.lat_in<latgrib_min or self.lon_in>longrib_max or self.lon_in<longrib_min):
+                            quadrilateral_is_ok = True
+                            outs += 1
+                            weights[nn] = np.array([np.nan, 0., 0., 0.])
+                            result[nn] = empty_array
+                            skip_current_point = True
+
+                    # check grib type (if grig is on parallels or projected (self.source_grid_is_rotated=True))
+                    # in case we are not in parallel-like grib files, let's use the old bilinear method 
+                    # that works with every grid but is less precise
+                    # see here for possible grib files https://apps.ecmwf.int/codes/grib/format/grib1/grids/10/
+                    if additional_checks_completed == False and skip_current_point == False:
+                        # the grib file has different number of longitude points for each latitude,
+                        # thus I will make sure to use only 2 above and two below of the current point
+                        # the function will return the wrong point, if any
+                        index_wrong_points = getWrongPointDirection(self.lat_in, self.lon_in, corners_points)
+                        if len(index_wrong_points):
+                            # check if the latitude point is above the maximum or below the minimun latitude, 
+                            if self.lat_in>latgrib_max or self.lat_in<latgrib_min:
+                                # to speed up the process and retrieve better "close points" from the KDTree 
+                                # I will look for nearest points of the opposite side of the globe
+                                if self.replaceIndexOppositeSide(index_wrong_points, indexes, nn) == False:
+                                    # if there is no replacement with 4 points, get only the nearest point
+                                    quadrilateral_is_ok = True
+                                    outs += 1
+                                    result[nn] = z[idxs[nn,0]]  # take exactly the point, weight = 1
+                                    weights[nn] = np.array([1., 0., 0., 0.])
+                                    skip_current_point = True
+
+                            else:
+                                additional_points = self.replaceIndex(index_wrong_points, indexes, nn, additional_points)
+                        else:
+                            # check for points in grid-like shape
+                            index_wrong_point = getWrongPointGridLikeShape(self.lat_in, self.lon_in, corners_points)
+                            if index_wrong_point is not None:
+                                additional_points = self.replaceIndex([index_wrong_point], indexes, nn, additional_points)
+                            else:
+                                # check for best grid-like shape:
+                                index_wrong_point, new_lat, new_lon = getWrongPointBestGridLikeShape(self.lat_in, self.lon_in, corners_points)
+                                if index_wrong_point is not None:
+                                    self.replaceIndexCloseToPoint([index_wrong_point], new_lat, new_lon, indexes, nn)
+                                else:
+                                    additional_checks_completed = True
+                    if additional_checks_completed == True and skip_current_point == False:
+                        #get p1,p2,p3,p4 in clockwise order
+                        self.p1, self.p2, self.p3, self.p4 = get_clockwise_points(corners_points)
+                        # check for convexity
+                        is_convex = isConvexQuadrilateral(self.p1[0:2], self.p2[0:2], self.p3[0:2], self.p4[0:2])
+                        if self.source_grid_is_rotated:
+                            # in case of rotated grid, actually the convexity check give worst results
+                            # so let's just skip this check
+                            is_convex = True 
+
+                        index_nonconvex = -1
+                        if is_convex == False:                            
+                            index_nonconvex = getNonConvexVertex(self.p1, 
+                                                    self.p2, 
+                                                    self.p3, 
+                                                    self.p4,)
+                            if (index_nonconvex is None):
+                                print("Error, index_nonconvex is None for nn={}".format(nn))
+                            
+                            assert(index_nonconvex is not None)    
+                            additional_points = self.replaceIndex([index_nonconvex], indexes, nn, additional_points)
+                        else:
+                            # check for point in quadrilateral
+                            is_in_quadrilateral = isPointInQuadrilateral([self.lat_in,self.lon_in], 
+                                                                            self.p1[0:2], 
+                                                                            self.p2[0:2], 
+                                                                            self.p3[0:2], 
+                                                                            self.p4[0:2], 
+                                                                            is_convex)
+                            if is_in_quadrilateral == False:
+                                # get rid of the wrong point (the actual farthest one) and add the new one 
+                                # (that is the farthest in the new list of replacement_indexes)
+                                additional_points = self.replaceIndex([indexes[nn, 3]], indexes, nn, additional_points)                                
+                            else:
+                                quadrilateral_is_ok = True
+
+                if skip_current_point == False:
+                    if max_used_additional_points<additional_points:
+                        max_used_additional_points = additional_points
+                        nn_max_used_additional_points = nn
+                        print("\nmax_used_additional_points: {}, nn_max_used_additional_points: {}".format(max_used_additional_points, nn_max_used_additional_points))
+
+                    try:
+                        assert(len(np.unique(indexes[nn, 0:4]))==4) 
+                    except AssertionError as e:
+                        ApplicationException.get_exc(WEIRD_STUFF, details=str(e) + "\nLess then 4 distinct point! nn={} lat={} lon={}".format(nn, self.lat_in, self.lon_in))
+                    
+                    if quadrilateral_is_ok==False:
+                        #print("\nError: quadrilateral_is_ok is False, failed to find a correct quadrilateral: nn is {}, lat={} lon={}".format(nn, self.lat_in, self.lon_in))
+                        not_in_quad+=1
+
+                    [alpha, beta] = np.clip(opt.fsolve(self._functionAlphaBeta, (0.5, 0.5)), 0, 1)
+                    weight1[nn] = (1-alpha)*(1-beta)
+                    weight2[nn] = alpha*(1-beta)
+                    weight3[nn] = alpha*beta
+                    weight4[nn] = (1-alpha)*beta
+
+                    weights[nn, 0:4] = np.array([weight1[nn], weight2[nn], weight3[nn], weight4[nn]])
+                    idxs[nn, 0:4] = np.array([self.p1[3], self.p2[3], self.p3[3], self.p4[3]])
+                    result[nn] = weight1[nn]*self.p1[2] + weight2[nn]*self.p2[2] + weight3[nn] * self.p3[2] + weight4[nn] * self.p4[2]  
+
+        stdout.write('{}{:>100}'.format(back_char, ' '))
+        stdout.write('{}Building coeffs: {}/{} [outs: {}, not_in_quad: {}] (100%)\n'.format(back_char, num_cells, num_cells, outs, not_in_quad))
+        stdout.write('debug info: max_used_additional_points is {}, nn is {}\n'.format(max_used_additional_points, nn_max_used_additional_points))
+        stdout.flush()
+
+        return result, weights, idxs
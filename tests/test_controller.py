@@ -0,0 +1,82 @@
+import json
+from copy import deepcopy
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from pyg2p.exceptions import ApplicationException, MISSING_FORMULAS_IN_EXEC, NO_MESSAGES
+from pyg2p.main import pyg2p_exe
+from pyg2p.main.context import ExecutionContext
+from pyg2p.main.controller import Controller
+from pyg2p.main.readers import GRIBReader, PCRasterReader
+
+from tests import config_dict
+
+
+class TestMultiTarget:
+    out_maps = {
+        '@cloneMap': 'tests/data/dem.map',
+        'Interpolation': {'@latMap': config_dict['interpolation.latMap'],
+                          '@lonMap': config_dict['interpolation.lonMap'],
+                          '@mode': 'nearest'},
+    }
+
+    @staticmethod
+    def args(tmp_path, out_maps, out_dir, workers=1, parameter=None):
+        commands = {'Execution': {'@name': 'multi target test', '@targetWorkers': workers,
+                                  'Parameter': dict({'@shortName': '2t'}, **(parameter or {})), 'OutMaps': out_maps}}
+        commands_file = tmp_path.joinpath('commands.json')
+        commands_file.write_text(json.dumps(commands))
+        return ['-c', commands_file.as_posix(), '-i', config_dict['input.file'],
+                '-o', tmp_path.joinpath(out_dir).as_posix(), '-N', 'tests/data', '-l', 'ERROR']
+
+    def run(self, tmp_path, out_maps, out_dir, workers=1):
+        return pyg2p_exe(self.args(tmp_path, out_maps, out_dir, workers))
+
+    def test_targets_as_single_runs(self, tmp_path):
+        netcdf_maps = deepcopy(self.out_maps)
+        netcdf_maps.update({'@format': 'netcdf', '@namePrefix': 't2'})
+        assert self.run(tmp_path, [self.out_maps, netcdf_maps], 'multi', workers=2) == 0
+        assert self.run(tmp_path, self.out_maps, 'single') == 0
+        assert self.run(tmp_path, netcdf_maps, 'single') == 0
+        multi = Dataset(tmp_path.joinpath('multi/t2_None.nc').as_posix())['t2'][:]
+        single = Dataset(tmp_path.joinpath('single/t2_None.nc').as_posix())['t2'][:]
+        assert np.ma.allequal(multi, single)
+        for i in range(1, multi.shape[0] + 1):
+            multi_map = PCRasterReader(tmp_path.joinpath(f'multi/2t000000.00{i}').as_posix()).values
+            single_map = PCRasterReader(tmp_path.joinpath(f'single/2t000000.00{i}').as_posix()).values
+            assert np.array_equal(multi_map, single_map, equal_nan=True)
+
+    def test_targets_with_same_outputs(self, tmp_path):
+        # a second block must change output folder, name or format
+        assert self.run(tmp_path, [self.out_maps, self.out_maps], 'multi') == 1
+        other_dir = dict(self.out_maps, **{'@outDir': 'other'})
+        assert self.run(tmp_path, [self.out_maps, other_dir], 'multi') == 0
+        assert tmp_path.joinpath('multi/other/2t000000.001').exists()
+
+    def test_targets_with_correction_need_dem(self, tmp_path):
+        correction = {'@correctionFormula': 'p+gem-dem*0.0065', '@gem': '(z/9.81)*0.0065', '@demMap': 'tests/data/dem.map'}
+        other_dir = dict(self.out_maps, **{'@outDir': 'other'})
+        # the DEM of the first block is not used for other targets
+        with pytest.raises(ApplicationException) as e:
+            ExecutionContext(self.args(tmp_path, [self.out_maps, other_dir], 'multi', parameter=correction))
+        assert e.value.code == MISSING_FORMULAS_IN_EXEC
+        other_dir['@demMap'] = 'tests/data/dem.map'
+        ctx = ExecutionContext(self.args(tmp_path, [self.out_maps, other_dir], 'multi', parameter=correction))
+        assert ctx.targets[1]['correction.demMap'] == 'tests/data/dem.map'
+
+    def test_all_members_with_short_name_variants(self, tmp_path):
+        ctx = ExecutionContext(self.args(tmp_path, self.out_maps, 'members') + ['-m', 'all'])
+        controller = Controller(ctx)
+        controller.grib_reader = GRIBReader(config_dict['input.file'])
+        # members are found under the same shortName variants used to select messages
+        for header in controller.grib_reader._catalogue:
+            header['shortName'] = '2T'
+        assert controller.members() == [2]
+        for header in controller.grib_reader._catalogue:
+            header['shortName'] = 'xx'
+        with pytest.raises(ApplicationException) as e:
+            controller.members()
+        assert e.value.code == NO_MESSAGES
+        controller.grib_reader.close()
@@ -0,0 +1,121 @@
+import json
+import os
+import signal
+import threading
+import time
+
+from pyg2p.main.daemon import Daemon, DONE, FAILED, QUEUED, JOB_EXT, STATUS_EXT, TAKEN_EXT
+
+from tests import config_dict
+
+
+def commands_file(tmp_path):
+    commands = {'Execution': {'@name': 'daemon test', 'Parameter': {'@shortName': '2t'},
+                              'OutMaps': {'@cloneMap': 'tests/data/dem.map',
+                                          'Interpolation': {'@latMap': config_dict['interpolation.latMap'],
+                                                            '@lonMap': config_dict['interpolation.lonMap'],
+                                                            '@mode': 'nearest'}}}}
+    path = tmp_path.joinpath('commands.json')
+    path.write_text(json.dumps(commands))
+    return path.as_posix()
+
+
+class TestDaemon:
+    command = 'pyg2p -c {cmd} -i {inp} -o {out} -N tests/data -l ERROR'
+
+    @staticmethod
+    def wait(daemon, job_id):
+        while daemon.status(job_id)['status'] not in (DONE, FAILED):
+            time.sleep(0.1)
+        return daemon.status(job_id)
+
+    def test_jobs(self, tmp_path):
+        daemon = Daemon(workers=1)
+        try:
+            job = daemon.submit('pyg2p -c {cmd} -i {inp} -o {out}', params={'cmd': tmp_path / 'missing.json',
+                                                                           'inp': 'tests/data/input.grib',
+                                                                           'out': tmp_path.as_posix()})
+            status = self.wait(daemon, job.id)
+            assert status['status'] == FAILED
+            assert status['return_code'] == 1
+            assert daemon.handle_request({'action': 'status', 'job': 'xyz'})['error'] == 'unknown job'
+            assert 'error' in daemon.handle_request({'action': 'restart'})
+            assert [j['job'] for j in daemon.handle_request({'action': 'status'})['jobs']] == [job.id]
+        finally:
+            daemon.shutdown()
+
+    def test_successful_jobs(self, tmp_path):
+        daemon = Daemon(workers=1, max_jobs_per_worker=1, keep_finished=1)
+        try:
+            params = {'cmd': commands_file(tmp_path), 'inp': config_dict['input.file']}
+            jobs = [daemon.submit(self.command, params=dict(params, out=tmp_path.joinpath(f'out{i}').as_posix())) for i in range(2)]
+            # the second job waits for the only worker, even when it's already in the call queue of the pool
+            assert jobs[1].status == QUEUED
+            for job in jobs:
+                job.future.result()
+                assert job.status == DONE and job.to_dict()['return_code'] == 0
+            assert tmp_path.joinpath('out0/2t000000.001').exists() and tmp_path.joinpath('out1/2t000000.001').exists()
+            # completed jobs leave the job list, and only the last keep_finished statuses are kept
+            while daemon.jobs:
+                time.sleep(0.1)
+            assert [j['job'] for j in daemon.status()['jobs']] == [jobs[1].id]
+        finally:
+            daemon.shutdown()
+
+    def test_spool(self, tmp_path):
+        spool = tmp_path.joinpath('spool')
+        daemon = Daemon(workers=1, spool_dir=spool.as_posix(), poll_interval=0.1)
+        spool.mkdir()
+        request = {'command': self.command, 'params': {'cmd': commands_file(tmp_path), 'inp': config_dict['input.file'],
+                                                      'out': tmp_path.joinpath('out').as_posix()}}
+        spool.joinpath('t2' + JOB_EXT).write_text(json.dumps(request))
+        spool.joinpath('invalid' + JOB_EXT).write_text('{"params": {}}')
+        poll = threading.Thread(target=daemon._poll_spool, daemon=True)
+        poll.start()
+        try:
+            status_file = spool.joinpath('t2' + STATUS_EXT)
+            while not status_file.exists() or json.loads(status_file.read_text())['status'] not in (DONE, FAILED):
+                time.sleep(0.1)
+            status = json.loads(status_file.read_text())
+            assert status['status'] == DONE and status['return_code'] == 0
+            assert tmp_path.joinpath('out/2t000000.001').exists()
+            assert not spool.joinpath('t2' + TAKEN_EXT).exists()
+            assert json.loads(spool.joinpath('invalid' + STATUS_EXT).read_text())['status'] == FAILED
+            assert not daemon.jobs and daemon.status('t2')['error'] == 'unknown job'
+        finally:
+            daemon.shutdown()
+            poll.join()
+
+    def test_broken_pool(self, tmp_path):
+        spool = tmp_path.joinpath('spool')
+        spool.mkdir()
+        daemon = Daemon(workers=1, spool_dir=spool.as_posix(), poll_interval=0.1)
+        poll = threading.Thread(target=daemon._poll_spool, daemon=True)
+        poll.start()
+        request = {'command': 'pyg2p -c {cmd} -i {inp} -o {out}',
+                   'params': {'cmd': (tmp_path / 'missing.json').as_posix(), 'inp': 'tests/data/input.grib', 'out': tmp_path.as_posix()}}
+
+        def run_spooled(name):
+            spool.joinpath(name + JOB_EXT).write_text(json.dumps(request))
+            status_file = spool.joinpath(name + STATUS_EXT)
+            while not status_file.exists() or json.loads(status_file.read_text())['status'] not in (DONE, FAILED):
+                time.sleep(0.1)
+            return json.loads(status_file.read_text())
+
+        try:
+            assert run_spooled('before')['return_code'] == 1
+            # a worker killed (e.g. by the OOM killer) breaks the pool
+            broken_pool = daemon._pool
+            for process in list(broken_pool._processes.values()):
+                os.kill(process.pid, signal.SIGKILL)
+            while not broken_pool._broken:
+                time.sleep(0.1)
+            # the job submitted to the broken pool fails, and the next ones run with new workers
+            status = run_spooled('broken')
+            assert status['status'] == FAILED and 'error' in status
+            assert not spool.joinpath('broken' + TAKEN_EXT).exists()
+            assert daemon._pool is not broken_pool
+            assert run_spooled('after')['return_code'] == 1
+        finally:
+            daemon.shutdown()
+            poll.join()
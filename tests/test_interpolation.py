@@ -1,12 +1,19 @@
 import os
 from copy import deepcopy
 
+import numpy as np
 import pytest
 
-from pyg2p.main.interpolation import Interpolator
+from pyg2p.main.interpolation import Interpolator, intertable
+from pyg2p.main.interpolation.checkpoint import Checkpoint
+from pyg2p.main.interpolation.geometry import SourceGeometry
+from pyg2p.main.interpolation.scipy_interpolation_lib import ScipyInterpolation, stretched_latitudes
+from pyg2p.main.interpolation.sparse import SparseOperator
 from pyg2p.main.readers import GRIBReader, PCRasterReader
+from pyg2p.main.readers.netcdf import NetCDFReader
 
 from tests import MockedExecutionContext, config_dict
+from tests.bilinear_loop import build_weights_bilinear_loop
 
 
 class TestInterpolation:
@@ -25,7 +32,475 @@ class TestInterpolation:
         shape_target = PCRasterReader(config_dict['interpolation.latMap']).values.shape
         assert shape_target == values_resampled.shape
 
+    def test_intertable_mmap_layout(self, tmp_path):
+        tbl = 'tests/data/tbl_pf10slhf_550800_scipy_nearest.npy.gz'
+        converted = intertable.convert(tbl, intertable.MMAP, out_dir=tmp_path.as_posix())
+        assert converted == tmp_path.joinpath('tbl_pf10slhf_550800_scipy_nearest.mmap').as_posix()
+        original = intertable.load(tbl)
+        mapped = intertable.load(tmp_path.joinpath('tbl_pf10slhf_550800_scipy_nearest.npy').as_posix())
+        assert isinstance(mapped['indexes'], np.memmap)
+        assert np.array_equal(mapped['indexes'], original['indexes'])
+        assert np.array_equal(mapped['coeffs'], original['coeffs'])
+
+    def test_intertable_compact_layout(self, tmp_path):
+        tbl = 'tests/data/tbl_pf10slhf_550800_scipy_nearest.npy.gz'
+        meta = {'id': 'test', 'mode': 'nearest', 'nnear': 1, 'source_shape': [212065], 'target_shape': [810, 680]}
+        converted = intertable.convert(tbl, intertable.COMPACT, out_dir=tmp_path.as_posix(), meta=meta)
+        assert intertable.read_compact_header(converted)['meta'] == meta
+        original = intertable.load(tbl)
+        compact = intertable.load(tmp_path.joinpath('tbl_pf10slhf_550800_scipy_nearest.npy').as_posix())
+        # narrowest dtype for indexes
+        assert compact['indexes'].dtype == np.uint32
+        assert np.array_equal(compact['indexes'], original['indexes'])
+
+    def test_intertable_compact_weights(self, tmp_path):
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        target_lats, target_lons = target_lats[::4, ::4], target_lons[::4, ::4]
+        for mode, nnear in (('invdist', 4), ('bilinear', 4)):
+            _, weights, indexes = ScipyInterpolation(lons, lats, messages.grid_details, values_in, nnear, -999., messages.missing_value,
+                                                     mode=mode).interpolate(target_lons, target_lats)
+            tbl = tmp_path.joinpath(f'tbl_{mode}.npy').as_posix()
+            intertable.save(tbl, np.rec.fromarrays((indexes, weights), names=('indexes', 'coeffs')))
+            converted = intertable.convert(tbl, intertable.COMPACT, meta={'mode': mode, 'nnear': nnear})
+            compact = intertable.load_compact(converted)
+            # weights are stored as float32 and results stay within the tolerance
+            assert compact['coeffs'].dtype == np.float32
+            expected, result = [SparseOperator.from_scipy(table['indexes'], table['coeffs'], nnear, values_in.size, target_lats.shape).apply([values_in], -999.)[0]
+                                for table in (intertable.load(tbl), compact)]
+            assert np.array_equal(np.ma.getmaskarray(result), np.ma.getmaskarray(expected))
+            assert np.ma.allclose(result, expected, rtol=2 * intertable.COMPACT_WEIGHTS_TOLERANCE, atol=0)
+
+    def test_intertable_converted_again(self, tmp_path):
+        original = intertable.load('tests/data/tbl_pf10slhf_550800_scipy_nearest.npy.gz')
+        tbl = tmp_path.joinpath('tbl_test_scipy_nearest.npy.gz').as_posix()
+        intertable.save(tbl, original)
+        for layout in intertable.LAYOUTS:
+            converted = intertable.convert(tbl, layout)
+            assert intertable.converted_source(converted, layout) == intertable.source_signature(tbl)
+            assert intertable.convert(tbl, layout) == converted
+        # the source table is created again: converted tables are not read, and converted again
+        changed = original.copy()
+        changed['indexes'][:10] = 0
+        intertable.save(tbl, changed)
+        # modification time may not change within the resolution of the file system clock
+        os.utime(tbl, ns=(0, 0))
+        assert np.array_equal(intertable.load(tbl)['indexes'], changed['indexes'])
+        for layout in intertable.LAYOUTS:
+            converted = intertable.convert(tbl, layout)
+            assert intertable.converted_source(converted, layout) == intertable.source_signature(tbl)
+        loaded = intertable.load(tbl)
+        assert isinstance(loaded['indexes'], np.memmap)
+        assert np.array_equal(loaded['indexes'], changed['indexes'])
+        assert np.array_equal(intertable.load_compact(intertable.compact_path(tbl))['indexes'], changed['indexes'])
+
+    def test_intertable_save_stream(self, tmp_path):
+        original = intertable.load('tests/data/tbl_pf10slhf_550800_scipy_nearest.npy.gz')
+        tbl = tmp_path.joinpath('tbl_stream.npy.gz').as_posix()
+        intertable.save_stream(tbl, original.shape, original.dtype, (original[i:i + 100000] for i in range(0, original.size, 100000)))
+        streamed = intertable.load(tbl)
+        assert streamed.dtype == original.dtype
+        assert np.array_equal(streamed, original)
+
     #@pytest.mark.slow
+    def test_sparse_operator(self):
+        rng = np.random.default_rng(0)
+        source_size, target_shape, mv = 100, (20, 30), -9999.
+        values = [rng.random(source_size) * 300 for _ in range(3)]
+        # index == source_size is the missing value
+        indexes = rng.integers(0, source_size + 1, (600, 4))
+        weights = rng.random((600, 4))
+        operator = SparseOperator.from_scipy(indexes, weights, 4, source_size, target_shape)
+        results = operator.apply(values, mv)
+        for v, result in zip(values, results):
+            expected = np.einsum('ij,ij->i', weights, np.append(v, mv)[indexes]).reshape(target_shape)
+            assert np.allclose(result, expected, rtol=1e-15)
+            assert np.array_equal(result, operator.apply([v], mv)[0])
+        nearest = SparseOperator.from_scipy(indexes[:, 0], None, 1, source_size, target_shape)
+        assert np.array_equal(nearest.apply(values, mv)[1], np.append(values[1], mv)[indexes[:, 0]].reshape(target_shape))
+
+        # grib_invdist tables: results only on xs, ys and masked values set to mv
+        xs, ys = np.unravel_index(np.arange(0, 600, 2), target_shape)
+        idxs, coeffs = indexes[::2, :].T % source_size, weights[::2, :].T
+        v = np.ma.masked_where(values[0] > 250, values[0])
+        result = SparseOperator.from_grib(xs, ys, list(idxs), list(coeffs), source_size, target_shape).apply([v], mv, masks=[v.mask])[0]
+        expected = np.full(target_shape, mv)
+        res = v[idxs[0]] * coeffs[0] + v[idxs[1]] * coeffs[1] + v[idxs[2]] * coeffs[2] + v[idxs[3]] * coeffs[3]
+        expected[xs, ys] = res.filled(mv)
+        assert np.array_equal(result, expected)
+
+    def test_scipy_masked_source(self):
+        reader = GRIBReader(config_dict['input.file'])
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        lats, lons = messages.latlons
+        interpolator = Interpolator(MockedExecutionContext(config_dict, False), messages.missing_value)
+        masked = np.ma.masked_where(values_in > np.median(values_in), values_in)
+        result, unmasked = interpolator.interpolate_values(lats, lons, [masked, values_in], messages.grid_id, messages.grid_details)
+        if isinstance(np.ma.getmask(np.append(masked[:1], interpolator.mv_output)), np.ndarray):
+            # results of masked source values are masked, the other ones are the same as without mask
+            _, intertable_name = interpolator._intertable_filename(messages.grid_id)
+            indexes, _ = interpolator._read_intertable(intertable_name)
+            expected_mask = np.append(masked.mask, False)[indexes].reshape(result.shape)
+            assert expected_mask.any() and not expected_mask.all()
+            assert np.array_equal(np.ma.getmaskarray(result), expected_mask)
+            assert np.array_equal(result.compressed(), unmasked[~expected_mask])
+        else:
+            # np.append doesn't keep the mask of the source values: results are computed from unmasked data
+            assert not np.ma.getmaskarray(result).any()
+            assert np.ma.allequal(result, unmasked)
+
+    def test_bilinear_weights_same_as_loop(self):
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        # a subset of the target grid and a global grid (points around poles and date line)
+        targets = [(target_lats[::20, ::20], target_lons[::20, ::20]),
+                   np.meshgrid(np.linspace(89.9, -89.9, 30), np.linspace(-179.9, 179.9, 60), indexing='ij')]
+        interpolation = ScipyInterpolation(lons, lats, messages.grid_details, values_in, 4, -999., messages.missing_value, mode='bilinear')
+        # with a KDTree, corners of reduced gaussian grids are searched in retry rounds
+        interpolation.tree = interpolation._build_tree()
+        for target_lats, target_lons in targets:
+            interpolation.target_latsOR, interpolation.target_lonsOR = target_lats, target_lons
+            x, y, z = interpolation.to_3d(target_lons, target_lats)
+            locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+            distances, indexes = interpolation.tree.query(locations, k=4)
+            result, weights, idxs = interpolation._build_weights_bilinear(distances, indexes.copy(), locations, 4)
+            result_loop, weights_loop, idxs_loop = build_weights_bilinear_loop(interpolation, distances, indexes.copy(), locations, 4)
+            assert np.array_equal(idxs, idxs_loop)
+            assert np.allclose(weights, weights_loop, rtol=0, atol=1e-9, equal_nan=True)
+            assert np.ma.allclose(result, result_loop)
+
+    def test_split_in_processes_same_as_sequential(self):
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        target_lats, target_lons = target_lats[::10, ::10], target_lons[::10, ::10]
+        for mode, nnear in (('nearest', 1), ('adw', 11)):
+            results = [ScipyInterpolation(lons, lats, messages.grid_details, values_in.copy(), nnear, -999., messages.missing_value,
+                                          mode=mode, parallel=parallel, num_of_splits=5).interpolate(target_lons, target_lats)
+                       for parallel in (2, False)]
+            for res, expected in zip(*results):
+                assert np.array_equal(np.ma.getdata(res), np.ma.getdata(expected), equal_nan=True)
+
+    def test_split_for_max_memory(self):
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        interpolation = ScipyInterpolation(lons, lats, messages.grid_details, values_in, 4, -999., messages.missing_value, mode='invdist')
+        expected = interpolation.interpolate(target_lons, target_lats)
+        interpolation.max_memory = 150 * 1024 ** 2
+        subsets, _ = interpolation.split_rows(target_lats.shape, keep_results=True)
+        assert len(subsets) > 1
+        for res, exp in zip(interpolation.interpolate(target_lons, target_lats), expected):
+            assert np.array_equal(np.ma.getdata(res), np.ma.getdata(exp))
+
+    def test_split_resumed_from_checkpoint(self, tmp_path):
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        target_lats, target_lons = target_lats[::10, ::10], target_lons[::10, ::10]
+        checkpoint = Checkpoint(tmp_path.joinpath('tbl_id').as_posix())
+        interpolation = ScipyInterpolation(lons, lats, messages.grid_details, values_in, 4, -999., messages.missing_value,
+                                           mode='invdist', num_of_splits=5, checkpoint=checkpoint)
+        expected = interpolation.interpolate(target_lons, target_lats)
+        assert checkpoint.completed(4) and not checkpoint.completed(5)
+        # an interrupted creation: first chunk is loaded (here with altered weights) and the others are computed
+        os.remove(checkpoint._chunk_file(3))
+        os.remove(checkpoint._chunk_file(4))
+        result, weights, indexes = checkpoint.load(0)
+        checkpoint.save(0, (result, weights + 1, indexes))
+        _, weights, indexes = interpolation.interpolate(target_lons, target_lats)
+        size = checkpoint.chunk_size
+        assert np.array_equal(weights[:size], expected[1][:size] + 1)
+        assert np.array_equal(weights[size:], expected[1][size:])
+        assert np.array_equal(indexes, expected[2])
+        assert checkpoint.completed(4)
+        # chunks of different settings are discarded
+        interpolation.num_of_splits = 4
+        interpolation.interpolate(target_lons, target_lats)
+        assert not checkpoint.completed(4)
+        checkpoint.clear()
+        assert not os.path.exists(checkpoint.work_dir)
+
+    def test_source_geometry_cache(self, tmp_path):
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        target_lats, target_lons = target_lats[::10, ::10], target_lons[::10, ::10]
+        geometry = SourceGeometry(messages.grid_id, tmp_path.as_posix())
+        lats, lons = geometry.latlons(messages.grid_details)
+        results = [ScipyInterpolation(lons, lats, messages.grid_details, values_in, 3, -999., messages.missing_value,
+                                      mode='triangulation', geometry=geometry).interpolate(target_lons, target_lats)
+                   for _ in range(2)]
+        # reduced gaussian grids are indexed by latitude rings, not with a KDTree (and triangulation needs no min_upper_bound)
+        for name in ('latlons', 'delaunay'):
+            # second interpolation used cached items
+            geometry.get(name, lambda: pytest.fail(f'{name} not cached'))
+        expected = ScipyInterpolation(lons, lats, messages.grid_details, values_in, 3, -999., messages.missing_value,
+                                      mode='triangulation').interpolate(target_lons, target_lats)
+        for result in results:
+            for res, exp in zip(result, expected):
+                assert np.array_equal(np.ma.getdata(res), np.ma.getdata(exp))
+
+    def test_ring_grid_index_same_as_kdtree(self):
+        from scipy.spatial import cKDTree
+        from pyg2p.main.interpolation.ring_grid import RingGridIndex
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        # global grid, global gaussian grid and a regional grid, with template and global targets
+        targets = [(target_lats[::5, ::5], target_lons[::5, ::5]),
+                   np.meshgrid(np.linspace(89.9, -89.9, 50), np.linspace(-179.9, 179.9, 100), indexing='ij')]
+        grids = [np.meshgrid(np.arange(89.75, -90, -0.5), np.arange(0, 360, 0.5), indexing='ij'),
+                 np.meshgrid(np.degrees(np.arcsin(np.polynomial.legendre.leggauss(64)[0])), np.arange(-180, 180, 360 / 256), indexing='ij'),
+                 np.meshgrid(np.arange(70, 29, -1.), np.arange(-30, 50.1, 1.), indexing='ij')]
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        interpolation = ScipyInterpolation(*messages.latlons[::-1], messages.grid_details, values_in, 1, -999., messages.missing_value)
+        assert isinstance(interpolation.tree, RingGridIndex)
+        # and the reduced gaussian grid of the source
+        grids.append(messages.latlons)
+        for lats, lons in grids:
+            x, y, z = interpolation.to_3d(lons.ravel(), lats.ravel())
+            locations = np.vstack((x, y, z)).T
+            index = RingGridIndex.from_grid(locations, lats, lons, messages.grid_details.get('radius'))
+            tree = cKDTree(locations)
+            for tlats, tlons in targets:
+                x, y, z = interpolation.to_3d(tlons, tlats)
+                target_locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+                for k in (1, 4):
+                    distances, indexes = index.query(target_locations, k=k)
+                    expected_distances, expected_indexes = tree.query(target_locations, k=k)
+                    assert np.array_equal(distances, expected_distances)
+                    assert np.array_equal(indexes, expected_indexes)
+        # points not ordered by rings
+        lats, lons = grids[0]
+        assert RingGridIndex.from_grid(locations, lats.T, lons.T, 1) is None
+
+    def test_ring_grid_tables_same_as_kdtree(self):
+        from pyg2p.main.interpolation.ring_grid import RingGridIndex
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        radius = messages.grid_details.get('radius')
+        # the reduced gaussian grid of the source and a regular_ll grid
+        regular_lats, regular_lons = [a.ravel() for a in np.meshgrid(np.arange(89.5, -90, -1.), np.arange(0, 360, 1.), indexing='ij')]
+        sources = [(lats, lons, messages.grid_details, values_in),
+                   (regular_lats, regular_lons, {'gridType': 'regular_ll', 'radius': radius, 'Nj': 180},
+                    np.cos(np.radians(regular_lats)) * np.sin(np.radians(regular_lons)))]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        target_lats, target_lons = target_lats[::10, ::10], target_lons[::10, ::10]
+        for source_lats, source_lons, grid_details, values in sources:
+            for mode, nnear in (('nearest', 1), ('invdist', 4), ('bilinear', 4)):
+                with_index = ScipyInterpolation(source_lons, source_lats, grid_details, values.copy(), nnear, -999., messages.missing_value, mode=mode)
+                assert isinstance(with_index.tree, RingGridIndex)
+                without_index = ScipyInterpolation(source_lons, source_lats, grid_details, values.copy(), nnear, -999., messages.missing_value, mode=mode)
+                without_index.tree = without_index._build_tree()
+                result, weights, indexes = with_index.interpolate(target_lons, target_lats)
+                expected_result, expected_weights, expected_indexes = without_index.interpolate(target_lons, target_lats)
+                assert np.array_equal(indexes, expected_indexes)
+                assert np.array_equal(weights, expected_weights, equal_nan=True)
+                assert np.ma.allequal(result, expected_result)
+
+    def test_ring_grid_bilinear_quads(self):
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        interpolation = ScipyInterpolation(lons, lats, messages.grid_details, values_in, 4, -999., messages.missing_value, mode='bilinear_rings')
+        target_lats, target_lons = np.meshgrid(np.linspace(89.9, -89.9, 60), np.linspace(-179.9, 179.9, 120), indexing='ij')
+        interpolation.target_latsOR, interpolation.target_lonsOR = target_lats, target_lons
+        x, y, z = interpolation.to_3d(target_lons, target_lats)
+        locations = np.vstack((x.ravel(), y.ravel(), z.ravel())).T
+        distances, indexes = interpolation.tree.query(locations, k=4)
+        result, weights, idxs = interpolation._build_weights_bilinear(distances, indexes, locations, 4)
+        quads, found = interpolation.tree.enclosing(target_lats.ravel(), target_lons.ravel())
+        assert found.all()
+        # corners are the two points around targets on the two rings around them
+        assert np.array_equal(np.sort(idxs, axis=1), np.sort(quads, axis=1))
+        inner = np.abs(target_lats.ravel()) < lats.max()
+        corner_lats = np.sort(lats[idxs[inner]], axis=1)
+        assert (corner_lats[:, 0] == corner_lats[:, 1]).all() and (corner_lats[:, 2] == corner_lats[:, 3]).all()
+        assert ((corner_lats[:, 0] < target_lats.ravel()[inner]) & (target_lats.ravel()[inner] <= corner_lats[:, 2])).all()
+        # and the two corners on each ring bracket the target longitude
+        corner_lons = np.take_along_axis(lons[idxs], np.argsort(lats[idxs], axis=1), axis=1)[inner]
+        offsets = np.mod(corner_lons - target_lons.ravel()[inner][:, np.newaxis] + 180, 360) - 180
+        for ring in (offsets[:, :2], offsets[:, 2:]):
+            assert ((ring.min(axis=1) <= 0) & (ring.max(axis=1) >= 0)).all()
+        assert np.allclose(weights.sum(axis=1), 1) and (weights >= 0).all()
+        assert np.allclose(result, np.einsum('ij,ij->i', weights, values_in[idxs]))
+
+    def test_source_pruned_around_target(self):
+        reader = GRIBReader('tests/data/input.grib')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        target_lats, target_lons = target_lats[200:500:2, 300:700:2], target_lons[200:500:2, 300:700:2]
+        for mode, nnear in (('nearest', 1), ('adw', 11), ('bilinear', 4)):
+            pruned = ScipyInterpolation(lons, lats, messages.grid_details, values_in, nnear, -999., messages.missing_value, mode=mode)
+            result = pruned.interpolate(target_lons, target_lats)
+            assert pruned.source_indexes is not None and pruned.source_indexes.size < values_in.size / 10
+            interpolation = ScipyInterpolation(lons, lats, messages.grid_details, values_in, nnear, -999., messages.missing_value, mode=mode)
+            interpolation.tree = interpolation._build_tree()
+            expected = interpolation.interpolate(target_lons, target_lats)
+            # indexes refer to the whole source grid
+            for res, exp in zip(result, expected):
+                assert np.array_equal(np.ma.getdata(res), np.ma.getdata(exp))
+        # target points out of the pruned grid are interpolated on the whole grid
+        far_lats, far_lons = target_lats[::10, 0] - 3, target_lons[::10, 0] - 3
+        result = pruned.interpolate_cells(far_lons, far_lats)
+        assert pruned.source_indexes is None
+        expected = interpolation.interpolate_cells(far_lons, far_lats)
+        for res, exp in zip(result, expected):
+            assert np.array_equal(np.ma.getdata(res), np.ma.getdata(exp))
+
+    def test_interpolate_modes_same_as_single_modes(self):
+        reader = GRIBReader('tests/data/input.grib')
+        messages = reader.select_messages(shortName='2t')
+        lats, lons = messages.latlons
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        target_lats, target_lons = target_lats[::4, ::4], target_lons[::4, ::4]
+        modes = {'nearest': 1, 'invdist': 4, 'adw': 11, 'bilinear': 4}
+        for num_of_splits in (None, 3):
+            interpolation = ScipyInterpolation(lons, lats, messages.grid_details, values_in, 1, -999., messages.missing_value,
+                                               mode='nearest', num_of_splits=num_of_splits)
+            results = interpolation.interpolate_modes(target_lons, target_lats, modes)
+            assert interpolation.mode == 'nearest' and interpolation.nnear == 1
+            for mode, nnear in modes.items():
+                expected = ScipyInterpolation(lons, lats, messages.grid_details, values_in, nnear, -999., messages.missing_value,
+                                              mode=mode, num_of_splits=num_of_splits).interpolate(target_lons, target_lats)
+                for res, exp in zip(results[mode][1:], expected[1:]):
+                    assert np.array_equal(res, exp)
+
+    def test_interpolation_create_scipy_modes(self):
+        d = deepcopy(config_dict)
+        d['interpolation.create'] = True
+        d['interpolation.modes'] = ['nearest', 'invdist']
+        reader = GRIBReader(d['input.file'])
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        lats, lons = messages.latlons
+        interpolator = Interpolator(MockedExecutionContext(d, False), messages.missing_value)
+        tables = [interpolator._intertable_filename(messages.grid_id, mode) for mode in ('nearest', 'invdist')]
+        try:
+            values_resampled = interpolator.interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details)
+            # the invdist table is registered under its own id
+            for (intertable_id, intertable_name), mode in zip(tables, ('nearest', 'invdist')):
+                assert intertable.exists(intertable_name)
+                assert interpolator.intertables_config.vars[intertable_id]['method'] == mode
+            d['interpolation.mode'] = 'invdist'
+            interpolator = Interpolator(MockedExecutionContext(d, False), messages.missing_value)
+            assert interpolator._intertable_filename(messages.grid_id) == tables[1]
+            assert values_resampled.shape == interpolator.interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details).shape
+        finally:
+            if os.path.exists('tests/data/tbl_pf10tp_550800_scipy_invdist.npy.gz'):
+                os.unlink('tests/data/tbl_pf10tp_550800_scipy_invdist.npy.gz')
+
+    def test_intertable_derived_from_overlapping_target(self, tmp_path):
+        from netCDF4 import Dataset
+        from osgeo import gdal
+
+        def write_netcdf(name, lat, lon):
+            with Dataset(tmp_path.joinpath(name).as_posix(), 'w') as nc:
+                nc.createDimension('lat', lat.size)
+                nc.createDimension('lon', lon.size)
+                nc.createVariable('lat', 'f8', ('lat',))[:] = lat
+                nc.createVariable('lon', 'f8', ('lon',))[:] = lon
+                nc.createVariable('template', 'i1', ('lat', 'lon'), fill_value=0)[:] = 1
+            return tmp_path.joinpath(name).as_posix(), tmp_path.joinpath(name).as_posix()
+
+        def write_pcraster(name, col, row, cols, rows):
+            # float32 maps cut out of the lat/lon maps of tests
+            paths = []
+            for coord in ('lat', 'lon'):
+                paths.append(tmp_path.joinpath(f'{name}_{coord}.map').as_posix())
+                gdal.Translate(paths[-1], config_dict[f'interpolation.{coord}Map'], srcWin=[col, row, cols, rows], format='PCRaster')
+            return tuple(paths)
+
+        template = NetCDFReader('tests/data/template_test.nc')
+        lat, lon = template.get_lat_values()[::4], template.get_lon_values()[::4]
+        step = lat[1] - lat[0]
+        targets = {
+            'netcdf': {'parent': write_netcdf('parent.nc', lat, lon),
+                       # a sub-domain and a grid shifted by some rows and columns
+                       'crop': write_netcdf('crop.nc', lat[20:120], lon[10:140]),
+                       'extended': write_netcdf('extended.nc', np.r_[lat[0] - step * np.arange(10, 0, -1), lat[:-20]], lon[5:])},
+            'pcraster': {'parent': write_pcraster('parent', 200, 200, 150, 150),
+                         'crop': write_pcraster('crop', 210, 220, 130, 100),
+                         'extended': write_pcraster('extended', 195, 180, 150, 150)},
+        }
+        reader = GRIBReader('tests/data/era5_T2avg_19790101.grb')
+        messages = reader.select_messages(shortName='2t')
+        values_in = messages.values_first_or_single_res[messages.first_step_range]
+        lats, lons = messages.latlons
+
+        def interpolate(target_maps, mode, tables_dir, derive=True):
+            d = deepcopy(config_dict)
+            d.update({'interpolation.create': True, 'interpolation.mode': mode, 'input.file': 'tests/data/era5_T2avg_19790101.grb',
+                      'interpolation.latMap': target_maps[0], 'interpolation.lonMap': target_maps[1],
+                      'interpolation.dirs': {'user': tables_dir, 'global': tables_dir}})
+            interpolator = Interpolator(MockedExecutionContext(d, False), messages.missing_value)
+            if not derive:
+                interpolator.min_derived_overlap = 2
+            result = interpolator.interpolate_scipy(lats, lons, values_in, messages.grid_id, messages.grid_details)
+            intertable_id, intertable_name = interpolator._intertable_filename(messages.grid_id)
+            return result, intertable.load(intertable_name), interpolator.intertables_config.vars[intertable_id]
+
+        for target_format, format_targets in targets.items():
+            for mode in Interpolator.derived_modes:
+                derived_dir, created_dir = tmp_path.joinpath(target_format, mode, 'derived'), tmp_path.joinpath(target_format, mode, 'created')
+                derived_dir.mkdir(parents=True)
+                created_dir.mkdir(parents=True)
+                _, _, parent_conf = interpolate(format_targets['parent'], mode, derived_dir.as_posix())
+                for target in ('crop', 'extended'):
+                    result, table, conf = interpolate(format_targets[target], mode, derived_dir.as_posix())
+                    assert conf['derived_from'] == parent_conf['filename']
+                    expected, expected_table, _ = interpolate(format_targets[target], mode, created_dir.as_posix(), derive=False)
+                    assert table['coeffs'].dtype == expected_table['coeffs'].dtype
+                    assert np.array_equal(table['indexes'], expected_table['indexes'])
+                    assert np.array_equal(table['coeffs'], expected_table['coeffs'])
+                    assert np.ma.allequal(result, expected)
+
+    def test_grib_nearest_batch_same_as_points(self):
+        import eccodes
+        from pyg2p.main.interpolation.grib_interpolation_lib import find_nearest, find_4_nearest, nearest_handle
+        target_lats, target_lons = NetCDFReader('tests/data/template_test.nc').get_lat_lon_values()
+        lats, lons = target_lats[::40, ::40].ravel()[:150], target_lons[::40, ::40].ravel()[:150]
+        with open('tests/data/era5_T2avg_19790101.grb', 'rb') as f:
+            gid = eccodes.codes_grib_new_from_file(f)
+        try:
+            with nearest_handle(gid) as nid:
+                indexes = find_nearest(gid, nid, lats, lons)
+                invs, indexes4 = find_4_nearest(gid, nid, lats, lons)
+            for k, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())):
+                assert indexes[k] == eccodes.codes_grib_find_nearest(gid, lat, lon)[0]['index']
+                n_nearest = eccodes.codes_grib_find_nearest(gid, lat, lon, npoints=4)
+                assert list(indexes4[:, k]) == [n['index'] for n in n_nearest]
+                assert list(invs[:, k]) == [1 / n['distance'] for n in n_nearest]
+        finally:
+            eccodes.codes_release(gid)
+
+    def test_stretched_latitudes(self):
+        from scipy.integrate import quad
+        lats = np.array([-89.9, -45.3, -0.1, 0., 12.5, 60., 89.78])
+        expected = [quad(lambda x: 1 / np.cos(x), 0, np.radians(lat))[0] for lat in lats]
+        assert np.allclose(stretched_latitudes(lats), expected, rtol=1e-12, atol=0)
+
     def test_interpolation_create_scipy_invdist(self):
         d = deepcopy(config_dict)
         d['interpolation.create'] = True
@@ -181,7 +656,7 @@ class TestInterpolation:
         ctx = MockedExecutionContext(d, True)
         interpolator = Interpolator(ctx, missing)
         values_in = messages.values_first_or_single_res[messages.first_step_range]
-        values_resampled = interpolator.interpolate_grib(values_in, reader._selected_grbs[0], grid_id)
+        values_resampled = interpolator.interpolate_grib(values_in, reader.get_main_aux(), grid_id)
         shape_target = PCRasterReader(d['interpolation.latMap']).values.shape
         assert shape_target == values_resampled.shape
         os.unlink('tests/data/tbl_input_550800_grib_nearest.npy.gz')
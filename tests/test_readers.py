@@ -1,10 +1,14 @@
+import os
+import shutil
+from functools import partial
+
 import numpy as np
 
 import pytest
 
 from pyg2p.main import ApplicationException
 from pyg2p.main.readers import GRIBReader, PCRasterReader
-from pyg2p import GRIBInfo
+from pyg2p import GRIBInfo, LazyValues
 
 
 class TestGribReader:
@@ -44,6 +48,99 @@ class TestGribReader:
         assert val2 is None
         assert val == np.array([100.])
 
+    def test_lazy_values(self):
+        file = 'tests/data/test.grib'
+        reader = GRIBReader(file)
+        messages = reader.select_messages(**{'shortName': 'ediff'})
+        values = messages.first_resolution_values()
+        assert isinstance(values, LazyValues)
+        # only the handle of the first message is kept open, values are decoded on access
+        assert reader._aux_gids == [reader.get_main_aux()]
+        assert sorted(float(v[0]) for v in values.values()) == sorted(float(reader._decode(h)[0]) for h in reader.scan_grib(shortName='ediff'))
+        reader.close()
+
+    def test_lazy_values_decoded_once(self):
+        calls = []
+
+        def loader(step):
+            calls.append(step)
+            return np.full(3, float(step))
+
+        values = LazyValues({step: partial(loader, step) for step in (1, 2, 3)})
+        assert 2 in values and not calls
+        assert values[2][0] == values[2][0] == 2.
+        assert calls == [2]
+        reordered = values.reorder([3, 2])
+        assert list(reordered) == [3, 2]
+        assert [v[0] for v in reordered.values()] == [3., 2.]
+        assert calls == [2, 3]
+        doubled = values.map(lambda v: v * 2)
+        assert doubled[1][0] == doubled[1][0] == 2.
+        assert calls == [2, 3, 1]
+
+    def test_parallel_decoding(self):
+        file = 'tests/data/test.grib'
+        reader = GRIBReader(file)
+        serial = reader.select_messages(**{'shortName': 'ediff'})
+        parallel_reader = GRIBReader(file, decode_workers=4)
+        parallel = parallel_reader.select_messages(**{'shortName': 'ediff'})
+        assert list(parallel.first_resolution_values()) == list(serial.first_resolution_values())
+        for step, values in serial.first_resolution_values().items():
+            assert np.array_equal(parallel.first_resolution_values()[step], values)
+        reader.close()
+        parallel_reader.close()
+
+    def test_catalogue(self):
+        file = 'tests/data/test.grib'
+        reader = GRIBReader(file)
+        # all selections are answered by the in-memory headers catalogue
+        headers = reader.scan_grib(shortName='ediff', level=lambda lev: lev >= 40)
+        assert [h['level'] for h in headers] == [40, 100]
+        assert all('offset' in h and 'totalLength' in h for h in headers)
+        assert not reader.has_geopotential()
+        reader.close()
+
+    def test_mmap_scan(self):
+        file = 'tests/data/test.grib'
+        reader = GRIBReader(file)
+        # message boundaries found in the memory-mapped file match the ones found by eccodes
+        assert reader._scan_headers() == reader._scan_headers_from_file()
+        reader.close()
+
+    def test_sidecar_index(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(GRIBReader, 'index_user_dir', tmp_path.joinpath('indexes').as_posix())
+        file = tmp_path.joinpath('test.grib').as_posix()
+        shutil.copy('tests/data/test.grib', file)
+        # index is written in the user folder, unless it's asked to write it next to the GRIB
+        reader = GRIBReader(file)
+        reader.close()
+        assert not os.path.exists(file + GRIBReader.index_suffix)
+        user_index = reader._index_paths(writing=True)[0]
+        assert user_index.startswith(GRIBReader.index_user_dir) and os.path.exists(user_index)
+        os.remove(user_index)
+        reader = GRIBReader(file, index_next_to_input=True)
+        catalogue = reader._catalogue
+        reader.close()
+        assert os.path.exists(file + GRIBReader.index_suffix)
+        # second open reads the sidecar index instead of scanning the file
+        reader = GRIBReader(file, index_next_to_input=True)
+        assert reader._catalogue == catalogue
+        messages = reader.select_messages(**{'shortName': 'ediff', 'level': 100})
+        assert len(messages) == 1
+        reader.close()
+        # index is invalidated as soon as the GRIB file changes
+        os.utime(file, ns=(0, 0))
+        reader = GRIBReader(file, index_next_to_input=True)
+        assert reader._index_signature()['mtime'] == 0
+        with open(file + GRIBReader.index_suffix) as f:
+            assert '"mtime":0' in f.read()
+        reader.close()
+
+    def test_geopotential(self):
+        reader = GRIBReader('tests/data/geopotential.grib')
+        assert reader.has_geopotential()
+        reader.close()
+
 
 class TestPCRasterReader:
     def test_read(self):
@@ -20,3 +20,22 @@ class TestStrings(unittest.TestCase):
     def test_to_argdict_for_empty_string(self):
         d = strings.to_argdict('')
         assert d == {}
+
+    def test_to_members(self):
+        assert strings.to_members('10') == 10
+        assert strings.to_members('3,1,5') == [1, 3, 5]
+        assert strings.to_members('1-4,10') == [1, 2, 3, 4, 10]
+        assert strings.to_members('ALL') == 'all'
+
+    def test_to_bytes(self):
+        assert strings.to_bytes('1024') == 1024
+        assert strings.to_bytes('16G') == 16 * 1024 ** 3
+        assert strings.to_bytes('1.5gb') == 3 * 1024 ** 3 // 2
+        assert strings.to_bytes(' 512 MiB') == 512 * 1024 ** 2
+        with self.assertRaises(ValueError):
+            strings.to_bytes('16X')
+
+    def test_to_list(self):
+        assert strings.to_list('nearest,invdist, adw') == ['nearest', 'invdist', 'adw']
+        assert strings.to_list('adw,,nearest,adw') == ['adw', 'nearest']
+        assert strings.to_list(['bilinear', 'nearest']) == ['bilinear', 'nearest']